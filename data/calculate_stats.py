@@ -1,126 +1,184 @@
 """
-This script is used to calculate the online mean and std of the dataset.
+This script is used to calculate the per-channel mean, std, min/max and
+histograms of the dataset, directly on uint8 data and with a pool of processes.
+Partial results of every worker are merged with the parallel algorithm of Chan et al. [1].
 Note: it should be used only on the training dataset.
+
+The stats are written as json. mean and std are in [0, 1] scale, as expected by
+the Normalize transform of the data loaders (see `stats_path` in data_loaders.py).
+
+Example usage:
+```
+python calculate_stats.py --img_dir /mnt/.../landsat/min_pct --years 2013 2014 2015 --out landsat_stats.json
+python calculate_stats.py --store_dir /mnt/.../store --product ld --years 2013 2014 2015
+```
+[1] https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
 """
 import os
-import glob
+import json
+import argparse
+import multiprocessing
 import numpy as np
 import cv2
-import torch
-import torchvision
-import pickle as pkl
-from torch.utils.data import DataLoader, Dataset
-from torchvision import datasets, transforms
+from tile_store import TileStore
 
 
 def open_image(img_path):
     """
-    Open image as ndarray
+    Open image as uint8 ndarray (height, width, channels), RGB.
     """
     filetype = img_path[-3:]
     assert filetype in ['png', 'npy']
     if filetype == 'npy':
-        try:
-            img_arr = np.load(img_path)
-            if len(img_arr.shape) == 3: # RGB
-                # if RGB, it expects a (3, height, width)
-                # transpose it to (height, width, 3)
-                img_arr = img_arr.transpose([1,2,0])
-                return img_arr / 255.
-            elif len(img_arr.shape) == 2: # mask
-                # change to binary mask
-                nonzero = np.where(img_arr!=0)
-                img_arr[nonzero] = 1
-                return img_arr
-        except:
-            print('ERROR', img_path)
-            return None
-        # return img_arr / 255.
-    else:
-        # For images transforms.ToTensor() does range to (0.,1.)
-        img_arr = cv2.imread(img_path)
-        try:
-            img_arr = cv2.cvtColor(img_arr, cv2.COLOR_BGR2RGB)
-        except:
-            print(img_path)
-        return cv2.cvtColor(img_arr, cv2.COLOR_BGR2RGB)
+        img_arr = np.load(img_path)
+        if img_arr.ndim == 3 and img_arr.shape[0] == 3: # (3, height, width)
+            img_arr = img_arr.transpose([1, 2, 0])
+        if img_arr.dtype != np.uint8:
+            img_arr = np.clip(np.rint(img_arr), 0, 255).astype(np.uint8)
+        return img_arr
+    img_arr = cv2.imread(img_path)
+    if img_arr is None:
+        print('ERROR', img_path)
+        return None
+    return cv2.cvtColor(img_arr, cv2.COLOR_BGR2RGB)
 
 
-def online_mean_and_std(loader):
+class ChannelStats:
     """
-        Compute the mean and sd in an online fashion [1].
-        Var[x] = E[X^2] - E^2[X]
-        [1] https://discuss.pytorch.org/t/about-normalization-using-pre-trained-vgg16-networks/23560/9
+    Running per-channel statistics of uint8 images: count, mean, sum of squared
+    differences (M2), min, max and 256-bin histograms.
     """
-    cnt = 0
-    fst_moment = torch.empty(3, dtype=torch.double)
-    snd_moment = torch.empty(3, dtype=torch.double)
-    i = 0
-    for data in loader:
-        b, c, h, w = data.shape
-        nb_pixels = b * h * w
-        sum_ = torch.sum(data, dim=[0, 2, 3]).double()
-        sum_of_square = torch.sum(data ** 2, dim=[0, 2, 3]).double()
-        fst_moment = (cnt * fst_moment + sum_) / (cnt + nb_pixels)
-        snd_moment = (cnt * snd_moment + sum_of_square) / (cnt + nb_pixels)
-        cnt += nb_pixels
-        if i % 5000 == 0:
-            print(i)
-        i = i + 1
-
-    return fst_moment, torch.sqrt(snd_moment - fst_moment ** 2)
-
-
-class MyDataset(Dataset):
+    def __init__(self, num_channels=3):
+        self.count = 0
+        self.mean = np.zeros(num_channels)
+        self.m2 = np.zeros(num_channels)
+        self.min = np.full(num_channels, 255, dtype=np.int64)
+        self.max = np.zeros(num_channels, dtype=np.int64)
+        self.hist = np.zeros((num_channels, 256), dtype=np.int64)
+
+    def update(self, img):
+        """
+        Add an image (height, width, channels) uint8.
+        """
+        pixels = img.reshape(-1, img.shape[-1])
+        batch = ChannelStats(pixels.shape[1])
+        batch.count = pixels.shape[0]
+        batch.mean = pixels.mean(axis=0, dtype=np.float64)
+        batch.m2 = ((pixels - batch.mean) ** 2).sum(axis=0)
+        batch.min = pixels.min(axis=0).astype(np.int64)
+        batch.max = pixels.max(axis=0).astype(np.int64)
+        for c in range(pixels.shape[1]):
+            batch.hist[c] = np.bincount(pixels[:, c], minlength=256)
+        self.merge(batch)
+
+    def merge(self, other):
+        """
+        Merge the stats of another ChannelStats (Chan et al.).
+        """
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.hist += other.hist
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def as_dict(self, scale=255.):
+        return {
+            'count': self.count,
+            'mean': (self.mean / scale).tolist(),
+            'std': (self.std / scale).tolist(),
+            'min': self.min.tolist(),
+            'max': self.max.tolist(),
+            'hist': self.hist.tolist()
+        }
+
+
+def _file_shard_stats(img_paths):
+    stats = ChannelStats()
+    for img_path in img_paths:
+        img = open_image(img_path)
+        if img is not None and img.ndim == 3:
+            stats.update(img)
+    return stats
+
+
+def _store_shard_stats(args):
+    store_dir, product, keys = args
+    store = TileStore(store_dir)
+    stats = ChannelStats()
+    for year, z, x, y in keys:
+        stats.update(store.read(product, year, z, x, y, copy=False))
+    return stats
+
+
+def parallel_stats(shard_fn, shards, num_workers=None):
     """
-    Custom dataset to calculate the mean and standard deviation of a dataset
+    Compute the stats of every shard with a pool of processes and merge them.
     """
-    def __init__(self, img_paths):
-        """Initizalize dataset.
-            Params:
-                img_paths: list of image files of the dataset.
-        """
-        self.dataset = img_paths
-        self.dataset_size = len(self.dataset)
-        print('Loaded {} files'.format(self.dataset_size))
-        self.transforms = transforms.Compose([
-            transforms.ToTensor(),
-        ])
-
-    def __len__(self):
-        # print('Planet Dataset len called')
-        return self.dataset_size
-
-    def __getitem__(self, index):
-        r"""Returns data point and its binary mask"""
-        img = open_image(self.dataset[index])
-        img = self.transforms(img)
-        # print(img)
-        return img
+    stats = ChannelStats()
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        for i, shard_stats in enumerate(pool.imap_unordered(shard_fn, shards)):
+            stats.merge(shard_stats)
+            if i % 100 == 0:
+                print('{}/{} shards'.format(i, len(shards)))
+    return stats
+
+
+def chunks(l, n):
+    """
+    Yield successive n-sized chunks from l.
+    """
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+
+def write_stats(stats, out_path):
+    with open(out_path, 'w') as f:
+        json.dump(stats.as_dict(), f)
+    print('Saved stats to', out_path)
+
 
 def main():
-    img_paths = []
-    label_dir = '/mnt/ds3lab-scratch/lming/data/min_quality11/landsat/min_pct'
-    years = ['2013', '2014', '2015']
-    for year in years:
-        imgs = glob.glob(os.path.join(label_dir, year, '*'))
-        img_paths.extend(imgs)
-
-    dataset = MyDataset(img_paths)
-    loader = DataLoader(
-        dataset,
-        batch_size=1,
-        num_workers=1,
-        shuffle=False
-    )
-
-    mean, std = online_mean_and_std(loader)
-    stats = {
-        'mean': mean,
-        'std': std
-    }
-    with open('landsat_stats.pkl', 'wb') as pkl_file:
-        pkl.dump(stats, pkl_file)
+    args = argparse.ArgumentParser(description='Compute per-channel stats of a dataset')
+    args.add_argument('--img_dir', default='/mnt/ds3lab-scratch/lming/data/min_quality11/landsat/min_pct',
+                      type=str, help='directory with one subdirectory per year')
+    args.add_argument('--store_dir', default=None, type=str,
+                      help='root of a tile store, used instead of img_dir')
+    args.add_argument('--product', default='ld', type=str, help='tile store product')
+    args.add_argument('--years', nargs='+', default=['2013', '2014', '2015'], type=str)
+    args.add_argument('--out', default=None, type=str,
+                      help='output json (default: landsat_stats.json, or stats.json next to the store product)')
+    args.add_argument('--num_workers', default=None, type=int)
+    args.add_argument('--shard_size', default=256, type=int, help='tiles per task')
+    args = args.parse_args()
+
+    if args.store_dir is not None:
+        store = TileStore(args.store_dir)
+        keys = [(year, z, x, y) for year in args.years for z, x, y in store.keys(args.product, year)]
+        shards = [(args.store_dir, args.product, shard) for shard in chunks(keys, args.shard_size)]
+        print('Loaded {} tiles'.format(len(keys)))
+        stats = parallel_stats(_store_shard_stats, shards, args.num_workers)
+        out = args.out or os.path.join(args.store_dir, args.product, 'stats.json')
+    else:
+        img_paths = []
+        for year in args.years:
+            year_dir = os.path.join(args.img_dir, year)
+            img_paths.extend(os.path.join(year_dir, name) for name in sorted(os.listdir(year_dir)))
+        print('Loaded {} files'.format(len(img_paths)))
+        stats = parallel_stats(_file_shard_stats, list(chunks(img_paths, args.shard_size)),
+                               args.num_workers)
+        out = args.out or 'landsat_stats.json'
+    write_stats(stats, out)
+    print(stats.as_dict(scale=255.)['mean'], stats.as_dict(scale=255.)['std'])
 
 if __name__ == '__main__':
     main()
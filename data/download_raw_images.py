@@ -4,10 +4,15 @@ hansen (labels).
 """
 import os
 import sys
-import multiprocessing
 import glob
+import time
+import threading
+import tempfile
 import requests
 import logging
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 from utils import create_dir
 from itertools import product
 
@@ -104,6 +109,183 @@ def download_tile(tile, out_dir):
             if not os.path.exists(planet_path2):
                 download_file(planet_url2, planet_path2)
 
+def local_url_templates(base_url):
+    """
+    Rewrite LANDSAT_URLS and PLANET_URL to be served from base_url, keeping the
+    same paths. Used to run the downloader against a local HTTP server.
+    Params:
+        base_url: e.g. 'http://127.0.0.1:8000'
+    Returns (landsat_urls, planet_url)
+    """
+    def rebase(url):
+        parts = urlsplit(url)
+        rebased = base_url.rstrip('/') + parts.path
+        return rebased + '?' + parts.query if parts.query else rebased
+    landsat_urls = {year: rebase(url) for year, url in LANDSAT_URLS.items()}
+    return landsat_urls, rebase(PLANET_URL)
+
+def tile_items(tile, out_dir, landsat_urls=LANDSAT_URLS, planet_url=PLANET_URL):
+    """
+    List the raw images of a tile as in download_tile.
+    Params:
+        tile: tuple composed of (year, zoom, x, y)
+        out_dir: output directory to store the images
+    Returns a list of (key, url, path), with key = (year, z, x, y, source).
+    The landsat years without a mosaic in landsat_urls (e.g. 2018) are skipped.
+    """
+    planet_name = 'pl{year}_{q}_{z}_{x}_{y}.png'
+    landsat_name = 'ld{year}_{z}_{x}_{y}.png'
+    quarters = ['q1', 'q2', 'q3', 'q4']
+    year, z, x, y = tile
+    year = int(year)
+    items = []
+    landsat_years = [year] if year == 2013 else [year-1, year]
+    for ly in [ly for ly in landsat_years if str(ly) in landsat_urls]:
+        items.append(((str(ly), str(z), str(x), str(y), 'landsat'),
+                      landsat_urls[str(ly)].format(z=z, x=x, y=y),
+                      os.path.join(out_dir, 'landsat', str(ly), landsat_name.format(year=ly, z=z, x=x, y=y))))
+    if year in [2017, 2018]:
+        for py in [year-1, year]:
+            for q in quarters:
+                items.append(((str(py), str(z), str(x), str(y), 'planet_' + q),
+                              planet_url.format(year=py, q=q, z=z, x=x, y=y),
+                              os.path.join(out_dir, 'planet', str(py), planet_name.format(year=py, q=q, z=z, x=x, y=y))))
+    return items
+
+class DownloadManifest:
+    """
+    Append-only record of the downloaded items. One line per item:
+    year z x y source
+    Used to resume a download without checking every file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    key = tuple(line.split())
+                    if len(key) == 5:
+                        self.done.add(key)
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, key):
+        with self._lock:
+            self.done.add(key)
+            self._file.write(' '.join(key) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def create_session(pool_size, hosts=1):
+    """
+    Create a requests Session that keeps pool_size keep-alive connections
+    open per host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_file(session, url, path, retries=3, backoff=0.5, timeout=30):
+    """
+    Download url into path atomically (temporary file + rename), retrying
+    with exponential backoff on connection errors, 429 and 5xx responses.
+    Returns True if the file was downloaded.
+    """
+    for attempt in range(retries + 1):
+        tmp_path = None
+        try:
+            with session.get(url, stream=True, timeout=timeout) as r:
+                if r.status_code == 429 or r.status_code >= 500:
+                    raise requests.HTTPError('{} {}'.format(r.status_code, url))
+                if r.status_code != 200:
+                    logger.debug('FAIL {} {} {}'.format(r.status_code, url, path))
+                    return False
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=65536):
+                        if chunk: # filter out keep-alive new chunks
+                            f.write(chunk)
+            os.replace(tmp_path, path)
+            logger.debug('SUCCESS {} {}'.format(url, path))
+            return True
+        except (requests.RequestException, OSError) as e:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if attempt == retries:
+                logger.debug('FAIL {} {} {}'.format(e, url, path))
+                return False
+            time.sleep(backoff * 2 ** attempt)
+
+def download_tiles(tiles, out_dir, concurrency=32, retries=3, backoff=0.5,
+                   manifest_path=None, landsat_urls=LANDSAT_URLS,
+                   planet_url=PLANET_URL, max_in_flight=None, log_every=1000):
+    """
+    Download the raw images of all the tiles with a pool of threads sharing
+    keep-alive connections. Items recorded in the manifest are skipped.
+    Params:
+        tiles: list of (year, zoom, x, y)
+        out_dir: output directory to store the images
+        concurrency: number of concurrent requests
+        manifest_path: path of the manifest (default: out_dir/manifest.txt)
+        max_in_flight: maximum number of items submitted and not finished yet
+            (default: 4 * concurrency)
+    Returns (number of downloaded items, number of failed items)
+    """
+    manifest = DownloadManifest(manifest_path or os.path.join(out_dir, 'manifest.txt'))
+    max_in_flight = max_in_flight or 4 * concurrency
+    # consecutive years of the same tile share images, e.g. ld2016 for 2016 and 2017:
+    # keep one item per key, hence per path
+    items = {}
+    for tile in tiles:
+        for key, url, path in tile_items(tile, out_dir, landsat_urls, planet_url):
+            if key not in manifest:
+                items.setdefault(key, (key, url, path))
+    items = list(items.values())
+    for folder in set(os.path.dirname(path) for _, _, path in items):
+        create_dir(folder)
+    hosts = len(set(urlsplit(url).netloc for _, url, _ in items)) or 1
+    session = create_session(concurrency, hosts)
+    logger.info('Downloading {} items, {} already done'.format(len(items), len(manifest)))
+
+    start = time.time()
+    downloaded, failed = 0, 0
+    pending = {}
+    items_iter = iter(items)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            for key, url, path in items_iter:
+                pending[executor.submit(fetch_file, session, url, path, retries, backoff)] = key
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                key = pending.pop(future)
+                if future.result():
+                    manifest.add(key)
+                    downloaded += 1
+                else:
+                    failed += 1
+                i = downloaded + failed
+                if i % log_every == 0:
+                    logger.info('{}/{} items, {:.1f} items/s'.format(
+                        i, len(items), i / max(time.time() - start, 1e-6)))
+    session.close()
+    manifest.close()
+    return downloaded, failed
+
 def add_in_dict(dic, key):
     """
     Add key in dict if it doesn't exist
@@ -136,9 +318,9 @@ def main():
     for year in ['2013', '2014', '2015', '2016', '2017']:
         create_dir(os.path.join(out_dir, year))
 
-    for chunk in chunks(tiles, 16):
-        with multiprocessing.Pool(processes=16) as pool:
-            results = pool.starmap(download_tile, create_tuple(chunk, out_dir))
+    tiles = get_tiles()
+    downloaded, failed = download_tiles(tiles, out_dir, concurrency=32)
+    logger.info('Downloaded {} items, {} failed'.format(downloaded, failed))
 
 if __name__ == '__main__':
     main()
@@ -12,10 +12,13 @@ import argparse
 import matplotlib.pyplot as plt
 import pickle as pkl
 import logging
-from utils import deg2num, num2deg, geodesic2spherical, create_dir
+import time
+from utils import geodesic2spherical, create_dir
+from utils import num2deg_array, geodesic2spherical_array, bbox2tiles_array, tiles2array
+from hansen_labels import synthesize_labels
 from rasterio.merge import merge
 from rasterio.windows import Window
-from multiprocessing import Process
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 # from time import sleep
 
 logger = logging.getLogger('gee')
@@ -25,6 +28,8 @@ fh = logging.FileHandler('gee.log')
 fh.setLevel(logging.DEBUG)
 logger.addHandler(fh)
 
+TILE_SIZE = 256
+
 
 def add_in_dict(dic, key):
     """
@@ -53,16 +58,10 @@ def check_quality_label(img, threshold = 0.01):
 
 def bbox2tiles(bbox, zoom):
     """
-    Return the tile coordinates that forms a bounding box.
+    Return the tile coordinates that forms a bounding box, as an (N, 3) int
+    array of (z, x, y) rows.
     """
-    upper_left_tile = deg2num(bbox['upper_left'][0], bbox['upper_left'][1], zoom)
-    lower_right_tile = deg2num(bbox['lower_right'][0], bbox['lower_right'][1], zoom)
-    tile_coords = []
-    for i in range(upper_left_tile[0], lower_right_tile[0]+1):
-        for j in range(upper_left_tile[1], lower_right_tile[1]+1):
-            tile_coords.append((zoom, i,j))
-
-    return tile_coords
+    return bbox2tiles_array(bbox, zoom)
 
 def extract_tile(mosaicdb, lon, lat, tile_size, crs):
     """
@@ -82,6 +81,79 @@ def extract_tile(mosaicdb, lon, lat, tile_size, crs):
     idx, idy = mosaicdb.index(xgeo, ygeo)
     return mosaicdb.read(window=Window(idy, idx, 256, 256))
 
+def tile_pixel_offsets(mosaicdb, tiles):
+    """
+    Get the raster (row, col) of the upper left pixel of every tile.
+    Params:
+        mosaicdb: Rasterio DataReader
+        tiles: list of (z, x, y) tile coordinates
+    Returns an (N, 2) int64 array.
+    """
+    tiles = tiles2array(tiles)
+    lons, lats = num2deg_array(tiles[:, 1], tiles[:, 2], tiles[:, 0])
+    xgeo, ygeo = geodesic2spherical_array(lons, lats)
+    cols, rows = ~mosaicdb.transform * (xgeo, ygeo)
+    return np.stack([np.floor(rows), np.floor(cols)], axis=1).astype(np.int64)
+
+def group_tiles(mosaicdb, tiles, offsets, window_tiles=16, tile_size=TILE_SIZE):
+    """
+    Sort tiles by raster row/col and group them into superwindows that cover
+    at most window_tiles x window_tiles tiles. The windows start on a raster
+    block boundary so that every block is read once.
+    Params:
+        mosaicdb: Rasterio DataReader
+        tiles: list of (z, x, y) tile coordinates
+        offsets: list of (row, col) raster offsets, as in tile_pixel_offsets
+        window_tiles: number of tiles per side of a superwindow
+    Returns a list of (Window, [(tile, row, col), ...]) in raster order.
+    """
+    span = window_tiles * tile_size
+    groups = {}
+    for tile, (row, col) in zip(tiles, offsets):
+        groups.setdefault((row // span, col // span), []).append((tile, row, col))
+
+    block_h, block_w = mosaicdb.block_shapes[0]
+    windows = []
+    for key in sorted(groups):
+        members = sorted(groups[key], key=lambda m: (m[1], m[2]))
+        row0 = min(m[1] for m in members) // block_h * block_h
+        col0 = min(m[2] for m in members) // block_w * block_w
+        row1 = max(m[1] for m in members) + tile_size
+        col1 = max(m[2] for m in members) + tile_size
+        # Clip the superwindow to the raster extent
+        row0, col0 = max(row0, 0), max(col0, 0)
+        row1, col1 = min(row1, mosaicdb.height), min(col1, mosaicdb.width)
+        if row1 <= row0 or col1 <= col0:
+            logger.debug('Tiles outside of the raster: {}'.format([m[0] for m in members]))
+            continue
+        windows.append((Window(col0, row0, col1 - col0, row1 - row0), members))
+    return windows
+
+def slice_tile(block, window, row, col, tile_size=TILE_SIZE):
+    """
+    Slice the tile with upper left pixel (row, col) out of a superwindow read.
+    """
+    r = max(row - window.row_off, 0)
+    c = max(col - window.col_off, 0)
+    return block[:, r:row - window.row_off + tile_size,
+                 c:col - window.col_off + tile_size]
+
+def iter_tile_arrays(mosaicdb, tiles, window_tiles=16, tile_size=TILE_SIZE):
+    """
+    Yield (tile, img_arr) for every tile, reading each superwindow of the
+    raster once and slicing the tiles out of it in memory.
+    Params:
+        mosaicdb: Rasterio DataReader
+        tiles: list of (z, x, y) tile coordinates
+        window_tiles: number of tiles per side of a superwindow
+    """
+    offsets = tile_pixel_offsets(mosaicdb, tiles)
+    for window, members in group_tiles(mosaicdb, tiles, offsets,
+                                       window_tiles, tile_size):
+        block = mosaicdb.read(window=window)
+        for tile, row, col in members:
+            yield tile, slice_tile(block, window, row, col, tile_size)
+
 def preprocess_fc(img_arr, threshold=0.25):
     """
     Threshold percentage values to be binary with a 0.25 threshold.
@@ -117,6 +189,7 @@ def create_forest_cover(fc2000, gain2000_2012, loss2000_2012, loss2013_year):
 def get_aggregated_loss(img_arr, beg=1, end=12):
     """
     Gets the forest total loss from 2001 to 2012.
+    Note: kept as the reference implementation, see hansen_labels.synthesize_labels.
     """
     loss_arr = np.zeros(img_arr.shape)
     for i in range(beg, end+1): # +1 because range is exclusive
@@ -124,26 +197,16 @@ def get_aggregated_loss(img_arr, beg=1, end=12):
         loss_arr[mask] = 1
     return loss_arr
 
-def save_fc(img_arr, out_name, year):
+def save_fc(img_arr, out_name, year, fc_arr=None):
     """
     img_arr: hansen db
     out_name: full path of the forest loss name
     year: to extract
+    fc_arr: forest cover of year, if it was already computed with synthesize_labels
     """
-    FC_IDX = 0 # forest cover index
     gee_dir = '/mnt/ds3lab-scratch/lming/gee_data/images_forma_compare'
-    GAIN_IDX = 1 # forest gain index
-    LOSS_IDX = 2 # forest loss index
-    # loss_arr = extract_tile(img_db[LOSS_IDX], lon, lat, 256, crs='ESPG:4326')
-    loss_arr = np.copy(img_arr[LOSS_IDX])
-    loss2000_2012 = get_aggregated_loss(loss_arr, beg=1, end=12) # 0 is no loss in this band, get loss from [1,12]
-    # gain2000_2012 = extract_tile(img_db[GAIN_IDX])
-    gain2000_2012 = np.copy(img_arr[GAIN_IDX])
-    loss2013_year = get_aggregated_loss(loss_arr, beg=13, end=year)
-    # fc2000 = extract_tile(img_db[FC_IDX], lon, lat, 256, crs='ESPG:4326')
-    fc2000 = np.copy(img_arr[FC_IDX])
-    fc2000 = preprocess_fc(fc2000)
-    img_arr = create_forest_cover(fc2000, gain2000_2012, loss2000_2012, loss2013_year)
+    if fc_arr is None:
+        fc_arr = synthesize_labels(img_arr, [year])[0][0]
 
     forest_cover_dir = os.path.join(gee_dir, 'forest_coverv2', '20' + str(year))
     create_dir(forest_cover_dir)
@@ -151,59 +214,164 @@ def save_fc(img_arr, out_name, year):
     fl_name = out_name.split('/')[-1]
     fc_name = 'fc' + '20' + str(year) + '_' + '_'.join(fl_name.split('_')[1:])
     fc_name = os.path.join(forest_cover_dir, fc_name)
-    np.save(fc_name, img_arr)
+    np.save(fc_name, fc_arr)
 
 def gen_tile(img_db, lon, lat, year, out_name):
     """
     year: int, from 1 to 18
     """
-    # 'treecover2000', 'gain', 'lossyear', 'lossyear2000_2012')
-    FC_IDX = 0 # forest cover index
-    GAIN_IDX = 1 # forest gain index
-    LOSS_IDX = 2 # forest loss index
     img_arr = extract_tile(img_db, lon, lat, 256, crs='ESPG:4326')
+    write_fl_tile(img_arr, year, out_name)
+
+def write_fl_tile(img_arr, year, out_name):
+    """
+    Save the forest loss (and forest cover) labels of an already extracted tile.
+    Params:
+        img_arr: ndarray (bands, height, width) from the hansen db
+        year: int, from 1 to 18
+        out_name: full path of the forest loss name
+    """
     if img_arr.size == 0:
         print('WARNING:', out_name)
-    img_arr = np.copy(img_arr[LOSS_IDX])
-    loss_mask = np.where(img_arr == year)
-    no_loss_mask = np.where(img_arr != year)
-    img_arr[loss_mask] = 1
-    img_arr[no_loss_mask] = 0
-    if check_quality_label(img_arr):
-        np.save(out_name, img_arr)
-        save_fc(img_arr, out_name, year)
+    fc_arr, fl_arr = synthesize_labels(img_arr, [year])
+    if check_quality_label(fl_arr[0]):
+        np.save(out_name, fl_arr[0])
+        save_fc(img_arr, out_name, year, fc_arr=fc_arr[0])
 
 def extract_fc_and_fl_tile(img_db, lon, lat, year, out_name):
     """
     year: int, from 1 to 18
     """
-    # 'treecover2000', 'gain', 'lossyear', 'lossyear2000_2012')
-    FC_IDX = 0 # forest cover index
-    GAIN_IDX = 1 # forest gain index
-    LOSS_IDX = 2 # forest loss index
     img_arr = extract_tile(img_db, lon, lat, 256, crs='ESPG:4326')
+    write_fc_and_fl_tile(img_arr, year, out_name)
+
+def write_fc_and_fl_tile(img_arr, year, out_name):
+    """
+    Save the forest loss label of an already extracted tile.
+    Params:
+        img_arr: ndarray (bands, height, width) from the hansen db
+        year: int, from 1 to 18
+        out_name: full path of the forest loss name
+    """
     if img_arr.size == 0:
         print('WARNING:', out_name)
-    img_arr_loss = np.copy(img_arr[LOSS_IDX])
-    loss_mask = np.where(img_arr_loss == year)
-    no_loss_mask = np.where(img_arr_loss != year)
-    img_arr_loss[loss_mask] = 1
-    img_arr_loss[no_loss_mask] = 0
-    print(img_arr_loss.shape)
-    np.save(out_name, img_arr_loss)
+    _, fl_arr = synthesize_labels(img_arr, [year])
+    np.save(out_name, fl_arr[0])
     # save_fc(img_arr, out_name, year)
 
-def extract_tiles(tiles, year, hansen_db, forest_loss_dir):
-    out_fl = os.path.join(forest_loss_dir, year)
-    create_dir(out_fl)
-    fl_template = 'fl{year}_{z}_{x}_{y}.npy'
-    # for z,x,y in [(12, 1260, 2185)]:
-    for z, x, y in tiles:
-        lon, lat = num2deg(int(x), int(y), int(z))
-        int_year = int(year[2:])
-        # gen_tile(landsat_db, lon, lat, 'ld', int_year, os.path.join(out_landsat, landsat_template.format(year=year, z=z, x=x, y=y)))
-        # gen_tile(hansen_db, lon, lat, 'fc', int_year, os.path.join(out_fc, fc_template.format(year=year, z=z, x=x, y=y)))
-        gen_tile(hansen_db, lon, lat, int_year, os.path.join(out_fl, fl_template.format(year=year, z=z, x=x, y=y)))
+def extract_tiles(tiles, year, hansen_db, forest_loss_dir, window_tiles=16,
+                  num_workers=1, max_in_flight=None):
+    """
+    Save the forest loss and forest cover labels of the tiles of a year.
+    Params:
+        hansen_db: Rasterio DataReader or path of the hansen .vrt. The pool
+            mode (num_workers > 1) opens the path again in every worker.
+    """
+    run_extraction(tiles, [year], hansen_db, forest_loss_dir, write_fl_tile,
+                   window_tiles, num_workers, max_in_flight)
+
+FL_TEMPLATE = 'fl{year}_{z}_{x}_{y}.npy'
+
+# Dataset handle of the pool workers. Every worker opens its own handle, GDAL
+# handles must not be shared across a fork.
+_worker_db = None
+
+def _init_extraction_worker(vrt_path):
+    global _worker_db
+    _worker_db = rasterio.open(vrt_path)
+
+def _extract_window(window, members, years, forest_loss_dir, writer, tile_size):
+    """
+    Read one superwindow and write the labels of all its tiles for every year.
+    Returns the number of tiles processed.
+    """
+    block = _worker_db.read(window=window)
+    for (z, x, y), row, col in members:
+        img_arr = slice_tile(block, window, row, col, tile_size)
+        for year in years:
+            out_name = os.path.join(forest_loss_dir, year,
+                                    FL_TEMPLATE.format(year=year, z=z, x=x, y=y))
+            writer(img_arr, int(year[2:]), out_name)
+    return len(members)
+
+def extract_tiles_pool(tiles, years, vrt_path, forest_loss_dir,
+                       writer=write_fl_tile, num_workers=None,
+                       max_in_flight=None, window_tiles=16,
+                       tile_size=TILE_SIZE, log_every=50):
+    """
+    Shard the tile list into superwindows and extract them with a pool of
+    processes. Each superwindow is read once and written for all the years.
+    Params:
+        tiles: list of (z, x, y) tile coordinates
+        years: list of years, e.g. ['2016', '2017']
+        vrt_path: path of the hansen .vrt
+        forest_loss_dir: output directory, with one subdirectory per year
+        writer: function(img_arr, int_year, out_name), e.g. write_fl_tile or
+            write_fc_and_fl_tile
+        num_workers: number of processes (default: number of cpus)
+        max_in_flight: maximum number of superwindows submitted and not
+            finished yet. It bounds the memory used by the reads.
+    """
+    num_workers = num_workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * num_workers
+    for year in years:
+        create_dir(os.path.join(forest_loss_dir, year))
+
+    # Plan the reads in the parent, and close the handle before forking
+    with rasterio.open(vrt_path) as mosaicdb:
+        offsets = tile_pixel_offsets(mosaicdb, tiles)
+        windows = group_tiles(mosaicdb, tiles, offsets, window_tiles, tile_size)
+    n_tiles = sum(len(members) for _, members in windows)
+    logger.info('Extracting {} tiles in {} windows with {} workers'.format(
+        n_tiles, len(windows), num_workers))
+
+    start = time.time()
+    done_tiles, done_windows = 0, 0
+    pending = set()
+    windows = iter(windows)
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             initializer=_init_extraction_worker,
+                             initargs=(vrt_path,)) as executor:
+        while True:
+            for window, members in windows:
+                pending.add(executor.submit(_extract_window, window, members,
+                                            years, forest_loss_dir, writer,
+                                            tile_size))
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done_tiles += future.result()
+                done_windows += 1
+                if done_windows % log_every == 0 or done_tiles == n_tiles:
+                    elapsed = time.time() - start
+                    logger.info('{}/{} tiles, {:.1f} tiles/s'.format(
+                        done_tiles, n_tiles, done_tiles / max(elapsed, 1e-6)))
+    return done_tiles
+
+def run_extraction(tiles, years, hansen_db, forest_loss_dir, writer,
+                   window_tiles=16, num_workers=1, max_in_flight=None):
+    """
+    Extract tiles with writer either in this process or with a pool of workers.
+    Params:
+        hansen_db: Rasterio DataReader or path of the hansen .vrt
+    """
+    vrt_path = hansen_db if isinstance(hansen_db, str) else hansen_db.name
+    if num_workers > 1:
+        return extract_tiles_pool(tiles, years, vrt_path, forest_loss_dir,
+                                  writer, num_workers, max_in_flight,
+                                  window_tiles)
+    if isinstance(hansen_db, str):
+        hansen_db = rasterio.open(hansen_db)
+    for year in years:
+        create_dir(os.path.join(forest_loss_dir, year))
+    for (z, x, y), img_arr in iter_tile_arrays(hansen_db, tiles, window_tiles):
+        for year in years:
+            out_name = os.path.join(forest_loss_dir, year,
+                                    FL_TEMPLATE.format(year=year, z=z, x=x, y=y))
+            writer(img_arr, int(year[2:]), out_name)
 
 
 ###
@@ -223,30 +391,16 @@ def get_tiles(path='/mnt/ds3lab-scratch/lming/gee_data/z11/forest_lossv2'):
             add_in_dict(tiles, key)
     return list(tiles.keys())
 
-def extract_video_tiles(tiles, year, hansen_db, forest_loss_dir):
-    out_fl = os.path.join(forest_loss_dir, year)
-    create_dir(out_fl)
-    fl_template = 'fl{year}_{z}_{x}_{y}.npy'
-    # for z,x,y in [(12, 1260, 2185)]:
-    for z, x, y in tiles:
-        lon, lat = num2deg(int(x), int(y), int(z))
-        int_year = int(year[2:])
-        extract_fc_and_fl_tile(hansen_db, lon, lat, int_year, os.path.join(out_fl, fl_template.format(year=year, z=z, x=x, y=y)))
-
-def extract_forma_tiles(tiles, year, hansen_db, forest_loss_dir):
+def extract_video_tiles(tiles, year, hansen_db, forest_loss_dir, window_tiles=16,
+                        num_workers=1, max_in_flight=None):
+    run_extraction(tiles, [year], hansen_db, forest_loss_dir,
+                   write_fc_and_fl_tile, window_tiles, num_workers, max_in_flight)
+
+def extract_forma_tiles(tiles, year, hansen_db, forest_loss_dir, window_tiles=16,
+                        num_workers=1, max_in_flight=None):
     # TODO: CHANGE SAVE_FC SAVING MODE!!!!!!!
-    out_fl = os.path.join(forest_loss_dir, year)
-    create_dir(out_fl)
-    fl_template = 'fl{year}_{z}_{x}_{y}.npy'
-    for z, x, y in tiles:
-        out_name = os.path.join(out_fl, fl_template.format(year=year, z=z, x=x, y=y))
-        lon, lat = num2deg(int(x), int(y), int(z))
-        int_year = int(year[2:])
-        # img_arr = extract_tile(hansen_db, lon, lat, 256, crs='ESPG:4326')
-        # np.save(os.path.join(forest_loss_dir, fl_template.format(year=year, z=z, x=x, y=y)), img_arr)
-        # save_fc(img_arr, out_name, int_year)
-
-        extract_fc_and_fl_tile(hansen_db, lon, lat, int_year, os.path.join(out_fl, fl_template.format(year=year, z=z, x=x, y=y)))
+    run_extraction(tiles, [year], hansen_db, forest_loss_dir,
+                   write_fc_and_fl_tile, window_tiles, num_workers, max_in_flight)
 
 def main():
     gee_dir = '/mnt/ds3lab-scratch/lming/gee_data/images_forma_compare'
@@ -277,18 +431,12 @@ def main():
         create_dir(os.path.join(forest_loss_dir, year))
         # create_dir(os.path.join(landsat_dir, year))
         # landsat_dbs[year] = rasterio.open(os.path.join(landsat_db_dir, 'landsat' + year + '.vrt'))
-    hansen_db = rasterio.open('/mnt/ds3lab-scratch/lming/gee_data/hansen11.vrt')
+    hansen_path = '/mnt/ds3lab-scratch/lming/gee_data/hansen11.vrt'
 
-    processes = []
-    for year in years:
-        # p = Process(target=extract_tiles, args=(tiles, year, hansen_db,
-        #         forest_loss_dir,))
-        # p = Process(target=extract_video_tiles, args=(tiles, year, hansen_db, forest_loss_dir))
-        p = Process(target=extract_forma_tiles, args=(tiles, year, hansen_db, forest_loss_dir))
-        processes.append(p)
-        p.start()
-    for p in processes:
-        p.join()
+    # One pool for all the years, every worker opens its own hansen handle
+    # extract_tiles_pool(tiles, years, hansen_path, forest_loss_dir, write_fl_tile)
+    extract_tiles_pool(tiles, years, hansen_path, forest_loss_dir,
+                       write_fc_and_fl_tile, num_workers=os.cpu_count())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,174 @@
+"""
+This module synthesizes the forest cover and forest loss labels from the
+Hansen bands ('treecover2000', 'gain', 'lossyear') in a single pass.
+It replaces the get_aggregated_loss / create_forest_cover path of gee_tiles.py.
+
+Example usage (benchmark against the previous implementation):
+```
+python hansen_labels.py --sizes 256 40000 --years 13 14 15 16 17
+```
+"""
+import time
+import argparse
+import numpy as np
+
+FC_IDX = 0 # forest cover index
+GAIN_IDX = 1 # forest gain index
+LOSS_IDX = 2 # forest loss index
+
+MAX_LOSS_YEAR = 255
+
+def _year_luts(years):
+    """
+    Build the lookup tables from a lossyear value to the labels of every year.
+    Returns:
+        keep_lut: uint8 (len(years), 256). 0 if the pixel was lost between 2013 and year.
+        loss_lut: uint8 (len(years), 256). 1 if the pixel was lost in year.
+        early_lut: bool (256,). True if the pixel was lost between 2001 and 2012.
+    """
+    values = np.arange(MAX_LOSS_YEAR + 1)
+    years = np.asarray(years).reshape(-1, 1)
+    keep_lut = ~((values >= 13) & (values <= years))
+    loss_lut = values == years
+    early_lut = (values >= 1) & (values <= 12)
+    return keep_lut.astype(np.uint8), loss_lut.astype(np.uint8), early_lut
+
+def synthesize_labels(img_arr, years, fc_threshold=0.25, out_fc=None,
+                      out_fl=None, chunk_rows=1024):
+    """
+    Create the forest cover and forest loss masks of every year in years.
+    For gain and loss on the same pixel between 2000-2012, we assume that
+    nothing happened (as in gee_tiles.create_forest_cover).
+    Params:
+        img_arr: ndarray (3, height, width) with the bands
+            'treecover2000', 'gain', 'lossyear'.
+        years: list of int, from 1 to 18
+        fc_threshold: minimum tree cover to be considered forest
+        out_fc: optional uint8 ndarray (len(years), height, width) to write
+            the forest cover into.
+        out_fl: optional uint8 ndarray (len(years), height, width) to write
+            the forest loss into.
+        chunk_rows: number of rows processed at a time. It bounds the size of
+            the temporary masks for big windows.
+    Returns (fc, fl), uint8 ndarrays of shape (len(years), height, width).
+    """
+    years = list(years)
+    _, height, width = img_arr.shape
+    shape = (len(years), height, width)
+    if out_fc is None:
+        out_fc = np.empty(shape, dtype=np.uint8)
+    if out_fl is None:
+        out_fl = np.empty(shape, dtype=np.uint8)
+    assert out_fc.shape == shape and out_fc.dtype == np.uint8
+    assert out_fl.shape == shape and out_fl.dtype == np.uint8
+
+    tc, gain, lossyear = img_arr[FC_IDX], img_arr[GAIN_IDX], img_arr[LOSS_IDX]
+    # Same rule as preprocess_fc: values are percentages only if they reach 100
+    if tc.size and tc.max() == 100:
+        fc_threshold = fc_threshold * 100
+    keep_lut, loss_lut, early_lut = _year_luts(years)
+
+    for r0 in range(0, height, chunk_rows):
+        r1 = min(r0 + chunk_rows, height)
+        ly = lossyear[r0:r1]
+        if ly.dtype != np.uint8:
+            ly = np.clip(ly, 0, MAX_LOSS_YEAR).astype(np.uint8)
+        g = gain[r0:r1]
+        early = early_lut[ly]
+        # forest cover in 2012
+        base = tc[r0:r1] >= fc_threshold
+        base |= (g == 1) & ~early
+        base &= ~(early & (g == 0))
+        # every year at once through the lookup tables
+        np.take(loss_lut, ly, axis=1, out=out_fl[:, r0:r1])
+        np.take(keep_lut, ly, axis=1, out=out_fc[:, r0:r1])
+        out_fc[:, r0:r1] &= base.view(np.uint8)
+    return out_fc, out_fl
+
+def _legacy_labels(img_arr, years):
+    """
+    Labels computed as in gee_tiles.gen_tile and gee_tiles.save_fc.
+    """
+    from gee_tiles import get_aggregated_loss, preprocess_fc, create_forest_cover
+    fcs, fls = [], []
+    for year in years:
+        fl_arr = np.copy(img_arr[LOSS_IDX])
+        loss_mask = np.where(fl_arr == year)
+        no_loss_mask = np.where(fl_arr != year)
+        fl_arr[loss_mask] = 1
+        fl_arr[no_loss_mask] = 0
+        loss_arr = np.copy(img_arr[LOSS_IDX])
+        loss2000_2012 = get_aggregated_loss(loss_arr, beg=1, end=12)
+        gain2000_2012 = np.copy(img_arr[GAIN_IDX])
+        loss2013_year = get_aggregated_loss(loss_arr, beg=13, end=year)
+        fc2000 = preprocess_fc(np.copy(img_arr[FC_IDX]))
+        fcs.append(create_forest_cover(fc2000, gain2000_2012, loss2000_2012, loss2013_year))
+        fls.append(fl_arr)
+    return np.stack(fcs), np.stack(fls)
+
+def random_hansen(height, width=None, seed=0, chunk_rows=1024):
+    """
+    Random hansen-like bands of shape (3, height, width), uint8. They are
+    generated in uint8 strips of chunk_rows rows, without int64/float64
+    temporaries of the whole window.
+    """
+    width = width or height
+    rng = np.random.default_rng(seed)
+    img_arr = np.empty((3, height, width), dtype=np.uint8)
+    for r0 in range(0, height, chunk_rows):
+        r1 = min(r0 + chunk_rows, height)
+        shape = (r1 - r0, width)
+        img_arr[FC_IDX, r0:r1] = rng.integers(0, 101, shape, dtype=np.uint8)
+        img_arr[GAIN_IDX, r0:r1] = rng.integers(0, 20, shape, dtype=np.uint8) == 0 # 5%
+        loss = rng.integers(1, 19, shape, dtype=np.uint8)
+        loss[rng.integers(0, 5, shape, dtype=np.uint8) != 0] = 0 # 20% of loss
+        img_arr[LOSS_IDX, r0:r1] = loss
+    return img_arr
+
+def benchmark(sizes, years, legacy_max_size=8192, repeat=3, strip_rows=2048):
+    """
+    Time synthesize_labels against the legacy path for every tile size.
+    The legacy path allocates float64 masks, so it is skipped above legacy_max_size.
+    Above legacy_max_size the bands and labels of a whole window do not fit in
+    memory (40000x40000 is 4.8 GB of bands and 1.6 GB per label year), so the
+    window is generated and synthesized in strips of strip_rows rows, as
+    gee_tiles reads it, and the kernel time is the sum over the strips.
+    """
+    for size in sizes:
+        if size > legacy_max_size:
+            out_fc = np.empty((len(years), strip_rows, size), dtype=np.uint8)
+            out_fl = np.empty((len(years), strip_rows, size), dtype=np.uint8)
+            total = 0.
+            for r0 in range(0, size, strip_rows):
+                rows = min(strip_rows, size - r0)
+                img_arr = random_hansen(rows, size, seed=r0)
+                start = time.time()
+                synthesize_labels(img_arr, years, out_fc=out_fc[:, :rows], out_fl=out_fl[:, :rows])
+                total += time.time() - start
+            print('{0}x{0}x3 kernel: {1:.4f}s (strips of {2} rows)'.format(size, total, strip_rows))
+            print('{0}x{0}x3 legacy: skipped'.format(size))
+            continue
+        img_arr = random_hansen(size)
+        out_fc = np.empty((len(years), size, size), dtype=np.uint8)
+        out_fl = np.empty((len(years), size, size), dtype=np.uint8)
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.time()
+            synthesize_labels(img_arr, years, out_fc=out_fc, out_fl=out_fl)
+            best = min(best, time.time() - start)
+        print('{0}x{0}x3 kernel: {1:.4f}s'.format(size, best))
+        start = time.time()
+        fc, fl = _legacy_labels(img_arr, years)
+        legacy = time.time() - start
+        assert np.array_equal(fc, out_fc) and np.array_equal(fl, out_fl)
+        print('{0}x{0}x3 legacy: {1:.4f}s ({2:.1f}x)'.format(size, legacy, legacy / best))
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Benchmark hansen label synthesis')
+    args.add_argument('--sizes', nargs='+', type=int, default=[256, 40000])
+    args.add_argument('--years', nargs='+', type=int, default=[13, 14, 15, 16, 17])
+    args.add_argument('--legacy_max_size', type=int, default=8192)
+    args.add_argument('--strip_rows', type=int, default=2048,
+                      help='rows per strip of the sizes above legacy_max_size')
+    args = args.parse_args()
+    benchmark(args.sizes, args.years, args.legacy_max_size, strip_rows=args.strip_rows)
@@ -1,19 +1,29 @@
 """
 This script produces annual mosaics from shorter time-period mosaics.
+Quarterly tiles pl{year}_{q}_{z}_{x}_{y}.png are composited into
+pl{year}_{z}_{x}_{y}.npy (HWC, BGR as read by cv2) with a pool of processes.
+Finished tiles are recorded in a manifest in the output directory, so the
+script can be resumed.
+
+Example usage:
+```
+python preprocess_planet.py --years 2016 2017 2018 --mode mean --num_workers 16
+```
 """
+import os
+import time
+import argparse
+import multiprocessing
 import cv2
 import numpy as np
-import glob
-import os
 from utils import create_dir
 
-PLANETPATH = '/mnt/ds3lab-scratch/lming/gee_data/ldpl/planet' 
-years = ['2016', '2017','2018']
+PLANETPATH = '/mnt/ds3lab-scratch/lming/gee_data/ldpl/planet'
 OUTPATH = '/mnt/ds3lab-scratch/lming/gee_data/ldpl/planet/annual'
-create_dir(OUTPATH)
-
-for year in years:
-    create_dir(os.path.join(OUTPATH, year))
+YEARS = ['2016', '2017', '2018']
+QUARTERS = ['q1', 'q2', 'q3', 'q4']
+MODES = ['mean', 'median', 'cloud']
+MANIFEST = 'manifest.txt'
 
 def annual_mosaic(imgs):
     """
@@ -21,35 +31,123 @@ def annual_mosaic(imgs):
     Params:
         imgs: list of mosaics. Example: [img_q1, img_q2, img_q3, img_q4]
     """
-    n = 0
-    annual = np.zeros(imgs[0].shape)
+    annual = np.zeros(imgs[0].shape, dtype=np.uint16)
     for img in imgs:
         annual += img
-        n += 1
-    return annual / n
+    return annual.astype(np.float32) / len(imgs)
+
+def cloud_mosaic(imgs, cloud_threshold=220):
+    """
+    Average the quarters ignoring cloudy (all channels >= cloud_threshold) and
+    no-data (all channels == 0) pixels. Pixels without any clear quarter
+    fall back to the plain mean.
+    """
+    stack = np.stack(imgs) # (quarters, height, width, channels)
+    clear = (stack.min(axis=-1) < cloud_threshold) & (stack.max(axis=-1) > 0)
+    count = clear.sum(axis=0, dtype=np.uint16)
+    annual = np.zeros(imgs[0].shape, dtype=np.uint16)
+    for img, valid in zip(imgs, clear):
+        annual += img * valid[..., None]
+    annual = annual.astype(np.float32) / np.maximum(count, 1)[..., None]
+    no_clear = count == 0
+    annual[no_clear] = annual_mosaic(imgs)[no_clear]
+    return annual
+
+def composite(imgs, mode='mean', dtype=np.uint8, cloud_threshold=220):
+    """
+    Composite the quarterly mosaics of a tile.
+    Params:
+        imgs: list of uint8 mosaics of the same shape
+        mode: 'mean', 'median' or 'cloud' (cloud-aware mean, see cloud_mosaic)
+        dtype: output dtype. Integer outputs are rounded.
+    """
+    assert mode in MODES
+    if mode == 'mean':
+        annual = annual_mosaic(imgs)
+    elif mode == 'median':
+        annual = np.median(np.stack(imgs), axis=0).astype(np.float32)
+    else:
+        annual = cloud_mosaic(imgs, cloud_threshold)
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        annual = np.rint(annual)
+    return annual.astype(dtype)
 
 def get_imgs(path):
     """
-    Get all the images from a directory.
+    Get all the annual tiles (year, z, x, y) of a directory of quarterly mosaics.
     """
-    all_imgs = glob.glob(path)
-    imgs = {}
-    for img in all_imgs:
+    keys = set()
+    for entry in os.scandir(path):
+        if not entry.name.endswith('.png'):
+            continue
         # pl{year}_{q}_{z}_{x}_{y}.png
-        items = img.split('/')[-1].split('_')
-        year, z, x, y = items[0][2:], items[2], items[3], items[4][:-4]
-        key = '_'.join((year, z, x, y))
-        imgs[key] = 'pl{year}_{z}_{x}_{y}.npy'.format(year=year, z=z, x=x, y=y)
-    return imgs
-
-quarters = ['q1', 'q2', 'q3', 'q4']
-
-for year in years:
-    imgs = get_imgs(os.path.join(PLANETPATH, year, '*.png'))
-    for key in imgs:
-        year, z, x, y = key.split('_')
-        if not os.path.exists(os.path.join(OUTPATH, year, imgs[key])):
-            qs = [cv2.imread(os.path.join(PLANETPATH, year, 'pl{year}_{q}_{z}_{x}_{y}.png').format(year=year, q=q, z=z, x=x, y=y)) for q in quarters]
-            annual = annual_mosaic(qs)
-            np.save(os.path.join(OUTPATH, year, imgs[key]), annual)
+        items = entry.name.split('_')
+        keys.add((items[0][2:], items[2], items[3], items[4][:-4]))
+    return sorted(keys)
+
+def load_manifest(out_path):
+    """
+    Read the set of finished tiles '{year}_{z}_{x}_{y}' of an output directory.
+    """
+    manifest_path = os.path.join(out_path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return set()
+    with open(manifest_path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+def process_tile(args):
+    """
+    Composite and save the annual mosaic of a tile.
+    Returns the tile key, or None if no quarter could be read.
+    """
+    key, planet_path, out_path, mode, dtype = args
+    year, z, x, y = key
+    quarter_name = os.path.join(planet_path, year, 'pl{year}_{q}_{z}_{x}_{y}.png')
+    qs = [cv2.imread(quarter_name.format(year=year, q=q, z=z, x=x, y=y)) for q in QUARTERS]
+    qs = [q for q in qs if q is not None]
+    if not qs:
+        return None
+    annual = composite(qs, mode, dtype)
+    out_name = os.path.join(out_path, year, 'pl{year}_{z}_{x}_{y}.npy'.format(year=year, z=z, x=x, y=y))
+    np.save(out_name, annual)
+    return '_'.join(key)
+
+def main(planet_path=PLANETPATH, out_path=OUTPATH, years=YEARS, mode='mean',
+         dtype='uint8', num_workers=None, chunksize=16):
+    create_dir(out_path)
+    for year in years:
+        create_dir(os.path.join(out_path, year))
+
+    done = load_manifest(out_path)
+    keys = [key for year in years for key in get_imgs(os.path.join(planet_path, year))
+            if '_'.join(key) not in done]
+    print('Processing {} tiles, {} already done'.format(len(keys), len(done)))
+    tasks = ((key, planet_path, out_path, mode, np.dtype(dtype)) for key in keys)
+
+    start = time.time()
+    n_done = 0
+    with open(os.path.join(out_path, MANIFEST), 'a') as manifest, \
+            multiprocessing.Pool(processes=num_workers) as pool:
+        for result in pool.imap_unordered(process_tile, tasks, chunksize=chunksize):
+            if result is None:
+                continue
+            manifest.write(result + '\n')
+            n_done += 1
+            if n_done % 1000 == 0:
+                manifest.flush()
+                print('{}/{} tiles, {:.1f} tiles/s'.format(
+                    n_done, len(keys), n_done / (time.time() - start)))
 
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Create annual mosaics from quarterly planet mosaics')
+    args.add_argument('--planet_path', default=PLANETPATH, type=str)
+    args.add_argument('--out_path', default=OUTPATH, type=str)
+    args.add_argument('--years', nargs='+', default=YEARS, type=str)
+    args.add_argument('--mode', default='mean', choices=MODES)
+    args.add_argument('--dtype', default='uint8', type=str,
+                      help='output dtype, e.g. uint8 or float32 (default: uint8)')
+    args.add_argument('--num_workers', default=None, type=int,
+                      help='number of processes (default: number of cpus)')
+    args = args.parse_args()
+    main(args.planet_path, args.out_path, args.years, args.mode, args.dtype,
+         args.num_workers)
@@ -0,0 +1,161 @@
+"""
+Writer of the chunked tile store. The format and its reader (TileGroup,
+TileStore) are defined with the data loaders, in
+semantic_segmentation/unet/data_loader/tile_store.py.
+
+Example usage (convert the directory layout):
+```
+python tile_store.py --src /mnt/.../forest_cover --dst /mnt/.../store --product fc --years 2013 2014 2015
+```
+"""
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import cv2
+# appended, so that the modules of this directory (e.g. utils) come first
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'semantic_segmentation', 'unet'))
+from data_loader.tile_store import META_FILE, INDEX_FILE, CHUNK_FILE, group_dir, TileStore
+
+DEFAULT_CHUNK_SIZE = 4096
+
+
+class TileStoreWriter:
+    """
+    Append tiles of one (product, year) to a tile store. Records are written
+    before their index row, so an interrupted writer leaves a readable store.
+    """
+    def __init__(self, root, product, year, shape, dtype=np.uint8,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.path = group_dir(root, product, year)
+        os.makedirs(self.path, exist_ok=True)
+        meta_path = os.path.join(self.path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            assert tuple(meta['shape']) == tuple(shape), 'Tile shape differs from the store'
+            assert np.dtype(meta['dtype']) == np.dtype(dtype), 'Tile dtype differs from the store'
+            chunk_size = meta['chunk_size']
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump({'dtype': np.dtype(dtype).str, 'shape': list(shape),
+                           'chunk_size': chunk_size}, f)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.tile_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        index_path = os.path.join(self.path, INDEX_FILE)
+        n_index = os.path.getsize(index_path) // 24 if os.path.exists(index_path) else 0
+        self.n_tiles = n_index
+        # Drop a partially written record or index row
+        with open(index_path, 'ab') as f:
+            f.truncate(n_index * 24)
+        self._index = open(index_path, 'ab')
+        self._chunk_id = None
+        self._chunk = None
+
+    def _open_chunk(self):
+        chunk_id = self.n_tiles // self.chunk_size
+        if chunk_id != self._chunk_id:
+            if self._chunk is not None:
+                self._chunk.close()
+            chunk_path = os.path.join(self.path, CHUNK_FILE.format(chunk_id))
+            self._chunk = open(chunk_path, 'ab')
+            self._chunk.truncate((self.n_tiles % self.chunk_size) * self.tile_nbytes)
+            self._chunk_id = chunk_id
+        return self._chunk
+
+    def append(self, z, x, y, tile):
+        tile = np.ascontiguousarray(tile, dtype=self.dtype)
+        assert tile.shape == self.shape, 'Expected tile of shape {}, got {}'.format(self.shape, tile.shape)
+        chunk = self._open_chunk()
+        chunk.write(tile.tobytes())
+        chunk.flush()
+        # flush the row too, so that an interrupted writer keeps every complete record
+        self._index.write(np.array([z, x, y], dtype=np.int64).tobytes())
+        self._index.flush()
+        self.n_tiles += 1
+
+    def close(self):
+        if self._chunk is not None:
+            self._chunk.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_tile_info(tile):
+    """
+    Retrieve the year, zoom, x, y from a tile name.
+    Format example: fc2017_11_753_1076.npy
+    """
+    tile_items = tile.split('_')
+    return tile_items[0][2:], int(tile_items[1]), int(tile_items[2]), int(tile_items[3][:-4])
+
+
+def load_tile(path):
+    """
+    Load a tile of the directory layout in the store format: HWC uint8 RGB
+    for images and HW uint8 binary for masks.
+    """
+    if path.endswith('.png'):
+        return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+    img_arr = np.load(path)
+    if img_arr.ndim == 2: # mask
+        return (img_arr != 0).astype(np.uint8)
+    if img_arr.shape[0] == 3: # CHW
+        img_arr = img_arr.transpose([1, 2, 0])
+    return np.clip(np.rint(img_arr), 0, 255).astype(np.uint8)
+
+
+def convert_directory(src_dir, dst_root, product, years, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Convert src_dir/<year>/<product><year>_<z>_<x>_<y>.(npy|png) into a tile store.
+    Tiles already in the store are skipped, so it can be resumed.
+    Returns the number of tiles converted.
+    """
+    store = TileStore(dst_root)
+    n_converted = 0
+    for year in years:
+        year_dir = os.path.join(src_dir, str(year))
+        names = sorted(entry.name for entry in os.scandir(year_dir)
+                       if entry.name.startswith(product) and entry.name[-4:] in ['.npy', '.png'])
+        if not names:
+            continue
+        done = set()
+        if os.path.exists(os.path.join(group_dir(dst_root, product, year), META_FILE)):
+            done = set(store.keys(product, year))
+        writer = None
+        for name in names:
+            _, z, x, y = get_tile_info(name)
+            if (z, x, y) in done:
+                continue
+            tile = load_tile(os.path.join(year_dir, name))
+            if writer is None:
+                writer = TileStoreWriter(dst_root, product, year, tile.shape,
+                                         chunk_size=chunk_size)
+            writer.append(z, x, y, tile)
+            n_converted += 1
+        if writer is not None:
+            writer.close()
+        print('Converted {} {} tiles'.format(year, product))
+    return n_converted
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Convert tile directories into a tile store')
+    args.add_argument('--src', required=True, type=str,
+                      help='directory with one subdirectory per year')
+    args.add_argument('--dst', required=True, type=str, help='root of the tile store')
+    args.add_argument('--product', required=True, type=str,
+                      help='file prefix of the tiles, e.g. fc, fl, ld, pl')
+    args.add_argument('--years', nargs='+', required=True, type=str)
+    args.add_argument('--chunk_size', default=DEFAULT_CHUNK_SIZE, type=int)
+    args = args.parse_args()
+    convert_directory(args.src, args.dst, args.product, args.years, args.chunk_size)
@@ -4,8 +4,9 @@ and directory/file management
 """
 import os
 import math
-from pyproj import Proj, transform
-from rasterio.merge import merge
+import numpy as np
+from functools import lru_cache
+from pyproj import Transformer
 
 def deg2num(lon_deg, lat_deg, zoom):
   """
@@ -28,6 +29,39 @@ def num2deg(xtile, ytile, zoom):
   lat_deg = math.degrees(lat_rad)
   return lon_deg, lat_deg
 
+def deg2num_array(lon_deg, lat_deg, zoom):
+  """
+  Vectorized deg2num. Transform arrays of (lon, lat) points into the tile
+  coordinates that contain them.
+  Returns two int64 ndarrays (xtile, ytile).
+  """
+  lon_deg = np.asarray(lon_deg, dtype=np.float64)
+  lat_rad = np.radians(np.asarray(lat_deg, dtype=np.float64))
+  n = 2.0 ** np.asarray(zoom, dtype=np.float64)
+  xtile = ((lon_deg + 180.0) / 360.0 * n).astype(np.int64)
+  ytile = ((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n).astype(np.int64)
+  return xtile, ytile
+
+def num2deg_array(xtile, ytile, zoom):
+  """
+  Vectorized num2deg. Transform arrays of tiles into (lon, lat) arrays of their
+  upper left corner.
+  """
+  xtile = np.asarray(xtile, dtype=np.float64)
+  ytile = np.asarray(ytile, dtype=np.float64)
+  n = 2.0 ** np.asarray(zoom, dtype=np.float64)
+  lon_deg = xtile / n * 360.0 - 180.0
+  lat_deg = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * ytile / n))))
+  return lon_deg, lat_deg
+
+@lru_cache(maxsize=None)
+def get_transformer(src_crs, dst_crs):
+    """
+    Build (once) a pyproj Transformer between two CRS. Coordinates are always
+    given as (x, y), i.e. (lon, lat) for EPSG:4326.
+    """
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
 def geodesic2spherical(x1, y1, inverse=False):
     """
     EPSG:4326 to EPSG:3857:
@@ -38,17 +72,49 @@ def geodesic2spherical(x1, y1, inverse=False):
         y1: y coordinate
     """
     if inverse:
-        inProj = Proj(init='epsg:3857')
-        outProj = Proj(init='epsg:4326')
+        transformer = get_transformer('epsg:3857', 'epsg:4326')
     else:
-        inProj = Proj(init='epsg:4326')
-        outProj = Proj(init='epsg:3857')
-    x2,y2 = transform(inProj, outProj, x1,y1)
+        transformer = get_transformer('epsg:4326', 'epsg:3857')
+    x2,y2 = transformer.transform(x1, y1)
     return x2, y2
 
+def geodesic2spherical_array(x1, y1, inverse=False):
+    """
+    Vectorized geodesic2spherical. Takes and returns float64 ndarrays.
+    """
+    x1 = np.asarray(x1, dtype=np.float64)
+    y1 = np.asarray(y1, dtype=np.float64)
+    return geodesic2spherical(x1, y1, inverse=inverse)
+
+def bbox2tiles_array(bbox, zoom):
+    """
+    Return the tile coordinates that form a bounding box as an (N, 3) int64
+    array of (z, x, y) rows. Tiles are ordered by x, then y.
+    Params:
+        bbox: dict with 'upper_left' and 'lower_right' (lon, lat) tuples
+        zoom: zoom level
+    """
+    lons = [bbox['upper_left'][0], bbox['lower_right'][0]]
+    lats = [bbox['upper_left'][1], bbox['lower_right'][1]]
+    xtiles, ytiles = deg2num_array(lons, lats, zoom)
+    xs = np.arange(xtiles[0], xtiles[1] + 1, dtype=np.int64)
+    ys = np.arange(ytiles[0], ytiles[1] + 1, dtype=np.int64)
+    tiles = np.empty((len(xs) * len(ys), 3), dtype=np.int64)
+    tiles[:, 0] = zoom
+    tiles[:, 1] = np.repeat(xs, len(ys))
+    tiles[:, 2] = np.tile(ys, len(xs))
+    return tiles
+
+def tiles2array(tiles):
+    """
+    Transform a list of (z, x, y) tiles, possibly given as strings, into an
+    (N, 3) int64 array.
+    """
+    return np.asarray(tiles, dtype=np.int64).reshape(-1, 3)
+
 def create_dir(folder):
-  """
-  Create dir if it does not exist.
-  """
+    """
+    Create dir if it does not exist.
+    """
     if not os.path.exists(folder):
         os.makedirs(folder)
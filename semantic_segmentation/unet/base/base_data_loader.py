@@ -5,19 +5,76 @@ to define the custom DataLoaders in unet/data_loader/data_loaders.py
 import numpy as np
 from torch.utils.data import DataLoader
 from torch.utils.data.dataloader import default_collate
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import Sampler, SubsetRandomSampler
+from torch.utils.data.distributed import DistributedSampler
+from utils import is_distributed, get_rank, get_world_size
+
+
+class ShardSampler(Sampler):
+    """
+    Every rank-th index of indices (default: all the samples of the dataset),
+    in order and without the padding of DistributedSampler, so that every
+    sample is evaluated exactly once whatever the number of processes.
+    """
+    def __init__(self, dataset, indices=None):
+        if indices is None:
+            indices = range(len(dataset))
+        self.indices = indices[get_rank()::get_world_size()]
+
+    def __iter__(self):
+        return (int(i) for i in self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class DistributedSubsetSampler(Sampler):
+    """
+    SubsetRandomSampler of distributed training: the indices are shuffled
+    every epoch (see set_epoch), padded like DistributedSampler so that every
+    process runs the same number of batches, and every rank-th index is
+    sampled.
+    """
+    def __init__(self, indices, seed=0):
+        self.indices = np.asarray(indices)
+        self.seed = seed
+        self.epoch = 0
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        self.num_samples = -(-len(self.indices) // self.world_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        indices = np.random.RandomState(self.seed + self.epoch).permutation(self.indices)
+        # repeat the first indices up to the same number of samples per process
+        indices = np.resize(indices, self.num_samples * self.world_size)
+        return iter(indices[self.rank::self.world_size].tolist())
+
+    def __len__(self):
+        return self.num_samples
 
 
 class BaseDataLoader(DataLoader):
     """
     Base class for all data loaders
     """
-    def __init__(self, dataset, batch_size, shuffle, validation_split, num_workers, collate_fn=default_collate):
+    def __init__(self, dataset, batch_size, shuffle, validation_split, num_workers, collate_fn=default_collate,
+                 distributed_eval=False):
         """
         params:
             dataset: Pytorch Dataset object
             validation_split: float between 0 and 1. Indicates the percentage
                 of data to assign to the validation set
+            distributed_eval: whether the loader evaluates the model (validation)
+                in distributed training, see below.
+        In distributed training (see train.py --nproc), every process loads
+        its own shard of the dataset. Training shards are padded to the same
+        number of batches (DistributedSampler), which the gradient all-reduce
+        requires. Evaluation shards (distributed_eval, and the validation split)
+        are not padded (ShardSampler), whatever shuffle says: the reduced
+        metrics must not count the padding samples twice.
         """
         self.validation_split = validation_split
         self.shuffle = shuffle
@@ -26,6 +83,13 @@ class BaseDataLoader(DataLoader):
         self.n_samples = len(dataset)
 
         self.sampler, self.valid_sampler = self._split_sampler(self.validation_split)
+        if is_distributed():
+            if distributed_eval:
+                self.sampler = ShardSampler(dataset, getattr(self.sampler, 'indices', None))
+            elif self.sampler is None:
+                self.sampler = DistributedSampler(dataset, shuffle=self.shuffle)
+            self.shuffle = False
+            self.n_samples = len(self.sampler)
         self.init_kwargs = {
             'dataset': dataset,
             'batch_size': batch_size,
@@ -60,8 +124,12 @@ class BaseDataLoader(DataLoader):
         valid_idx = idx_full[0:len_valid]
         train_idx = np.delete(idx_full, np.arange(0, len_valid))
 
-        train_sampler = SubsetRandomSampler(train_idx)
-        valid_sampler = SubsetRandomSampler(valid_idx)
+        if is_distributed():
+            train_sampler = DistributedSubsetSampler(train_idx)
+            valid_sampler = ShardSampler(None, valid_idx)
+        else:
+            train_sampler = SubsetRandomSampler(train_idx)
+            valid_sampler = SubsetRandomSampler(valid_idx)
 
         # turn off shuffle option which is mutually exclusive with sampler
         self.shuffle = False
@@ -6,6 +6,9 @@ import torch
 from abc import abstractmethod
 from numpy import inf
 from logger import TensorboardWriter
+from base.checkpoint_writer import CheckpointWriter
+from torch.nn.parallel import DistributedDataParallel
+from utils import is_distributed, is_main_process, get_rank, unwrap_model, load_model_state
 
 class BaseTrainer:
     def __init__(self, model, loss, metrics, optimizer, config):
@@ -18,13 +21,22 @@ class BaseTrainer:
             config: ConfigParser object
         """
         self.config = config
-        self.logger = config.get_logger('trainer', config['trainer']['verbosity'])
+        # in distributed training only the first process logs, checkpoints and writes to tensorboard
+        verbosity = config['trainer']['verbosity'] if is_main_process() else 0
+        self.logger = config.get_logger('trainer', verbosity)
 
         # setup GPU device if available, move model into configured device
         self.device, device_ids = self._prepare_device(config['n_gpu'])
         self.model = model.to(self.device)
-        if len(device_ids) > 1:
-            self.model = torch.nn.DataParallel(model, device_ids=device_ids)
+        # channels-last before the DDP wrap, which builds its gradient buckets from the parameter strides
+        self.channels_last = config['trainer'].get('channels_last', False)
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        if is_distributed():
+            self.model = DistributedDataParallel(
+                self.model, device_ids=device_ids if self.device.type == 'cuda' else None)
+        elif len(device_ids) > 1:
+            self.model = torch.nn.DataParallel(self.model, device_ids=device_ids)
 
         # Loss to optimize
         self.loss = loss
@@ -57,9 +69,11 @@ class BaseTrainer:
         # Last model in the model directory
         self.keep_last = config['trainer']['keep_last']
         self.checkpoint_dir = config.save_dir
+        self.checkpoint_writer = CheckpointWriter(self.checkpoint_dir, self.keep_last, self.logger)
 
         # setup visualization writer instance
-        self.writer = TensorboardWriter(config.log_dir, self.logger, cfg_trainer['tensorboard'])
+        self.writer = TensorboardWriter(config.log_dir, self.logger,
+                                        cfg_trainer['tensorboard'] and is_main_process())
 
         if config.resume is not None:
             self._resume_checkpoint(config.resume)
@@ -118,8 +132,9 @@ class BaseTrainer:
                                      "Training stops.".format(self.early_stop))
                     break
 
-            if epoch % self.save_period == 0:
+            if epoch % self.save_period == 0 and is_main_process():
                 self._save_checkpoint(epoch, save_best=best)
+        self.checkpoint_writer.close()
 
     def _prepare_device(self, n_gpu_use):
         """
@@ -134,48 +149,42 @@ class BaseTrainer:
             self.logger.warning("Warning: The number of GPU\'s configured to use is {}, but only {} are available "
                                 "on this machine.".format(n_gpu_use, n_gpu))
             n_gpu_use = n_gpu
-        # device = torch.device('cuda:{}'.format(device_id) if n_gpu_use > 0 else 'cpu')
+        if is_distributed():
+            # one process per GPU
+            if n_gpu_use == 0:
+                return torch.device('cpu'), []
+            device_id = get_rank() % n_gpu_use
+            torch.cuda.set_device(device_id)
+            return torch.device('cuda:{}'.format(device_id)), [device_id]
         device = torch.device('cuda:0' if n_gpu_use > 0 else 'cpu')
-        # TODO - implement for different gpus
         list_ids = list(range(n_gpu_use))
         return device, list_ids
 
+    def _model_to_save(self):
+        """
+        The model without the DataParallel/DistributedDataParallel wrapper, so
+        its checkpoints can be loaded however the model is run.
+        """
+        return unwrap_model(self.model)
+
     def _save_checkpoint(self, epoch, save_best=False):
         """
-        Saving checkpoints
+        Saving checkpoints. They are written in the background (see
+        checkpoint_writer.py), and only the last self.keep_last are kept.
 
         :param epoch: current epoch number
-        :param log: logging information of the epoch
-        :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
+        :param save_best: if True, also link the saved checkpoint as 'model_best.pth'
         """
-        arch = type(self.model).__name__
+        arch = type(self._model_to_save()).__name__
         state = {
             'arch': arch,
             'epoch': epoch,
-            'state_dict': self.model.state_dict(),
+            'state_dict': self._model_to_save().state_dict(),
             'optimizer': self.optimizer.state_dict(),
             'monitor_best': self.mnt_best,
-            'config': self.config
+            'config': dict(self.config.config)
         }
-        filename = str(self.checkpoint_dir / 'checkpoint-epoch{}.pth'.format(epoch))
-        torch.save(state, filename)
-        self.logger.info("Saving checkpoint: {} ...".format(filename))
-        if save_best:
-            best_path = str(self.checkpoint_dir / 'model_best.pth')
-            torch.save(state, best_path)
-            self.logger.info("Saving current best: model_best.pth ...")
-
-        self._remove_checkpoints()
-
-    def _remove_checkpoints(self):
-        """
-        Keep the last self.keep_last checkpoints after each epoch.
-        """
-        checkpoints = self.checkpoint_dir.rglob("checkpoint-epoch*.pth")
-        checkpoints = sorted(checkpoints, key=lambda f: f.stat().st_mtime)
-        checkpoints = checkpoints[:-self.keep_last]
-        for c in checkpoints:
-            c.unlink()
+        self.checkpoint_writer.save(state, 'checkpoint-epoch{}.pth'.format(epoch), save_best)
 
     def _resume_checkpoint(self, resume_path):
         """
@@ -185,7 +194,7 @@ class BaseTrainer:
         """
         resume_path = str(resume_path)
         self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
+        checkpoint = torch.load(resume_path, map_location=self.device)
         self.start_epoch = checkpoint['epoch'] + 1
         self.mnt_best = checkpoint['monitor_best']
 
@@ -193,7 +202,7 @@ class BaseTrainer:
         if checkpoint['config']['arch'] != self.config['arch']:
             self.logger.warning("Warning: Architecture configuration given in config file is different from that of "
                                 "checkpoint. This may yield an exception while state_dict is being loaded.")
-        self.model.load_state_dict(checkpoint['state_dict'])
+        load_model_state(self.model, checkpoint['state_dict'])
 
         # load optimizer state from checkpoint only when optimizer type is not changed.
         if checkpoint['config']['optimizer']['type'] != self.config['optimizer']['type']:
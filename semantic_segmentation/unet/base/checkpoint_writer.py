@@ -0,0 +1,112 @@
+"""
+Background checkpoint writer used by BaseTrainer. The state is snapshotted to
+CPU on the training thread, then serialized and written by a worker thread.
+Files are written to a temporary name and renamed, so a checkpoint is either
+complete or absent. The best model is a hard link to its epoch checkpoint.
+"""
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+BEST_NAME = 'model_best.pth'
+CHECKPOINT_GLOB = 'checkpoint-epoch*.pth'
+
+
+def snapshot(obj):
+    """
+    Copy the tensors of a (nested) state to CPU, so training can go on while
+    it is written.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def _atomic_save(state, path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _atomic_link(src, dst):
+    """
+    Point dst to the content of src: hard link if the filesystem supports it,
+    copy otherwise.
+    """
+    tmp_path = dst + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class CheckpointWriter:
+    """
+    Write checkpoints in a background thread and keep the last keep_last of them.
+    Params:
+        checkpoint_dir: pathlib.Path of the experiment checkpoints
+        keep_last: number of epoch checkpoints to keep (0 keeps all of them)
+    """
+    def __init__(self, checkpoint_dir, keep_last, logger):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.logger = logger
+        # retained checkpoints, oldest first. Only listed once, when resuming in the same directory
+        existing = sorted(checkpoint_dir.glob(CHECKPOINT_GLOB), key=lambda f: f.stat().st_mtime)
+        self.retained = deque(str(f) for f in existing)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def save(self, state, filename, save_best=False):
+        """
+        Snapshot state and write it to checkpoint_dir/filename in the background.
+        At most one checkpoint is in flight: it waits for the previous one first.
+        """
+        self.wait()
+        state = snapshot(state)
+        self._pending = self._executor.submit(self._write, state, filename, save_best)
+
+    def _write(self, state, filename, save_best):
+        path = str(self.checkpoint_dir / filename)
+        _atomic_save(state, path)
+        self.logger.info("Saving checkpoint: {} ...".format(path))
+        if save_best:
+            _atomic_link(path, str(self.checkpoint_dir / BEST_NAME))
+            self.logger.info("Saving current best: {} ...".format(BEST_NAME))
+        if path in self.retained:
+            self.retained.remove(path)
+        self.retained.append(path)
+        while self.keep_last and len(self.retained) > self.keep_last:
+            old_path = self.retained.popleft()
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def wait(self):
+        """
+        Wait for the checkpoint in flight, re-raising its error if it failed.
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
@@ -11,9 +11,54 @@ import torchvision
 import pickle as pkl
 from torch.utils.data import DataLoader, Dataset
 from torch.utils.data.sampler import SubsetRandomSampler
-from torchvision import datasets, transforms
 from base import BaseDataLoader
 from data_loader import utils
+from data_loader.tile_store import TileStore
+from data_loader.tile_index import get_tile_index
+from data_loader.tile_cache import PartitionedTileCache
+from utils import get_world_size
+
+# slot shapes of the decoded-tile cache
+IMAGE_SHAPE = (256, 256, 3)
+MASK_SHAPE = (256, 256)
+
+
+def get_store_keys(store, product, years):
+    """
+    List the (year, z, x, y) keys of a tile store product for the given years.
+    """
+    keys = []
+    for year in years:
+        keys.extend((year, z, x, y) for z, x, y in store.keys(product, year))
+    return keys
+
+
+def make_cache(num_items, cache_bytes, part_shapes):
+    """
+    Create the decoded-tile cache of a dataset, or None if cache_bytes is 0.
+    The key of part p of item i is i * len(part_shapes) + p.
+    cache_bytes is the budget of the machine: in distributed training every
+    process has its own cache of cache_bytes / world size.
+    """
+    if not cache_bytes:
+        return None
+    return PartitionedTileCache(len(part_shapes) * num_items, cache_bytes // get_world_size(), part_shapes)
+
+
+def read_tile(source, store=None, cache=None, key=None, raw=False):
+    """
+    Read a tile from a path or a (product, year, z, x, y) tile store key.
+    With a cache, the tile is decoded to uint8 once and then copied from the
+    cache, so it must be normalized with utils.ToNormalizedTensor.
+    With raw, it is always returned as uint8 (see utils.open_image).
+    """
+    if isinstance(source, tuple):
+        load = lambda: store.read(*source)
+    else:
+        load = lambda: utils.open_image(source, raw=raw or cache is not None)
+    if cache is None:
+        return load()
+    return cache.get(key, load)
 
 
 class SingleDataset(Dataset):
@@ -24,22 +69,48 @@ class SingleDataset(Dataset):
             label_dir: directory of the semantic segmentation labels (Hansen)
             years: list of years
             max_dataset_size
+            store_dir: root of a tile store. If given, tiles are read from it
+                instead of img_dir and label_dir.
+            img_product, label_product: tile store products of the images and
+                the labels, e.g. 'ld' and 'fc'
+            stats_path: json with the normalization mean/std computed by
+                data/calculate_stats.py (default: Landsat stats)
+            index_path: .npz tile index (see tile_index.py). It is built on
+                first use, and then the tile paths are read from it.
+            min_positive_ratio: with index_path, skip tiles whose label has a
+                lower ratio of positive pixels
+            cache_bytes: memory budget of the decoded-tile cache shared by the
+                DataLoader workers (default: 0, no cache), see make_cache
     """
-    def __init__(self, img_dir, label_dir, years, max_dataset_size):
+    def __init__(self, img_dir, label_dir, years, max_dataset_size,
+                 store_dir=None, img_product='ld', label_product='fc',
+                 stats_path=None, index_path=None, min_positive_ratio=0.,
+                 cache_bytes=0):
         self.img_dir = img_dir
         self.label_dir = label_dir
-        self.paths = []
-        for year in years:
-            imgs_path = os.path.join(label_dir, year)
-            self.paths.extend(glob.glob(os.path.join(imgs_path, '*')))
+        self.store = None
+        self.index = None
+        self.img_product = img_product
+        self.label_product = label_product
+        if store_dir is not None:
+            self.store = TileStore(store_dir)
+            self.paths = get_store_keys(self.store, label_product, years)
+        elif index_path is not None:
+            self.index = get_tile_index(index_path, img_dir, label_dir, years,
+                                        double=False, min_positive_ratio=min_positive_ratio)
+            self.paths = list(range(len(self.index['label_path'])))
+        else:
+            self.paths = []
+            for year in years:
+                imgs_path = os.path.join(label_dir, year)
+                self.paths.extend(glob.glob(os.path.join(imgs_path, '*')))
         self.paths = self.paths[:min(len(self.paths), max_dataset_size)]
         self.paths.sort()
-        self.transforms = transforms.Compose([
-            transforms.ToTensor(),
-            utils.Normalize((0.3326, 0.3570, 0.2224),
-                (0.1059, 0.1086, 0.1283))
-        ])
+        self.mean, self.std = utils.load_stats(stats_path)
+        self.transforms = utils.ToNormalizedTensor(self.mean, self.std)
         self.dataset_size = len(self.paths)
+        # mask and image of every tile
+        self.cache = make_cache(self.dataset_size, cache_bytes, [MASK_SHAPE, IMAGE_SHAPE])
 
     def __len__(self):
         # print('Planet Dataset len called')
@@ -47,11 +118,19 @@ class SingleDataset(Dataset):
 
     def __getitem__(self, index):
         r"""Returns data point and its binary mask"""
-        mask_path = self.paths[index]
-        img_path = utils.get_img(mask_path, self.img_dir)
-
-        mask_arr = utils.open_image(mask_path)
-        img_arr = utils.open_image(img_path)
+        if self.store is not None:
+            year, z, x, y = self.paths[index]
+            mask_src = (self.label_product, year, z, x, y)
+            img_src = (self.img_product, year, z, x, y)
+        elif self.index is not None:
+            i = self.paths[index]
+            mask_src = self.index['label_path'][i].decode()
+            img_src = self.index['img_path'][i].decode()
+        else:
+            mask_src = self.paths[index]
+            img_src = utils.get_img(mask_src, self.img_dir)
+        mask_arr = read_tile(mask_src, self.store, self.cache, 2 * index)
+        img_arr = read_tile(img_src, self.store, self.cache, 2 * index + 1)
         mask_arr = torch.from_numpy(mask_arr).unsqueeze(0)
         img_arr = self.transforms(img_arr)
 
@@ -64,6 +143,9 @@ class SingleDataLoader(BaseDataLoader):
             img_dir: directory of the input raw images (Planet or Landsat)
             label_dir: directory of the semantic segmentation labels (Hansen)
             years: list of years
+            store_dir, img_product, label_product, stats_path, index_path,
+                min_positive_ratio, cache_bytes: see SingleDataset
+            distributed_eval: see BaseDataLoader
     """
     def __init__(self, img_dir,
             label_dir,
@@ -72,11 +154,22 @@ class SingleDataLoader(BaseDataLoader):
             max_dataset_size=float('inf'),
             shuffle=True,
             num_workers=16,
-            mode='train'):
+            mode='train',
+            store_dir=None,
+            img_product='ld',
+            label_product='fc',
+            stats_path=None,
+            index_path=None,
+            min_positive_ratio=0.,
+            cache_bytes=0,
+            distributed_eval=False):
         if max_dataset_size == 'inf':
             max_dataset_size = float('inf')
-        self.dataset = SingleDataset(img_dir, label_dir, years, max_dataset_size)
-        super().__init__(self.dataset, batch_size, shuffle, 0, num_workers)
+        self.dataset = SingleDataset(img_dir, label_dir, years, max_dataset_size,
+                                     store_dir, img_product, label_product, stats_path,
+                                     index_path, min_positive_ratio, cache_bytes)
+        super().__init__(self.dataset, batch_size, shuffle, 0, num_workers,
+                         distributed_eval=distributed_eval)
 
 class DoubleDataset(Dataset):
     """
@@ -85,25 +178,41 @@ class DoubleDataset(Dataset):
             img_dir: directory of the input raw images (Planet or Landsat)
             label_dir: directory of the semantic segmentation labels (Hansen)
             years: list of years
+            store_dir, img_product, label_product, stats_path, index_path,
+                min_positive_ratio, cache_bytes: see SingleDataset
     """
-    def __init__(self, img_dir, label_dir, years, max_dataset_size):
+    def __init__(self, img_dir, label_dir, years, max_dataset_size,
+                 store_dir=None, img_product='ld', label_product='fc',
+                 stats_path=None, index_path=None, min_positive_ratio=0.,
+                 cache_bytes=0):
         self.img_dir = img_dir
         self.label_dir = label_dir
-        self.paths = []
-        for year in years:
-            imgs_path = os.path.join(label_dir, year)
-            self.paths.extend(glob.glob(os.path.join(imgs_path, '*')))
+        self.store = None
+        self.index = None
+        self.img_product = img_product
+        self.label_product = label_product
+        if store_dir is not None:
+            self.store = TileStore(store_dir)
+            self.paths = get_store_keys(self.store, label_product, years)
+        elif index_path is not None:
+            self.index = get_tile_index(index_path, img_dir, label_dir, years,
+                                        double=True, min_positive_ratio=min_positive_ratio)
+            self.paths = list(range(len(self.index['label_path'])))
+        else:
+            self.paths = []
+            for year in years:
+                imgs_path = os.path.join(label_dir, year)
+                self.paths.extend(glob.glob(os.path.join(imgs_path, '*')))
         self.paths = self.paths[:min(len(self.paths), max_dataset_size)]
         # with open('/mnt/ds3lab-scratch/lming/gee_data/forma_tiles2017.pkl', 'rb') as f:
         #     self.paths = pkl.load(f)
         # self.paths = [('11','773','1071')]
         self.paths.sort()
-        self.transforms = transforms.Compose([
-            transforms.ToTensor(),
-            utils.Normalize((0.3326, 0.3570, 0.2224),
-                (0.1059, 0.1086, 0.1283))
-        ])
+        self.mean, self.std = utils.load_stats(stats_path)
+        self.transforms = utils.ToNormalizedTensor(self.mean, self.std)
         self.dataset_size = len(self.paths)
+        # mask, previous and current image of every tile
+        self.cache = make_cache(self.dataset_size, cache_bytes, [MASK_SHAPE, IMAGE_SHAPE, IMAGE_SHAPE])
 
     def __len__(self):
         return self.dataset_size
@@ -135,12 +244,22 @@ class DoubleDataset(Dataset):
         img_arr = torch.cat((img_arr0, img_arr1), 0)
         return img_arr.float(), fl_arr.float()
         '''
-        mask_path = self.paths[index]
-        img_path1, img_path2 = utils.get_img(mask_path, self.img_dir, double=True)
-
-        mask_arr = utils.open_image(mask_path)
-        img_arr1 = utils.open_image(img_path1)
-        img_arr2 = utils.open_image(img_path2)
+        if self.store is not None:
+            year, z, x, y = self.paths[index]
+            mask_src = (self.label_product, year, z, x, y)
+            img_src1 = (self.img_product, str(int(year) - 1), z, x, y)
+            img_src2 = (self.img_product, year, z, x, y)
+        elif self.index is not None:
+            i = self.paths[index]
+            mask_src = self.index['label_path'][i].decode()
+            img_src1 = self.index['prev_img_path'][i].decode()
+            img_src2 = self.index['img_path'][i].decode()
+        else:
+            mask_src = self.paths[index]
+            img_src1, img_src2 = utils.get_img(mask_src, self.img_dir, double=True)
+        mask_arr = read_tile(mask_src, self.store, self.cache, 3 * index)
+        img_arr1 = read_tile(img_src1, self.store, self.cache, 3 * index + 1)
+        img_arr2 = read_tile(img_src2, self.store, self.cache, 3 * index + 2)
         mask_arr = torch.from_numpy(mask_arr).unsqueeze(0)
         img_arr1 = self.transforms(img_arr1)
         img_arr2 = self.transforms(img_arr2)
@@ -157,6 +276,9 @@ class DoubleDataLoader(BaseDataLoader):
         label_dir: directory that contains the labels of the images. It has
             subdirectories for every year.
         years: years to load from img_dir and label_dir.
+        store_dir, img_product, label_product, stats_path, index_path,
+            min_positive_ratio, cache_bytes: see SingleDataset
+        distributed_eval: see BaseDataLoader
     """
     def __init__(self, img_dir,
             label_dir,
@@ -164,11 +286,22 @@ class DoubleDataLoader(BaseDataLoader):
             years,
             max_dataset_size=float('inf'),
             shuffle=True,
-            num_workers=16):
+            num_workers=16,
+            store_dir=None,
+            img_product='ld',
+            label_product='fc',
+            stats_path=None,
+            index_path=None,
+            min_positive_ratio=0.,
+            cache_bytes=0,
+            distributed_eval=False):
         if max_dataset_size == 'inf':
             max_dataset_size = float('inf')
-        self.dataset = DoubleDataset(img_dir, label_dir, years, max_dataset_size)
-        super().__init__(self.dataset, batch_size, shuffle, 0, num_workers)
+        self.dataset = DoubleDataset(img_dir, label_dir, years, max_dataset_size,
+                                     store_dir, img_product, label_product, stats_path,
+                                     index_path, min_positive_ratio, cache_bytes)
+        super().__init__(self.dataset, batch_size, shuffle, 0, num_workers,
+                         distributed_eval=distributed_eval)
 
 
 class VideoDataset(Dataset):
@@ -181,9 +314,19 @@ class VideoDataset(Dataset):
             subdirectories for every year.
         video_dir: video prediction directory of the images.
         years: years to load from img_dir and label_dir.
+        store_dir: root of a tile store. If given, the ground truth images and
+            labels are read from it instead of img_dir and label_dir.
+        img_product, label_product: tile store products of the images and labels
+        stats_path: json with the normalization mean/std (default: Landsat stats)
+        cache_bytes: memory budget of the decoded-tile cache (default: 0, no cache), see make_cache
     """
+    PARTS = ['2013', '2014', '2015', '2016', '2017', '2015p', '2016p', '2017p',
+             'label2013', 'label2014', 'label2015', 'label2016', 'label2017']
+
     # def __init__(self, img_dir, label_dir, years, max_dataset_size):
-    def __init__(self, img_dir, label_dir, video_dir, max_dataset_size):
+    def __init__(self, img_dir, label_dir, video_dir, max_dataset_size,
+                 store_dir=None, img_product='ld', label_product='fc',
+                 stats_path=None, cache_bytes=0):
         """Initizalize dataset.
             Params:
                 filetype: png or npy. If png it is raw data, if npy it has been preprocessed
@@ -195,19 +338,21 @@ class VideoDataset(Dataset):
         self.img_dir = img_dir
         self.label_dir = label_dir
         self.video_dir = video_dir
+        self.store = TileStore(store_dir) if store_dir is not None else None
+        self.img_product = img_product
+        self.label_product = label_product
         self.paths = utils.get_immediate_subdirectories(self.video_dir)
         # with open('/mnt/ds3lab-scratch/lming/forest-prediction/video_prediction/no_in_training.pkl', 'rb') as f:
         #     no_in_training = pkl.load(f)
         # self.paths = no_in_training
         self.paths.sort()
         # self.paths.sort()
-        # TODO: update mean/std
-        self.transforms = transforms.Compose([
-            transforms.ToTensor(),
-            utils.Normalize((0.3326, 0.3570, 0.2224),
-                (0.1059, 0.1086, 0.1283))
-        ])
+        self.mean, self.std = utils.load_stats(stats_path)
+        self.transforms = utils.ToNormalizedTensor(self.mean, self.std)
         self.dataset_size = len(self.paths)
+        # 5 ground truth images, 3 predictions and 5 labels of every tile
+        self.cache = make_cache(self.dataset_size, cache_bytes,
+                                [MASK_SHAPE if part.startswith('label') else IMAGE_SHAPE for part in self.PARTS])
 
     def get_item(self, index):
         key = self.paths[index]
@@ -232,6 +377,14 @@ class VideoDataset(Dataset):
         label2016 = label_template.format(year_dir=2016, year_f=2016, key=key)
         label2017 = label_template.format(year_dir=2017, year_f=2017, key=key)
 
+        if self.store is not None:
+            # (product, year, z, x, y) keys instead of paths, see _load
+            z, x, y = key.split('_')
+            img2013, img2014, img2015, img2016, img2017 = [
+                (self.img_product, year, z, x, y) for year in self.years]
+            label2013, label2014, label2015, label2016, label2017 = [
+                (self.label_product, year, z, x, y) for year in self.years]
+
         return {
             '2013': {
                 'img_dir': img2013,
@@ -267,9 +420,17 @@ class VideoDataset(Dataset):
             },
         }
 
-    def _process_img_pair(self, img_dict):
-        img_arr = utils.open_image(img_dict['img_dir'])
-        mask_arr = utils.open_image(img_dict['label_dir'])
+    def _load(self, index, part, item, raw=False):
+        """
+        Load an image from a path or a (product, year, z, x, y) tile store key.
+        """
+        key = index * len(self.PARTS) + self.PARTS.index(part)
+        return read_tile(item, self.store, self.cache, key, raw)
+
+    def _process_img_pair(self, index, year, img_dict):
+        img_arr = self._load(index, year, img_dict['img_dir'])
+        # predictions share the label of their year
+        mask_arr = self._load(index, 'label' + year[:4], img_dict['label_dir'])
         img_arr = self.transforms(img_arr)
         mask_arr = torch.from_numpy(mask_arr).unsqueeze(0)
 
@@ -287,14 +448,8 @@ class VideoDataset(Dataset):
         # Notes: tiles in annual mosaics need to be divided by 255.
         imgs_dict = self.get_item(index)
         tensor_dict = {
-            '2013': self._process_img_pair(imgs_dict['2013']),
-            '2014': self._process_img_pair(imgs_dict['2014']),
-            '2015': self._process_img_pair(imgs_dict['2015']),
-            '2016': self._process_img_pair(imgs_dict['2016']),
-            '2017': self._process_img_pair(imgs_dict['2017']),
-            '2015p': self._process_img_pair(imgs_dict['2015p']),
-            '2016p': self._process_img_pair(imgs_dict['2016p']),
-            '2017p': self._process_img_pair(imgs_dict['2017p']),
+            year: self._process_img_pair(index, year, imgs_dict[year])
+            for year in self.PARTS[:8]
         }
         return tensor_dict
 
@@ -309,6 +464,8 @@ class PlanetVideoDataLoader(BaseDataLoader):
             subdirectories for every year.
         video_dir: video prediction directory of the images.
         years: years to load from img_dir and label_dir.
+        store_dir, img_product, label_product, stats_path, cache_bytes: see VideoDataset
+        distributed_eval: see BaseDataLoader
     """
     def __init__(self, img_dir,
             label_dir,
@@ -316,6 +473,68 @@ class PlanetVideoDataLoader(BaseDataLoader):
             batch_size,
             max_dataset_size=float('inf'),
             shuffle=False,
-            num_workers=16):
-        self.dataset = VideoDataset(img_dir, label_dir, video_dir, max_dataset_size)
-        super().__init__(self.dataset, batch_size, shuffle, 0, num_workers)
+            num_workers=16,
+            store_dir=None,
+            img_product='ld',
+            label_product='fc',
+            stats_path=None,
+            cache_bytes=0,
+            distributed_eval=False):
+        self.dataset = VideoDataset(img_dir, label_dir, video_dir, max_dataset_size,
+                                    store_dir, img_product, label_product, stats_path,
+                                    cache_bytes)
+        super().__init__(self.dataset, batch_size, shuffle, 0, num_workers,
+                         distributed_eval=distributed_eval)
+
+
+class TimelineDataset(VideoDataset):
+    """
+    Timeline of a tile of the video prediction results. The ground truth images
+    of every year and the predicted images are loaded once into a contiguous
+    uint8 stack, and the label of every year only once.
+    Items:
+        imgs: uint8 tensor (frames, C, H, W), frames in FRAMES order
+        labels: uint8 tensor (years, 1, H, W)
+    The label of FRAMES[f] is labels[LABEL_OF_FRAME[f]]. The images are
+    normalized on the device with utils.normalize_batch.
+    Params: see VideoDataset
+    """
+    FRAMES = ['2013', '2014', '2015', '2016', '2017', '2015p', '2016p', '2017p']
+    LABEL_OF_FRAME = [0, 1, 2, 3, 4, 2, 3, 4]
+
+    def __getitem__(self, index):
+        imgs_dict = self.get_item(index)
+        imgs = np.stack([
+            self._load(index, frame, imgs_dict[frame]['img_dir'], raw=True)
+            for frame in self.FRAMES])
+        labels = np.stack([
+            self._load(index, 'label' + year, imgs_dict[year]['label_dir'], raw=True)
+            for year in self.years])
+        return {
+            'imgs': torch.from_numpy(np.ascontiguousarray(imgs.transpose(0, 3, 1, 2))),
+            'labels': torch.from_numpy(labels).unsqueeze(1)
+        }
+
+
+class TimelineDataLoader(BaseDataLoader):
+    """
+    DataLoader of TimelineDataset, it takes the arguments of PlanetVideoDataLoader.
+    """
+    def __init__(self, img_dir,
+            label_dir,
+            video_dir,
+            batch_size,
+            max_dataset_size=float('inf'),
+            shuffle=False,
+            num_workers=16,
+            store_dir=None,
+            img_product='ld',
+            label_product='fc',
+            stats_path=None,
+            cache_bytes=0,
+            distributed_eval=False):
+        self.dataset = TimelineDataset(img_dir, label_dir, video_dir, max_dataset_size,
+                                       store_dir, img_product, label_product, stats_path,
+                                       cache_bytes)
+        super().__init__(self.dataset, batch_size, shuffle, 0, num_workers,
+                         distributed_eval=distributed_eval)
@@ -0,0 +1,188 @@
+"""
+Decoded-tile cache shared by the DataLoader workers.
+Tiles are stored as uint8 in fixed-size slots of an anonymous shared memory
+map. The slot table, the slot versions, the reference bits and the hit/miss
+counters live in shared ctypes arrays. All of them are created in the main
+process and inherited by the workers when they are forked (the default start
+method on Linux).
+Hits do not take the lock: a worker copies the slot, then checks that the
+version of the slot did not change meanwhile (a seqlock), so workers only
+wait for each other to insert tiles. Full slots are evicted with the CLOCK
+(second chance) policy.
+PartitionedTileCache keeps one such cache per tile shape (e.g. 256x256 masks
+and 256x256x3 images), so that small tiles do not take big slots.
+In distributed training (train.py --nproc N) every process builds its own
+cache: data_loaders.make_cache splits cache_bytes among the N processes, so
+the caches of the machine take cache_bytes in total, not N times it.
+"""
+import mmap
+import multiprocessing
+import numpy as np
+
+MAX_NDIM = 3
+
+
+class SharedTileCache:
+    """
+    CLOCK cache of uint8 tiles with a byte budget.
+    Params:
+        num_keys: number of distinct keys, keys are ints in [0, num_keys)
+        budget_bytes: memory used by the cached tiles
+        slot_shape: shape of the biggest tile. Bigger (or non uint8) tiles
+            are not cached.
+    The hit/miss counters are not locked, so they are approximate.
+    """
+    def __init__(self, num_keys, budget_bytes, slot_shape=(256, 256, 3)):
+        self.slot_nbytes = int(np.prod(slot_shape))
+        self.num_slots = max(int(budget_bytes) // self.slot_nbytes, 1)
+        self.num_keys = num_keys
+        # MAP_SHARED | MAP_ANONYMOUS, shared with the forked workers
+        self._buffer = mmap.mmap(-1, self.num_slots * self.slot_nbytes)
+        self._slot_of_key = multiprocessing.RawArray('q', num_keys)
+        self._key_of_slot = multiprocessing.RawArray('q', self.num_slots)
+        self._versions = multiprocessing.RawArray('q', self.num_slots) # odd while the slot is written
+        self._referenced = multiprocessing.RawArray('b', self.num_slots)
+        self._shapes = multiprocessing.RawArray('q', self.num_slots * (MAX_NDIM + 1))
+        self._counters = multiprocessing.RawArray('q', 3) # clock hand, hits, misses
+        self._lock = multiprocessing.Lock()
+        self._views()
+        self.slot_of_key[:] = -1
+        self.key_of_slot[:] = -1
+
+    def _views(self):
+        self.data = np.frombuffer(self._buffer, dtype=np.uint8).reshape(self.num_slots, self.slot_nbytes)
+        self.slot_of_key = np.frombuffer(self._slot_of_key, dtype=np.int64)
+        self.key_of_slot = np.frombuffer(self._key_of_slot, dtype=np.int64)
+        self.versions = np.frombuffer(self._versions, dtype=np.int64)
+        self.referenced = np.frombuffer(self._referenced, dtype=np.int8)
+        self.shapes = np.frombuffer(self._shapes, dtype=np.int64).reshape(self.num_slots, MAX_NDIM + 1)
+        self.counters = np.frombuffer(self._counters, dtype=np.int64)
+
+    def _lookup(self, key):
+        """
+        Copy of the cached tile of key, or None. Lock-free: the copy is
+        dropped if the slot was written meanwhile.
+        """
+        slot = self.slot_of_key[key]
+        if slot < 0:
+            return None
+        version = self.versions[slot]
+        if version % 2 or self.key_of_slot[slot] != key:
+            return None
+        ndim = min(int(self.shapes[slot, 0]), MAX_NDIM)
+        shape = tuple(int(n) for n in self.shapes[slot, 1:ndim + 1])
+        tile = self.data[slot, :int(np.prod(shape))].copy()
+        if self.versions[slot] != version or tile.size != int(np.prod(shape)):
+            return None
+        self.referenced[slot] = 1
+        return tile.reshape(shape)
+
+    def _evict(self):
+        """
+        Slot to overwrite: the next slot of the clock hand that was not
+        referenced since the last turn. Call with the lock.
+        """
+        hand = int(self.counters[0])
+        while self.referenced[hand]:
+            self.referenced[hand] = 0
+            hand = (hand + 1) % self.num_slots
+        self.counters[0] = (hand + 1) % self.num_slots
+        return hand
+
+    def get(self, key, loader):
+        """
+        Return a copy of the tile of key, calling loader() to decode it on a miss.
+        """
+        tile = self._lookup(key)
+        if tile is not None:
+            self.counters[1] += 1
+            return tile
+        self.counters[2] += 1
+
+        # decode outside of the lock
+        tile = loader()
+        if tile.dtype != np.uint8 or tile.nbytes > self.slot_nbytes or tile.ndim > MAX_NDIM:
+            return tile
+
+        with self._lock:
+            if self.slot_of_key[key] >= 0: # inserted by another worker
+                return tile
+            slot = self._evict()
+            old_key = self.key_of_slot[slot]
+            if old_key >= 0:
+                self.slot_of_key[old_key] = -1
+            self.versions[slot] += 1
+            self.data[slot, :tile.nbytes] = tile.reshape(-1)
+            self.shapes[slot, 0] = tile.ndim
+            self.shapes[slot, 1:tile.ndim + 1] = tile.shape
+            self.key_of_slot[slot] = key
+            self.versions[slot] += 1
+            self.slot_of_key[key] = slot
+        return tile
+
+    @property
+    def hits(self):
+        return int(self.counters[1])
+
+    @property
+    def misses(self):
+        return int(self.counters[2])
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def stats(self):
+        cached = int(np.count_nonzero(self.key_of_slot >= 0))
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate(),
+            'cached_tiles': cached,
+            'cached_bytes': cached * self.slot_nbytes,
+            'budget_bytes': self.num_slots * self.slot_nbytes
+        }
+
+
+class PartitionedTileCache:
+    """
+    Tile cache of the parts of a dataset item (e.g. mask and image), with one
+    SharedTileCache per distinct part shape. Keys are ints item * len(part_shapes) + part.
+    The budget is split in proportion to the bytes of the parts, so every pool
+    holds the parts of the same number of items.
+    Params:
+        num_keys: number of distinct keys, keys are ints in [0, num_keys)
+        budget_bytes: memory used by the cached tiles of all the pools
+        part_shapes: shape of every part of an item
+    """
+    def __init__(self, num_keys, budget_bytes, part_shapes):
+        self.num_parts = len(part_shapes)
+        shapes = sorted(set(tuple(shape) for shape in part_shapes))
+        item_nbytes = sum(int(np.prod(shape)) for shape in part_shapes)
+        self.pools = []
+        for shape in shapes:
+            pool_nbytes = sum(int(np.prod(s)) for s in part_shapes if tuple(s) == shape)
+            self.pools.append(SharedTileCache(num_keys, budget_bytes * pool_nbytes // item_nbytes, shape))
+        self.pool_of_part = [shapes.index(tuple(shape)) for shape in part_shapes]
+
+    def get(self, key, loader):
+        return self.pools[self.pool_of_part[key % self.num_parts]].get(key, loader)
+
+    @property
+    def hits(self):
+        return sum(pool.hits for pool in self.pools)
+
+    @property
+    def misses(self):
+        return sum(pool.misses for pool in self.pools)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def stats(self):
+        pool_stats = [pool.stats() for pool in self.pools]
+        stats = {name: sum(s[name] for s in pool_stats)
+                 for name in ['hits', 'misses', 'cached_tiles', 'cached_bytes', 'budget_bytes']}
+        stats['hit_rate'] = self.hit_rate()
+        return stats
@@ -0,0 +1,148 @@
+"""
+Persistent tile index for SingleDataset and DoubleDataset. It is built once
+from the label directories and stored as a columnar .npz file with the columns:
+    year, z, x, y: int32
+    label_path, img_path, prev_img_path: bytes (prev_img_path only for double inputs)
+    positive_ratio: float32, ratio of nonzero pixels of the label
+    label_dirs: bytes, 'year mtime_ns' of every indexed label directory
+Loading it avoids globbing every year directory and resolving the image path
+of every tile at startup and in __getitem__.
+"""
+import os
+import glob
+import tempfile
+import multiprocessing
+import numpy as np
+from data_loader import utils
+from utils import is_main_process, barrier
+
+INDEX_VERSION = 3
+
+
+def _positive_ratio(label_path):
+    label = utils.open_image(label_path)
+    return np.count_nonzero(label) / label.size
+
+
+def label_dirs_state(label_dir, years):
+    """
+    Modification time of the label directory of every year, which changes
+    when a tile is added to or removed from the directory. A stat per year,
+    instead of listing the millions of tiles of the directories.
+    """
+    state = []
+    for year in sorted(years):
+        year_dir = os.path.join(label_dir, str(year))
+        if os.path.isdir(year_dir):
+            state.append('%s %d' % (year, os.stat(year_dir).st_mtime_ns))
+        else:
+            state.append('%s 0' % year)
+    return state
+
+
+def build_tile_index(img_dir, label_dir, years, double=False, num_workers=None):
+    """
+    Build the tile index of the labels of label_dir/<year>/* for every year.
+    Params:
+        img_dir: directory of the input raw images (Planet or Landsat)
+        label_dir: directory of the semantic segmentation labels (Hansen)
+        years: list of years
+        double: also resolve the image of the previous year (DoubleDataset)
+    """
+    # before the glob, so that tiles added while building trigger a rebuild
+    state = label_dirs_state(label_dir, years)
+    label_paths = []
+    for year in years:
+        label_paths.extend(glob.glob(os.path.join(label_dir, year, '*')))
+    label_paths.sort()
+
+    index = {name: np.empty(len(label_paths), dtype=np.int32) for name in ['year', 'z', 'x', 'y']}
+    img_paths, prev_img_paths = [], []
+    for i, label_path in enumerate(label_paths):
+        year, z, x, y = utils.get_tile_info(label_path.split('/')[-1])
+        index['year'][i], index['z'][i], index['x'][i], index['y'][i] = year, int(z), int(x), int(y)
+        if double:
+            prev_img_path, img_path = utils.get_img(label_path, img_dir, double=True)
+            prev_img_paths.append(prev_img_path)
+        else:
+            img_path = utils.get_img(label_path, img_dir)
+        img_paths.append(img_path)
+
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        ratios = pool.map(_positive_ratio, label_paths, chunksize=256)
+
+    index['label_path'] = np.array(label_paths, dtype=np.bytes_)
+    index['img_path'] = np.array(img_paths, dtype=np.bytes_)
+    if double:
+        index['prev_img_path'] = np.array(prev_img_paths, dtype=np.bytes_)
+    index['positive_ratio'] = np.array(ratios, dtype=np.float32)
+    index['meta'] = np.array([str(INDEX_VERSION), img_dir, label_dir, str(double)], dtype=np.bytes_)
+    index['label_dirs'] = np.array(state, dtype=np.bytes_)
+    return index
+
+
+def save_tile_index(index, index_path):
+    # write to a unique temporary file then rename, so readers never see a
+    # partial index and concurrent jobs don't write to the same file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), suffix='.tmp.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **index)
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_tile_index(index_path):
+    with np.load(index_path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def _same_source(index, img_dir, label_dir, double):
+    meta = [m.decode() for m in index['meta']]
+    if meta != [str(INDEX_VERSION), img_dir, label_dir, str(double)]:
+        return False
+    state = [s.decode() for s in index['label_dirs']]
+    return state == label_dirs_state(label_dir, [s.split()[0] for s in state])
+
+
+def get_tile_index(index_path, img_dir, label_dir, years, double=False,
+                   min_positive_ratio=0.):
+    """
+    Load the tile index from index_path, building and saving it first if it
+    does not exist, was built for other directories/years or if the label
+    directories changed since. Returns the rows of the given years with
+    positive_ratio >= min_positive_ratio.
+    In distributed training the first process builds the index and the others
+    load it.
+    """
+    if not is_main_process():
+        barrier()
+    try:
+        index = _get_tile_index(index_path, img_dir, label_dir, years, double)
+    finally:
+        if is_main_process():
+            barrier()
+    keep = np.isin(index['year'], [int(year) for year in years])
+    keep &= index['positive_ratio'] >= min_positive_ratio
+    return {name: column[keep] for name, column in index.items() if name not in ('meta', 'label_dirs')}
+
+
+def _get_tile_index(index_path, img_dir, label_dir, years, double):
+    index = load_tile_index(index_path) if os.path.exists(index_path) else None
+    years = [str(year) for year in years]
+    if index is not None and _same_source(index, img_dir, label_dir, double):
+        indexed_years = set(s.decode().split()[0] for s in index['label_dirs'])
+        if not set(years) <= indexed_years:
+            # extend the index with the missing years
+            years_to_build = sorted(indexed_years | set(years))
+            index = None
+    else:
+        years_to_build = years
+        index = None
+    if index is None:
+        print('Building tile index', index_path)
+        index = build_tile_index(img_dir, label_dir, years_to_build, double)
+        save_tile_index(index, index_path)
+    return index
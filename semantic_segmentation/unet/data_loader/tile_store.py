@@ -0,0 +1,111 @@
+"""
+Chunked tile store. Tiles are keyed by (product, year, z, x, y) and stored as
+fixed-size records in a few big chunk files, instead of one file per tile.
+
+Layout of a store:
+    root/<product>/<year>/meta.json      dtype, tile shape and chunk size
+    root/<product>/<year>/index.bin      int64 (z, x, y) rows, in record order
+    root/<product>/<year>/chunk-00000.bin raw tile records
+products are the file prefixes of the directory layout, e.g. fc, fl, ld, pl.
+
+Images are stored as HWC uint8 RGB and masks as HW uint8 binary, i.e. what
+data_loader.utils.open_image returns before scaling.
+This module defines the format and its reader, stores are written by
+data/tile_store.py.
+"""
+import os
+import json
+import numpy as np
+
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.bin'
+CHUNK_FILE = 'chunk-{:05d}.bin'
+
+
+def group_dir(root, product, year):
+    return os.path.join(root, product, str(year))
+
+
+class TileGroup:
+    """
+    Read-only view of the tiles of one (product, year). Chunks are memory
+    mapped lazily, so the object can be created before forking DataLoader workers.
+    """
+    def __init__(self, root, product, year):
+        self.path = group_dir(root, product, year)
+        with open(os.path.join(self.path, META_FILE)) as f:
+            meta = json.load(f)
+        self.dtype = np.dtype(meta['dtype'])
+        self.shape = tuple(meta['shape'])
+        self.chunk_size = meta['chunk_size']
+        self.tile_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        index = np.fromfile(os.path.join(self.path, INDEX_FILE), dtype=np.int64)
+        index = index[:len(index) // 3 * 3].reshape(-1, 3)
+        self.n_tiles = min(len(index), self._stored_tiles())
+        self.index = index[:self.n_tiles]
+        # later records win, so a tile can be rewritten by appending it
+        self.slots = {tuple(key): slot for slot, key in enumerate(self.index.tolist())}
+        self._chunks = {}
+
+    def _stored_tiles(self):
+        n, i = 0, 0
+        while os.path.exists(os.path.join(self.path, CHUNK_FILE.format(i))):
+            n += os.path.getsize(os.path.join(self.path, CHUNK_FILE.format(i))) // self.tile_nbytes
+            i += 1
+        return n
+
+    def _chunk(self, i):
+        chunk = self._chunks.get(i)
+        if chunk is None:
+            count = min(self.chunk_size, self.n_tiles - i * self.chunk_size)
+            chunk = np.memmap(os.path.join(self.path, CHUNK_FILE.format(i)),
+                              dtype=self.dtype, mode='r', shape=(count,) + self.shape)
+            self._chunks[i] = chunk
+        return chunk
+
+    def keys(self):
+        return list(self.slots.keys())
+
+    def __contains__(self, key):
+        return tuple(int(k) for k in key) in self.slots
+
+    def read(self, z, x, y, copy=True):
+        """
+        Return the tile (z, x, y). With copy=False it returns a read-only view
+        of the memory mapped chunk.
+        """
+        slot = self.slots[(int(z), int(x), int(y))]
+        tile = self._chunk(slot // self.chunk_size)[slot % self.chunk_size]
+        return np.array(tile) if copy else tile
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_chunks'] = {}
+        return state
+
+
+class TileStore:
+    """
+    Read access to a tile store, keyed by (product, year, z, x, y).
+    """
+    def __init__(self, root):
+        self.root = root
+        self._groups = {}
+
+    def group(self, product, year):
+        key = (product, str(year))
+        if key not in self._groups:
+            self._groups[key] = TileGroup(self.root, product, year)
+        return self._groups[key]
+
+    def keys(self, product, year):
+        return self.group(product, year).keys()
+
+    def read(self, product, year, z, x, y, copy=True):
+        return self.group(product, year).read(z, x, y, copy)
+
+    def __contains__(self, key):
+        product, year, z, x, y = key
+        if not os.path.exists(os.path.join(group_dir(self.root, product, year), META_FILE)):
+            return False
+        return (z, x, y) in self.group(product, year)
@@ -4,9 +4,25 @@ Module to add helper functions for data_loaders.py
 import torch
 import torchvision
 import os
+import json
 import numpy as np
 import cv2
 
+# Landsat 2013-2015 training stats, used when no stats file is given
+LANDSAT_MEAN = (0.3326, 0.3570, 0.2224)
+LANDSAT_STD = (0.1059, 0.1086, 0.1283)
+
+def load_stats(stats_path=None):
+    """
+    Return the normalization (mean, std) from a json written by
+    data/calculate_stats.py, or the Landsat defaults if stats_path is None.
+    """
+    if stats_path is None:
+        return LANDSAT_MEAN, LANDSAT_STD
+    with open(stats_path) as f:
+        stats = json.load(f)
+    return tuple(stats['mean']), tuple(stats['std'])
+
 def get_immediate_subdirectories(a_dir):
     """Get the immediate subdirectories from a directory
     """
@@ -26,9 +42,12 @@ def get_tile_info(tile):
 
 
 # TODO: put in utils
-def open_image(img_path):
+def open_image(img_path, raw=False):
     """
     Return ndarray from an image of format png or npy
+    Params:
+        raw: return npy images as uint8 in [0, 255] and masks as uint8, as
+            stored in the tile cache (see tile_cache.py)
     """
     filetype = img_path[-3:]
     assert filetype in ['png', 'npy']
@@ -37,10 +56,14 @@ def open_image(img_path):
         if len(img_arr.shape) == 3: # RGB
             if img_arr.shape[0] == 3: # NCHW
                 img_arr = img_arr.transpose([1,2,0])
+            if raw:
+                return np.clip(np.rint(img_arr), 0, 255).astype(np.uint8)
             img_arr = img_arr / 255.
             return img_arr
         elif len(img_arr.shape) == 2: # mask
             # transform to binary mask
+            if raw:
+                return (img_arr != 0).astype(np.uint8)
             nonzero = np.where(img_arr!=0)
             img_arr[nonzero] = 1
             return img_arr
@@ -124,6 +147,40 @@ class Normalize(object):
         return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
 
 
+class ToNormalizedTensor(object):
+    """
+    Convert an image (H, W, C) into a normalized float32 tensor (C, H, W).
+    uint8 images are scaled to [0, 1] first and float images are expected in
+    [0, 1], as with transforms.ToTensor(). It replaces ToTensor + Normalize,
+    which normalize in float64.
+    """
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean, dtype=torch.float32)[:, None, None]
+        self.std = torch.tensor(std, dtype=torch.float32)[:, None, None]
+
+    def __call__(self, img_arr):
+        tensor = torch.from_numpy(np.ascontiguousarray(img_arr)).permute(2, 0, 1)
+        if tensor.dtype == torch.uint8:
+            tensor = tensor.float().div_(255.)
+        else:
+            tensor = tensor.to(torch.float32, copy=True)
+        return tensor.sub_(self.mean).div_(self.std)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(mean={0}, std={1})'.format(
+            self.mean.flatten().tolist(), self.std.flatten().tolist())
+
+
+def normalize_batch(batch, mean, std):
+    """
+    Normalize a uint8 batch (..., C, H, W) into float32. It is meant to run on
+    the device, after transferring the uint8 tensors.
+    """
+    mean = torch.as_tensor(mean, dtype=torch.float32, device=batch.device)[:, None, None]
+    std = torch.as_tensor(std, dtype=torch.float32, device=batch.device)[:, None, None]
+    return (batch.float() / 255. - mean) / std
+
+
 def _is_tensor_image(img):
         return torch.is_tensor(img) and img.ndimension() == 3
 
@@ -0,0 +1,46 @@
+"""
+Export a training checkpoint as a lean inference artifact (see model/artifact.py):
+weights only, optionally in fp16/bf16, with the normalization stats of the
+validation data loader. The scoring scripts load it with --artifact, memory
+mapped, instead of the full checkpoint with its optimizer state.
+It takes following arguments:
+-r full path to the trained model (it expects the config.json next to it)
+--out path of the artifact (default: <model dir>/model_infer.pt)
+--dtype dtype of the stored weights: fp32, fp16 or bf16 (default: fp32)
+--check load the artifact back and report the load latency
+
+Example usage:
+```
+python export_model.py -r path_of_saved_model/model_best.pth --dtype fp16 --check
+python predict_scene.py -r path_of_saved_model/model_best.pth --artifact path_of_saved_model/model_infer.pt --scene landsat2017.vrt --out fc2017.tif
+```
+"""
+import argparse
+import os
+from parse_config import ConfigParser
+from data_loader import utils as data_utils
+from model.artifact import export_artifact, load_artifact, DTYPES
+
+
+def main(config, options):
+    logger = config.get_logger('export')
+    out_path = options.out or os.path.join(str(config.resume.parent), 'model_infer.pt')
+    mean, std = data_utils.load_stats(config['data_loader_val']['args'].get('stats_path'))
+    export_artifact(config.resume, out_path, mean, std, options.dtype)
+    logger.info('Saved {} ({:.1f} MB, checkpoint {:.1f} MB)'.format(
+        out_path, os.path.getsize(out_path) / 2**20, os.path.getsize(str(config.resume)) / 2**20))
+    if options.check:
+        load_artifact(out_path, logger=logger)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Export an inference artifact')
+    args.add_argument('-r', '--resume', default=None, type=str,
+                      help='path to the trained model')
+    args.add_argument('-d', '--device', default=None, type=str,
+                      help='indices of GPUs to enable (default: all)')
+    args.add_argument('--out', default=None, type=str, help='path of the artifact')
+    args.add_argument('--dtype', default='fp32', choices=list(DTYPES), help='dtype of the weights')
+    args.add_argument('--check', action='store_true', help='load the artifact and report the latency')
+    config = ConfigParser(args)
+    main(config, args.parse_args())
@@ -0,0 +1,102 @@
+"""
+Lean inference artifacts exported from training checkpoints. An artifact keeps
+only what scoring needs:
+    arch: {'type', 'args'} of config.json
+    state_dict: the weights, optionally in fp16/bf16, without the DataParallel prefix
+    mean, std: normalization stats of the inputs
+    dtype: dtype of the stored weights
+without the optimizer state and the pickled config of the checkpoints. It is
+written with plain types, so it loads with weights_only=True, and with
+mmap=True the weights are views of the memory mapped file instead of copies.
+See export_model.py
+"""
+import time
+import inspect
+import torch
+import model.model as module_arch
+
+DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def export_artifact(checkpoint_path, out_path, mean, std, dtype='fp32'):
+    """
+    Export the model weights of a training checkpoint as an inference artifact.
+    Params:
+        dtype: 'fp32', 'fp16' or 'bf16'. Floating point weights are cast to it.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    state_dict = {}
+    for key, value in checkpoint['state_dict'].items():
+        if key.startswith('module.'): # saved from DataParallel
+            key = key[len('module.'):]
+        if value.is_floating_point():
+            value = value.to(DTYPES[dtype])
+        state_dict[key] = value.contiguous()
+    arch = checkpoint['config']['arch']
+    artifact = {
+        'arch': {'type': arch['type'], 'args': dict(arch['args'])},
+        'state_dict': state_dict,
+        'mean': [float(m) for m in mean],
+        'std': [float(s) for s in std],
+        'dtype': dtype
+    }
+    torch.save(artifact, out_path)
+    return artifact
+
+
+def _load(path):
+    # mmap and weights_only need torch >= 2.1
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        return torch.load(path, map_location='cpu')
+
+
+def _build(arch):
+    model_cls = getattr(module_arch, arch['type'])
+    args = dict(arch['args'])
+    if 'pretrained' in inspect.signature(model_cls).parameters:
+        # the weights come from the artifact, do not download them
+        args['pretrained'] = False
+    return model_cls, args
+
+
+def load_artifact(path, device='cpu', dtype=torch.float32, logger=None):
+    """
+    Load an inference artifact and return (model, artifact) with the model in
+    eval mode. The modules are created on the meta device and take the memory
+    mapped weights as they are (no random init, no copy) when the torch version
+    and dtype allow it.
+    Params:
+        dtype: dtype of the model, or None to keep the dtype of the artifact
+            (e.g. fp16 on GPU). fp16/bf16 artifacts are cast to fp32 by default.
+    """
+    start = time.time()
+    artifact = _load(path)
+    read_time = time.time() - start
+
+    model_cls, args = _build(artifact['arch'])
+    state_dict = artifact['state_dict']
+    if dtype is not None:
+        state_dict = {key: value.to(dtype) if value.is_floating_point() else value
+                      for key, value in state_dict.items()}
+    model = None
+    if 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters:
+        try:
+            with torch.device('meta'):
+                model = model_cls(**args)
+            model.load_state_dict(state_dict, assign=True)
+            if any(t.is_meta for t in list(model.parameters()) + list(model.buffers())):
+                model = None # non-persistent buffers are not in the state dict
+        except (TypeError, RuntimeError, NotImplementedError):
+            model = None
+    if model is None:
+        model = model_cls(**args)
+        model.load_state_dict(state_dict)
+    model = model.to(device).eval()
+
+    if logger is not None:
+        logger.info('Loaded {} in {:.1f} ms (read {:.1f} ms, build {:.1f} ms)'.format(
+            path, 1000 * (time.time() - start), 1000 * read_time,
+            1000 * (time.time() - start - read_time)))
+    return model, artifact
@@ -5,10 +5,73 @@ import torch
 
 def get_jaccard(y_pred, y_true):
     """
-    Jaccard index
+    Jaccard index, as a 0-dim tensor on the device of y_pred (no host sync)
     """
     epsilon = 1e-15
     intersection = (y_pred * y_true).sum(dim=-2).sum(dim=-1)
     union = y_true.sum(dim=-2).sum(dim=-1) + y_pred.sum(dim=-2).sum(dim=-1)
-    result = ((intersection + epsilon) / (union - intersection + epsilon)).data.cpu().numpy()
-    return np.mean(result)
+    result = ((intersection + epsilon) / (union - intersection + epsilon)).detach()
+    return result.mean()
+
+
+class ConfusionMatrix:
+    """
+    Streaming binary confusion matrices, accumulated on the device of the
+    outputs for several thresholds in one pass. hist()[k] is the matrix of
+    thresholds[k] with the layout of trainer.fast_hist (axis 0: gt,
+    axis 1: prediction), so it can be passed to trainer.evaluate.
+    Params:
+        thresholds: probability thresholds of the predictions
+        target_threshold: threshold of the targets
+    """
+    def __init__(self, thresholds=(0.3,), target_threshold=0.5):
+        self.thresholds = list(thresholds)
+        self.target_threshold = target_threshold
+        self.reset()
+
+    def reset(self):
+        self._hist = None
+
+    def update(self, probs, target):
+        """
+        Add a batch. probs and target are tensors of the same shape, e.g. (N, 1, H, W).
+        It does not synchronize with the device.
+        """
+        probs = probs.detach().reshape(1, -1)
+        gt = target.detach().reshape(-1) > self.target_threshold
+        if self._hist is None:
+            self._hist = torch.zeros(len(self.thresholds), 2, 2, dtype=torch.int64, device=probs.device)
+        thresholds = torch.tensor(self.thresholds, dtype=probs.dtype, device=probs.device)
+        pred = probs > thresholds[:, None] # (thresholds, pixels)
+        true_pos = (pred & gt).sum(dim=1)
+        pred_pos = pred.sum(dim=1)
+        gt_pos = gt.sum()
+        self._hist[:, 1, 1] += true_pos
+        self._hist[:, 0, 1] += pred_pos - true_pos
+        self._hist[:, 1, 0] += gt_pos - true_pos
+        self._hist[:, 0, 0] += gt.numel() - gt_pos - pred_pos + true_pos
+
+    def merge(self, other):
+        if other._hist is not None:
+            if self._hist is None:
+                self._hist = other._hist.clone()
+            else:
+                self._hist += other._hist.to(self._hist.device)
+        return self
+
+    def all_reduce(self, device):
+        """
+        Sum the confusion matrices of all the training processes (see train.py --nproc).
+        """
+        if self._hist is None:
+            self._hist = torch.zeros(len(self.thresholds), 2, 2, dtype=torch.int64, device=device)
+        utils.all_reduce_sum(self._hist)
+        return self
+
+    def hist(self):
+        """
+        Return the (thresholds, 2, 2) confusion matrices as float64 ndarray.
+        """
+        if self._hist is None:
+            return np.zeros((len(self.thresholds), 2, 2))
+        return self._hist.cpu().numpy().astype(np.float64)
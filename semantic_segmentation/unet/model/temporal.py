@@ -0,0 +1,133 @@
+"""
+Vectorized forest loss analytics of timelines of binary forest cover maps.
+The maps of a batch of tiles are stacked as (N, T, H, W) tensors and all the
+years are processed at once on their device: yearly and cumulative loss maps,
+per-year confusion matrices and per-tile areas. The host only receives a few
+numbers per tile and year.
+"""
+import numpy as np
+import torch
+
+
+def yearly_loss(cover):
+    """
+    Forest loss (N, T - 1, H, W) of the cover maps (N, T, H, W): forest in year
+    t and not in year t + 1 (gain is ignored).
+    """
+    cover = cover.bool()
+    return cover[:, :-1] & ~cover[:, 1:]
+
+
+def cumulative_loss(loss):
+    """
+    Forest lost up to every year (N, T', H, W) of the yearly loss maps (N, T', H, W).
+    """
+    return torch.cummax(loss.to(torch.uint8), dim=1)[0].bool()
+
+
+def confusion_per_year(pred, target):
+    """
+    Confusion matrices (T, 2, 2) int64 of the binary maps (N, T, H, W), with
+    the layout of trainer.fast_hist (axis 0: gt, axis 1: prediction).
+    """
+    pred = pred.bool().transpose(0, 1).reshape(pred.shape[1], -1)
+    gt = target.bool().transpose(0, 1).reshape(target.shape[1], -1)
+    true_pos = (pred & gt).sum(dim=1)
+    pred_pos = pred.sum(dim=1)
+    gt_pos = gt.sum(dim=1)
+    true_neg = gt.shape[1] - gt_pos - pred_pos + true_pos
+    return torch.stack([true_neg, pred_pos - true_pos, gt_pos - true_pos, true_pos], dim=1).view(-1, 2, 2)
+
+
+class TimelineAnalytics:
+    """
+    Accumulate the forest cover and forest loss statistics of timelines of
+    predictions against the ground truth.
+    Params:
+        years: names of the T years of the timelines, e.g. ['2013', ..., '2017']
+        pixel_area: area of a pixel in the unit of the table (0.09 ha for Landsat)
+    """
+    def __init__(self, years, pixel_area=1.):
+        self.years = list(years)
+        self.pixel_area = pixel_area
+        self.reset()
+
+    def reset(self):
+        self._hists = None
+        self._tiles = []
+        self._stats = []
+
+    def update(self, pred, target, tiles):
+        """
+        Add a batch. It does not synchronize with the device.
+        Params:
+            pred, target: binary forest cover maps (N, T, H, W), or (N, T, 1, H, W)
+            tiles: keys of the N tiles (e.g. z_x_y), in the first column of the table
+        """
+        if pred.dim() == 5:
+            pred, target = pred.squeeze(2), target.squeeze(2)
+        pred, target = pred.bool(), target.bool()
+        loss_pred, loss_gt = yearly_loss(pred), yearly_loss(target)
+        cumulative_pred, cumulative_gt = cumulative_loss(loss_pred), cumulative_loss(loss_gt)
+
+        hists = [confusion_per_year(pred, target),
+                 confusion_per_year(loss_pred, loss_gt),
+                 confusion_per_year(cumulative_pred, cumulative_gt)]
+        if self._hists is None:
+            self._hists = hists
+        else:
+            self._hists = [total + hist for total, hist in zip(self._hists, hists)]
+
+        # pixel counts per tile: (N, T) cover, (N, T - 1) loss
+        self._stats.append(torch.cat([
+            pred.sum(dim=(2, 3)), target.sum(dim=(2, 3)),
+            loss_pred.sum(dim=(2, 3)), loss_gt.sum(dim=(2, 3)), (loss_pred & loss_gt).sum(dim=(2, 3)),
+            cumulative_pred.sum(dim=(2, 3)), cumulative_gt.sum(dim=(2, 3))], dim=1))
+        self._tiles.extend(tiles)
+
+    def hists(self):
+        """
+        Confusion matrices as float64 ndarrays, to pass to trainer.evaluate:
+            cover: (T, 2, 2) of the forest cover of every year
+            loss: (T - 1, 2, 2) of the loss between years[t] and years[t + 1]
+            cumulative_loss: (T - 1, 2, 2) of the loss from years[0] to years[t + 1]
+        """
+        names = ['cover', 'loss', 'cumulative_loss']
+        if self._hists is None:
+            shapes = [len(self.years), len(self.years) - 1, len(self.years) - 1]
+            return {name: np.zeros((n, 2, 2)) for name, n in zip(names, shapes)}
+        return {name: hist.cpu().numpy().astype(np.float64) for name, hist in zip(names, self._hists)}
+
+    def columns(self):
+        loss_years = ['{}-{}'.format(y0, y1) for y0, y1 in zip(self.years[:-1], self.years[1:])]
+        return (['cover_{}'.format(y) for y in self.years] +
+                ['cover_gt_{}'.format(y) for y in self.years] +
+                ['loss_{}'.format(y) for y in loss_years] +
+                ['loss_gt_{}'.format(y) for y in loss_years] +
+                ['loss_tp_{}'.format(y) for y in loss_years] +
+                ['cumulative_loss_{}'.format(y) for y in loss_years] +
+                ['cumulative_loss_gt_{}'.format(y) for y in loss_years])
+
+    def table(self):
+        """
+        Per-tile areas (tiles, len(columns())) as float64 ndarray, in the order of the updates.
+        """
+        if not self._stats:
+            return np.zeros((0, len(self.columns())))
+        return torch.cat(self._stats).cpu().numpy().astype(np.float64) * self.pixel_area
+
+    def area_stats(self):
+        """
+        Total areas of all the tiles, {column: area}.
+        """
+        return dict(zip(self.columns(), self.table().sum(axis=0).tolist()))
+
+    def save_table(self, path):
+        """
+        Write the per-tile table as csv, with the tile keys in the first column.
+        """
+        table = self.table()
+        with open(path, 'w') as f:
+            f.write(','.join(['tile'] + self.columns()) + '\n')
+            for tile, row in zip(self._tiles, table):
+                f.write(','.join([str(tile)] + ['{:g}'.format(v) for v in row]) + '\n')
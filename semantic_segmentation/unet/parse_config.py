@@ -34,6 +34,10 @@ A config json consists of:
         `e.g. min val_loss` saves the model that has minimal validation loss as model_best.pth
     - early_stop: number of epochs to check - if validation didn't improved it stops
     - tensorboard: boolean - whether to use tensorboard
+    - output_thresholds: (optional) extra probability thresholds of the validation metrics, logged as `<metric>@<threshold>`
+    - amp: (optional) mixed precision: false (default), true (bf16 on CPU, fp16 on GPU), "bf16" or "fp16"
+    - channels_last: (optional) boolean - channels-last memory format for the model and inputs
+    - sync_every: (optional) reduce and log the training loss/metrics every n steps (default: 1)
 """
 
 
@@ -0,0 +1,210 @@
+"""
+Scene-level inference for the binary segmentation models.
+It reads a window of arbitrary size of a mosaic (e.g. a GeoTIFF or VRT of the
+annual Landsat mosaic), runs the model on overlapping windows in batches, blends
+the seams with a linear taper and writes one georeferenced raster, instead of
+one prediction file per 256x256 tile.
+It takes following arguments:
+-r full path to the trained model (it expects the config.json next to it)
+-d specifies the GPU ids to be used
+--scene mosaic of the year to predict (RGB uint8 in bands 1-3)
+--prev_scene mosaic of the previous year, for the models with 2 input images (6 channels)
+--out output raster: forest cover or forest loss, depending on the model
+--window col_off row_off width height of the scene window (default: full scene)
+--tile size of the windows given to the model, multiple of 32 (default: 512)
+--overlap overlap between windows (default: 64)
+--bs windows per batch (default: 8)
+--probs write the probabilities as float32 instead of the binary mask
+--artifact inference artifact of the model (see export_model.py), loaded instead of the checkpoint
+
+The models are fully convolutional, so windows larger than the 256x256 training
+tiles are used. The encoder work recomputed along the borders is then only the
+overlap, instead of the whole tile.
+Rows are processed as a band of windows at a time: the blended rows that no
+later window touches are written out, so the memory does not depend on the height
+of the scene.
+
+Example usage:
+```
+python predict_scene.py -r path_of_saved_model/model.pth --scene landsat2017.vrt --out fc2017.tif
+python predict_scene.py -r path_of_loss_model/model.pth --prev_scene landsat2016.vrt --scene landsat2017.vrt --out fl2017.tif
+```
+"""
+import argparse
+import time
+import numpy as np
+import torch
+import rasterio
+from rasterio.windows import Window
+import model.model as module_arch
+from parse_config import ConfigParser
+from data_loader import utils as data_utils
+from model.artifact import load_artifact
+from utils import load_model_state
+
+OUTPUT_THRESHOLD = 0.3
+
+def taper_weights(tile, overlap):
+    """
+    Blending weights (tile, tile) of a window: 1 in the center, decreasing
+    linearly to 0 (excluded) over the overlap at the borders.
+    """
+    ramp = np.minimum(np.arange(tile) + 1, np.arange(tile)[::-1] + 1).astype(np.float32)
+    ramp = np.minimum(ramp / max(overlap, 1), 1.)
+    return np.outer(ramp, ramp)
+
+def window_offsets(size, tile, stride):
+    """
+    Offsets of the windows covering [0, size). The last one is aligned with the end.
+    """
+    offsets = list(range(0, max(size - tile, 0) + 1, stride))
+    if offsets[-1] + tile < size:
+        offsets.append(size - tile)
+    return offsets
+
+def read_band(srcs, window, row, height, width, mean, std):
+    """
+    Read rows [row, row + height) and columns [0, width) of the window of every
+    source and return them normalized as a float32 array (channels, height, width).
+    Pixels outside of the scene are 0.
+    """
+    band = []
+    for src in srcs:
+        img = src.read([1, 2, 3], boundless=True, fill_value=0, window=Window(
+            window.col_off, window.row_off + row, width, height))
+        img = img.astype(np.float32) / 255.
+        img -= np.asarray(mean, dtype=np.float32)[:, None, None]
+        img /= np.asarray(std, dtype=np.float32)[:, None, None]
+        band.append(img)
+    return np.concatenate(band, axis=0)
+
+def predict_windows(model, windows, device):
+    """
+    Run the model on a batch of windows (N, C, tile, tile) and return the
+    probabilities (N, tile, tile).
+    """
+    data = torch.from_numpy(np.stack(windows)).to(device)
+    with torch.no_grad():
+        probs = torch.sigmoid(model(data))
+    return probs[:, 0].cpu().numpy()
+
+def predict_scene(model, srcs, window, dst, mean, std, device, tile=512, overlap=64,
+                  batch_size=8, threshold=OUTPUT_THRESHOLD):
+    """
+    Predict a window of the scene and write it into dst (same size as the window).
+    Params:
+        srcs: open rasterio datasets, [prev_scene, scene] or [scene]
+        window: rasterio Window of the scene
+        dst: open rasterio dataset to write. If threshold is None the
+            probabilities are written, otherwise the binary mask.
+    """
+    assert tile % 32 == 0, 'tile must be a multiple of 32'
+    height, width = int(window.height), int(window.width)
+    stride = tile - overlap
+    weights = taper_weights(tile, overlap)
+    rows = window_offsets(height, tile, stride)
+    cols = window_offsets(width, tile, stride)
+    padded_width = max(width, tile)
+
+    # blended rows [buffer_row, buffer_row + len(acc)) not written yet
+    acc = np.zeros((0, padded_width), dtype=np.float32)
+    acc_weights = np.zeros((0, padded_width), dtype=np.float32)
+    buffer_row = 0
+    start = time.time()
+    for i, row in enumerate(rows):
+        band = read_band(srcs, window, row, tile, padded_width, mean, std)
+        missing = row + tile - (buffer_row + len(acc))
+        if missing > 0:
+            acc = np.concatenate([acc, np.zeros((missing, padded_width), dtype=np.float32)])
+            acc_weights = np.concatenate([acc_weights, np.zeros((missing, padded_width), dtype=np.float32)])
+        top = row - buffer_row
+        for j in range(0, len(cols), batch_size):
+            batch_cols = cols[j:j + batch_size]
+            probs = predict_windows(model, [band[:, :, col:col + tile] for col in batch_cols], device)
+            for col, prob in zip(batch_cols, probs):
+                acc[top:top + tile, col:col + tile] += prob * weights
+                acc_weights[top:top + tile, col:col + tile] += weights
+
+        # rows before the next window row are final
+        done = (rows[i + 1] if i + 1 < len(rows) else height) - buffer_row
+        done = min(done, height - buffer_row)
+        if done > 0:
+            out = acc[:done, :width] / np.maximum(acc_weights[:done, :width], 1e-6)
+            if threshold is not None:
+                out = (out > threshold).astype(np.uint8)
+            dst.write(out[None].astype(dst.dtypes[0]), window=Window(0, buffer_row, width, done))
+            acc, acc_weights = acc[done:], acc_weights[done:]
+            buffer_row += done
+        print('{}/{} rows, {:.2f} Mpixel/s'.format(
+            buffer_row, height, buffer_row * width / 1e6 / (time.time() - start)))
+
+def main(config, options):
+    logger = config.get_logger('predict_scene')
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if options.threads is not None:
+        torch.set_num_threads(options.threads)
+
+    if options.artifact is not None:
+        model, artifact = load_artifact(options.artifact, device, logger=logger)
+        mean, std = artifact['mean'], artifact['std']
+    else:
+        model = config.initialize('arch', module_arch)
+        logger.info('Loading checkpoint: {} ...'.format(config.resume))
+        checkpoint = torch.load(config.resume, map_location='cpu')
+        if config['n_gpu'] > 1:
+            model = torch.nn.DataParallel(model)
+        load_model_state(model, checkpoint['state_dict'])
+        model = model.to(device)
+        model.eval()
+        mean, std = data_utils.load_stats(config['data_loader_val']['args'].get('stats_path'))
+
+    scene_paths = [options.scene] if options.prev_scene is None else [options.prev_scene, options.scene]
+    srcs = [rasterio.open(path) for path in scene_paths]
+    src = srcs[-1]
+    if options.window is not None:
+        window = Window(*options.window)
+    else:
+        window = Window(0, 0, src.width, src.height)
+
+    profile = {
+        'driver': 'GTiff',
+        'height': int(window.height),
+        'width': int(window.width),
+        'count': 1,
+        'dtype': 'float32' if options.probs else 'uint8',
+        'crs': src.crs,
+        'transform': src.window_transform(window),
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'deflate'
+    }
+    with rasterio.open(options.out, 'w', **profile) as dst:
+        predict_scene(model, srcs, window, dst, mean, std, device, options.tile,
+                      options.overlap, options.bs, None if options.probs else options.threshold)
+    for src in srcs:
+        src.close()
+    logger.info('Saved {}'.format(options.out))
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Predict a whole scene with a segmentation model')
+    args.add_argument('-r', '--resume', default=None, type=str,
+                      help='path to the trained model')
+    args.add_argument('-d', '--device', default=None, type=str,
+                      help='indices of GPUs to enable (default: all)')
+    args.add_argument('--scene', required=True, type=str, help='mosaic of the year to predict')
+    args.add_argument('--prev_scene', default=None, type=str,
+                      help='mosaic of the previous year, for 2 input images models')
+    args.add_argument('--out', required=True, type=str, help='output GeoTIFF')
+    args.add_argument('--window', nargs=4, default=None, type=int,
+                      help='col_off row_off width height (default: full scene)')
+    args.add_argument('--tile', default=512, type=int, help='window size, multiple of 32')
+    args.add_argument('--overlap', default=64, type=int, help='overlap between windows')
+    args.add_argument('--bs', default=8, type=int, help='windows per batch')
+    args.add_argument('--threshold', default=OUTPUT_THRESHOLD, type=float)
+    args.add_argument('--probs', action='store_true', help='write float32 probabilities')
+    args.add_argument('--threads', default=None, type=int, help='torch threads')
+    args.add_argument('--artifact', default=None, type=str,
+                      help='inference artifact, loaded instead of the checkpoint')
+    config = ConfigParser(args)
+    main(config, args.parse_args())
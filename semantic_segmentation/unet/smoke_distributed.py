@@ -0,0 +1,124 @@
+"""
+Smoke test of distributed training (train.py --nproc) on CPU with gloo.
+It trains a tiny model on random tiles in 2 processes, then checks that:
+    - the validation shards of the processes cover every tile exactly once
+    - the checkpoint has no 'module.' prefix and loads into a plain and a
+      DataParallel model
+    - the checkpoint resumes in 2 processes
+It takes a few seconds and needs no data nor GPU. Run it from unet/:
+```
+python smoke_distributed.py
+```
+"""
+import os
+import argparse
+import tempfile
+from pathlib import Path
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+from torch.utils.data import TensorDataset
+from base import BaseDataLoader
+from model.loss import LossBinary
+from model.metric import get_jaccard
+from parse_config import ConfigParser
+from logger import setup_logging
+from trainer import Trainer
+from utils import init_distributed, cleanup_distributed, all_reduce_sum, load_model_state, write_json
+
+NPROC = 2
+# uneven shards: 11 validation tiles are 6 and 5 tiles, 3 and 2 batches
+NUM_TRAIN, NUM_VAL, BATCH_SIZE, SIZE = 16, 11, 2, 16
+
+
+class TinyNet(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(3, 1, 3, padding=1)
+        self.bn = nn.BatchNorm2d(1)
+
+    def forward(self, x):
+        return self.bn(self.conv(x))
+
+
+def random_tiles(num, seed):
+    generator = torch.Generator().manual_seed(seed)
+    imgs = torch.rand(num, 3, SIZE, SIZE, generator=generator)
+    masks = (torch.rand(num, 1, SIZE, SIZE, generator=generator) > 0.5).float()
+    return TensorDataset(imgs, masks)
+
+
+def get_config(config_path=None, resume=None):
+    args = argparse.ArgumentParser()
+    args.add_argument('-c', '--config', default=config_path, type=str)
+    args.add_argument('-r', '--resume', default=resume, type=str)
+    args.add_argument('-d', '--device', default=None, type=str)
+    return ConfigParser(args, [])
+
+
+def worker(rank, world_size, config):
+    setup_logging(config.log_dir)
+    init_distributed(rank, world_size, 'gloo')
+    try:
+        data_loader = BaseDataLoader(random_tiles(NUM_TRAIN, 0), BATCH_SIZE, True, 0, 0)
+        # shuffled like data_loader_val of the configs
+        valid_data_loader = BaseDataLoader(random_tiles(NUM_VAL, 1), BATCH_SIZE, True, 0, 0,
+                                           distributed_eval=True)
+        val_indices = torch.zeros(NUM_VAL)
+        val_indices[list(valid_data_loader.sampler)] += 1
+        all_reduce_sum(val_indices)
+        assert (val_indices == 1).all(), 'validation shards do not cover every tile once'
+
+        model = TinyNet()
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        trainer = Trainer(model, LossBinary(jaccard_weight=0), [get_jaccard], optimizer,
+                          config=config,
+                          data_loader=data_loader,
+                          valid_data_loader=valid_data_loader)
+        trainer.train()
+    finally:
+        cleanup_distributed()
+
+
+def train(config):
+    mp.spawn(worker, args=(NPROC, config), nprocs=NPROC)
+    return config.save_dir / 'checkpoint-epoch{}.pth'.format(config['trainer']['epochs'])
+
+
+def main():
+    out_dir = tempfile.mkdtemp(prefix='smoke_distributed_')
+    os.environ.setdefault('MASTER_PORT', '29501')
+    config_path = os.path.join(out_dir, 'config.json')
+    write_json({
+        'name': 'smoke_distributed',
+        'n_gpu': 0,
+        'arch': {'type': 'TinyNet', 'args': {}},
+        'optimizer': {'type': 'Adam', 'args': {'lr': 1e-3}},
+        'trainer': {
+            'epochs': 2,
+            'save_dir': out_dir,
+            'save_period': 1,
+            'verbosity': 2,
+            'keep_last': 2,
+            'monitor': 'min val_loss',
+            'early_stop': 10,
+            'tensorboard': False,
+            'channels_last': True
+        }
+    }, Path(config_path))
+
+    checkpoint_path = train(get_config(config_path=config_path))
+    state_dict = torch.load(checkpoint_path, map_location='cpu')['state_dict']
+    assert not any(key.startswith('module.') for key in state_dict), 'checkpoint saved with the module. prefix'
+    load_model_state(TinyNet(), state_dict)
+    load_model_state(nn.DataParallel(TinyNet()), state_dict)
+
+    # resume in 2 processes, for one more epoch
+    config = get_config(resume=str(checkpoint_path))
+    config.config['trainer']['epochs'] = 3
+    train(config)
+    print('distributed smoke test passed, outputs in {}'.format(out_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,19 @@ Main entry point for the binary segmentation task.
 It takes following arguments:
 -r full path to the trained model
 -d specifies the GPU ids to be used (it takes max n_gpus defined in config.json)
+--bs batch size (default: 32)
+--workers number of data loader workers (default: number of cpus)
+--writers number of threads that save the predictions (default: 4)
+--threads number of torch threads for the forward pass (default: torch default)
+--metrics compute the loss and the binary segmentation metrics (on the device)
+--thresholds probability thresholds of the metrics (default: 0.3)
+--render save the input/gt/prediction figures (in a process pool, see utils/render.py)
+--no_save do not save the predictions
+--artifact inference artifact of the model (see export_model.py), loaded instead of the checkpoint
+
+The model runs on large batches. Saving, metrics and rendering are handed off
+to pools, so they stay off the model's critical path.
+Predictions are saved as uint8 prediction_{i}.npy in <model dir>/<landsat|planet|pix2pix>/predictions
 
 Note: if the model was trained on n GPU, the testing is expecting n GPU.
 Note2: in the path_of_saved_model directory, it expects a config.json
@@ -10,7 +23,7 @@ Note2: in the path_of_saved_model directory, it expects a config.json
 
 Example usage:
 ```
-python test.py -r path_of_saved_model/model.pth -d [gpu_id,]
+python test.py -r path_of_saved_model/model.pth -d [gpu_id,] --bs 64 --metrics
 ```
 """
 import argparse
@@ -18,15 +31,21 @@ import torch
 import os
 import numpy as np
 from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import DataLoader
 import data_loader.data_loaders as module_data
 import model.loss as module_loss
 import model.metric as module_metric
 import model.model as module_arch
+from model.artifact import load_artifact
 import time
 from parse_config import ConfigParser
-from trainer import evaluate, fast_hist, threshold_outputs
-from utils.util import save_simple_images, save_double_images
-from torch.nn import functional as F
+from trainer import evaluate
+from utils.render import RenderService, tile_panels
+from utils import load_model_state
+
+OUTPUT_THRESHOLD = 0.3
 
 def get_output_dir(img_dir):
     """
@@ -52,100 +71,125 @@ def create_loss(fc0, fc1):
     fl0[gain_mask] = 0
     return fl0
 
-def main(config):
+def save_predictions(preds, out_dir, idx_start):
+    """
+    Save the binary predictions (N, H, W) of a batch, one uint8 .npy per tile.
+    """
+    for j, pred in enumerate(preds):
+        np.save(os.path.join(out_dir, 'prediction_{}.npy'.format(idx_start + j)), pred)
+
+def drain(pending, max_pending):
+    """
+    Wait for the oldest tasks until at most max_pending are in flight, so the
+    pools do not pile up batches. It re-raises the errors of the tasks.
+    """
+    while len(pending) > max_pending:
+        pending.popleft().result()
+
+def get_data_loader(config, batch_size, num_workers, pin_memory):
+    """
+    Build the dataset of data_loader_val and a prefetching loader over it.
+    """
+    loader_args = dict(config['data_loader_val']['args'])
+    loader_args.update(batch_size=batch_size, shuffle=False, num_workers=0)
+    dataset = getattr(module_data, config['data_loader_val']['type'])(**loader_args).dataset
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                      num_workers=num_workers, pin_memory=pin_memory)
+
+def main(config, options):
     logger = config.get_logger('test')
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if options.threads is not None:
+        torch.set_num_threads(options.threads)
+    num_workers = options.workers if options.workers is not None else os.cpu_count()
     # setup data_loader instances
-    batch_size = 1
-    if config['data_loader_val']['args']['max_dataset_size'] == 'inf':
-        max_dataset_size = float('inf')
-    else:
-        max_dataset_size = config['data_loader_val']['args']['max_dataset_size']
-    data_loader = getattr(module_data, config['data_loader_val']['type'])(
-        img_dir=config['data_loader_val']['args']['img_dir'],
-        label_dir=config['data_loader_val']['args']['label_dir'],
-        batch_size=batch_size,
-        years=config['data_loader_val']['args']['years'],
-        max_dataset_size=max_dataset_size,
-        shuffle=False,
-        num_workers=1,
-    )
-    landsat_mean, landsat_std = (0.3326, 0.3570, 0.2224), (0.1059, 0.1086, 0.1283)
-    # build model architecture
-    model = config.initialize('arch', module_arch)
-    logger.info(model)
-
+    batch_size = options.bs
+    data_loader = get_data_loader(config, batch_size, num_workers, device.type == 'cuda')
+    landsat_mean, landsat_std = data_loader.dataset.mean, data_loader.dataset.std
     # get function handles of loss and metrics
     loss_fn = config.initialize('loss', module_loss)
     # loss_fn = getattr(module_loss, config['loss'])
-    metric_fns = [getattr(module_metric, met) for met in config['metrics']]
 
-    logger.info('Loading checkpoint: {} ...'.format(config.resume))
-    checkpoint = torch.load(config.resume)
-    state_dict = checkpoint['state_dict']
-    if config['n_gpu'] > 1:
-        model = torch.nn.DataParallel(model)
-    model.load_state_dict(state_dict)
+    if options.artifact is not None:
+        model, _ = load_artifact(options.artifact, device, logger=logger)
+    else:
+        # build model architecture
+        model = config.initialize('arch', module_arch)
+        logger.info(model)
 
-    # prepare model for testing
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model = model.to(device)
-    model.eval()
+        logger.info('Loading checkpoint: {} ...'.format(config.resume))
+        checkpoint = torch.load(config.resume, map_location='cpu')
+        state_dict = checkpoint['state_dict']
+        if config['n_gpu'] > 1:
+            model = torch.nn.DataParallel(model)
+        load_model_state(model, state_dict)
+
+        # prepare model for testing
+        model = model.to(device)
+        model.eval()
 
-    total_loss = 0.0
-    total_metrics = torch.zeros(len(metric_fns))
     pred_dir = '/'.join(str(config.resume.absolute()).split('/')[:-1])
     out_dir = os.path.join(pred_dir, get_output_dir(config['data_loader_val']['args']['img_dir']))
-
-    if not os.path.isdir(pred_dir):
-        os.makedirs(pred_dir)
-    if not os.path.isdir(out_dir):
-        os.makedirs(out_dir)
-
-    hist = np.zeros((2,2))
+    predictions_dir = os.path.join(out_dir, 'predictions')
+    os.makedirs(predictions_dir, exist_ok=True)
+
+    writer = ThreadPoolExecutor(max_workers=options.writers)
+    renderer = RenderService(options.writers) if options.render else None
+    pending = deque()
+    confusion = module_metric.ConfusionMatrix(options.thresholds, OUTPUT_THRESHOLD)
+    total_loss = torch.zeros((), device=device)
+    n_samples = 0
+    start = time.time()
     with torch.no_grad():
-        for i, batch in enumerate(tqdm(data_loader)):
-        # for i, (data, target) in enumerate(tqdm(data_loader)):
-            init_time = time.time()
-            loss = None
-            data, target = batch
-            udata = normalize_inverse(data, landsat_mean, landsat_std)
-
-            data, target = data.to(device, dtype=torch.float), target.to(device, dtype=torch.float)
-            output = model(data)
-
-            output_probs = F.sigmoid(output)
-            binary_target = threshold_outputs(target.data.cpu().numpy().flatten())
-            output_binary = threshold_outputs(
-                output_probs.data.cpu().numpy().flatten())
-
-            np.save('planet_prediction_{}.npy'.format(i), output_binary.reshape(-1,1,256,256)[0,0,:,:])
-            # print(output_binary.shape, 'SHAPEEE')
-            hist += fast_hist(output_binary, binary_target)
-            images = {
-                'img': udata.cpu().numpy(),
-                'gt': target.cpu().numpy(),
-                'pred': output_binary.reshape(-1, 1, 256, 256),
+        for i, (data, target) in enumerate(tqdm(data_loader)):
+            idx_start = n_samples
+            n_samples += data.shape[0]
+            output = model(data.to(device, dtype=torch.float, non_blocking=True))
+            output_probs = torch.sigmoid(output)
+            preds = (output_probs > OUTPUT_THRESHOLD).to(torch.uint8)
+            if not options.no_save or renderer is not None:
+                # to the host only for the writers and the renderers
+                preds = preds.squeeze(1).cpu().numpy()
+
+            if not options.no_save:
+                pending.append(writer.submit(save_predictions, preds, predictions_dir, idx_start))
+            if options.metrics:
+                # computing loss and confusion matrices on the device
+                target_device = target.to(device, dtype=torch.float, non_blocking=True)
+                total_loss += loss_fn(output, target_device).detach() * data.shape[0]
+                confusion.update(output_probs, target_device)
+            if renderer is not None:
+                img = normalize_inverse(data, landsat_mean, landsat_std).clamp_(0, 1)
+                images = {
+                    # single images (C=3) or double images (C=6), uint8 to the render processes
+                    'img': img.mul_(255).round_().to(torch.uint8).numpy(),
+                    'gt': target.numpy(),
+                    'pred': preds[:, None],
+                }
+                renderer.submit(tile_panels, images, out_dir, idx_start)
+            drain(pending, 4 * options.writers)
+
+    drain(pending, 0)
+    writer.shutdown()
+    if renderer is not None:
+        renderer.close()
+        logger.info('Rendered {} figures'.format(renderer.n_files))
+    if device.type == 'cuda':
+        # with --no_save nothing waited for the last batches
+        torch.cuda.synchronize()
+    elapsed = time.time() - start
+    logger.info('{} tiles in {:.1f}s, {:.1f} tiles/s'.format(n_samples, elapsed, n_samples / elapsed))
+
+    if options.metrics:
+        # Update binary segmentation metrics
+        for threshold, hist in zip(options.thresholds, confusion.hist()):
+            acc, acc_cls, mean_iu, fwavacc, precision, recall, f1_score = \
+                evaluate(hist=hist)
+            log = {'loss': total_loss.item() / n_samples, 'threshold': threshold,
+                'acc': acc, 'mean_iu': mean_iu, 'fwavacc': fwavacc,
+                'precision': precision, 'recall': recall, 'f1_score': f1_score
             }
-
-            # Save single images (C=3) or double images (C=6)
-            if images['img'].shape[1] == 3:
-                save_simple_images(3, images, out_dir, i*batch_size)
-            else:
-                save_double_images(3, images, out_dir, i*batch_size)
-            # computing loss, metrics on test set
-            loss = loss_fn(output, target)
-            batch_size = data.shape[0]
-            total_loss += loss.item() * batch_size
-
-    # Update binary segmentation metrics
-    acc, acc_cls, mean_iu, fwavacc, precision, recall, f1_score = \
-        evaluate(hist=hist)
-    n_samples = len(data_loader.sampler)
-    log = {'loss': total_loss / n_samples,
-        'acc': acc, 'mean_iu': mean_iu, 'fwavacc': fwavacc,
-        'precision': precision, 'recall': recall, 'f1_score': f1_score
-    }
-    logger.info(log)
+            logger.info(log)
 
 def normalize_inverse(batch, mean, std):
     """
@@ -155,19 +199,11 @@ def normalize_inverse(batch, mean, std):
         :param std: tensor of shape (3,)
     """
     with torch.no_grad():
-        img = batch.clone()
-        ubatch = torch.Tensor(batch.shape)
-        if img.shape[1] == 3: # 1 image
-            ubatch[:, 0, :, :] = img[:, 0, :, :] * std[0] + mean[0]
-            ubatch[:, 1, :, :] = img[:, 1, :, :] * std[1] + mean[1]
-            ubatch[:, 2, :, :] = img[:, 2, :, :] * std[2] + mean[2]
-        else: # 2 input images
-            ubatch[:, 0, :, :] = img[:, 0, :, :] * std[0] + mean[0]
-            ubatch[:, 1, :, :] = img[:, 1, :, :] * std[1] + mean[1]
-            ubatch[:, 2, :, :] = img[:, 2, :, :] * std[2] + mean[2]
-            ubatch[:, 3, :, :] = img[:, 3, :, :] * std[0] + mean[0]
-            ubatch[:, 4, :, :] = img[:, 4, :, :] * std[1] + mean[1]
-            ubatch[:, 5, :, :] = img[:, 5, :, :] * std[2] + mean[2]
+        # 1 or 2 input images, the channels repeat every 3
+        n_images = batch.shape[1] // 3
+        mean = torch.tensor(mean, dtype=batch.dtype).repeat(n_images)[None, :, None, None]
+        std = torch.tensor(std, dtype=batch.dtype).repeat(n_images)[None, :, None, None]
+        ubatch = batch * std + mean
     return ubatch
 
 if __name__ == '__main__':
@@ -177,5 +213,19 @@ if __name__ == '__main__':
                       help='path to latest checkpoint (default: None)')
     args.add_argument('-d', '--device', default=None, type=str,
                       help='indices of GPUs to enable (default: all)')
+    args.add_argument('--bs', default=32, type=int, help='batch size (default: 32)')
+    args.add_argument('--workers', default=None, type=int,
+                      help='data loader workers (default: number of cpus)')
+    args.add_argument('--writers', default=4, type=int,
+                      help='threads that save the predictions (default: 4)')
+    args.add_argument('--threads', default=None, type=int,
+                      help='torch threads for the forward pass (default: torch default)')
+    args.add_argument('--metrics', action='store_true', help='compute loss and metrics')
+    args.add_argument('--thresholds', nargs='+', default=[OUTPUT_THRESHOLD], type=float,
+                      help='probability thresholds of the metrics (default: 0.3)')
+    args.add_argument('--render', action='store_true', help='save input/gt/prediction figures')
+    args.add_argument('--no_save', action='store_true', help='do not save the predictions')
+    args.add_argument('--artifact', default=None, type=str,
+                      help='inference artifact, loaded instead of the checkpoint')
     config = ConfigParser(args)
-    main(config)
+    main(config, args.parse_args())
@@ -4,10 +4,17 @@ It takes following arguments:
 -c flag takes in the path to config.json
 -d specifies the GPU ids to be used (it takes max n_gpus defined in config.json)
 -r continues training from most recent checkpoint from a previous experiment (specify path to timestamp)
+--nproc number of training processes (DistributedDataParallel, default: 1)
+--backend distributed backend: gloo (CPU or GPU) or nccl (GPU)
+
+With --nproc > 1 every process trains on its shard of the data (one GPU per
+process, or CPU with gloo). Only the first process logs, writes to tensorboard
+and saves checkpoints. smoke_distributed.py checks this mode on CPU.
 
 Example usage:
 ```
 python train.py -c config.json -d [gpu_id,] -r path_of_saved_model 
+python train.py -c config.json --nproc 4 --backend gloo
 ```
 
 """
@@ -16,12 +23,15 @@ import time
 import argparse
 import collections
 import torch
+import torch.multiprocessing as mp
 import data_loader.data_loaders as module_data
 import model.loss as module_loss
 import model.metric as module_metric
 import model.model as module_arch
 from parse_config import ConfigParser
 from trainer import Trainer
+from logger import setup_logging
+from utils import init_distributed, cleanup_distributed
 # from data_loader.data_loaders import PlanetDataLoader
 
 
@@ -29,7 +39,8 @@ def main(config):
     logger = config.get_logger('train')
     # setup data_loader instances
     data_loader = config.initialize('data_loader_train', module_data)
-    valid_data_loader = config.initialize('data_loader_val', module_data)
+    # unpadded validation shards in distributed training, see BaseDataLoader
+    valid_data_loader = config.initialize('data_loader_val', module_data, distributed_eval=True)
     # valid_data_loader = data_loader.split_validation()
 
     # build model architecture, then print to console
@@ -53,7 +64,17 @@ def main(config):
                       valid_data_loader=valid_data_loader,
                       lr_scheduler=lr_scheduler)
     trainer.train()
-    _wait()
+
+def main_worker(rank, world_size, backend, config):
+    """
+    Entry point of a training process of distributed training.
+    """
+    setup_logging(config.log_dir)
+    init_distributed(rank, world_size, backend)
+    try:
+        main(config)
+    finally:
+        cleanup_distributed()
 
 def _wait():
     # dirty trick to reserve GPUs on spaceml, hahahaha
@@ -75,5 +96,14 @@ if __name__ == '__main__':
         CustomArgs(['--lr', '--learning_rate'], type=float, target=('optimizer', 'args', 'lr')),
         CustomArgs(['--bs', '--batch_size'], type=int, target=('data_loader', 'args', 'batch_size'))
     ]
+    args.add_argument('--nproc', default=1, type=int,
+                      help='number of training processes (default: 1)')
+    args.add_argument('--backend', default='gloo', choices=['gloo', 'nccl'],
+                      help='distributed backend (default: gloo)')
     config = ConfigParser(args, options)
-    main(config)
+    cli_args = args.parse_args()
+    if cli_args.nproc > 1:
+        mp.spawn(main_worker, args=(cli_args.nproc, cli_args.backend, config), nprocs=cli_args.nproc)
+    else:
+        main(config)
+        _wait()
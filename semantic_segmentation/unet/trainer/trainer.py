@@ -2,12 +2,14 @@
 Main training engine used to train the models.
 """
 import time
+import contextlib
 import numpy as np
 import torch
-from torch.nn import functional as F
 from torchvision.utils import make_grid
+from torch.nn.parallel import DistributedDataParallel
 from base import BaseTrainer
-from utils import inf_loop
+from model.metric import ConfusionMatrix
+from utils import inf_loop, all_reduce_sum
 
 
 class Trainer(BaseTrainer):
@@ -22,6 +24,8 @@ class Trainer(BaseTrainer):
         super().__init__(model, loss, metrics, optimizer, config)
         self.config = config
         self.data_loader = data_loader
+        # DistributedSampler in distributed training, reshuffled every epoch
+        self.train_sampler = data_loader.sampler
         if len_epoch is None:
             # epoch-based training
             self.len_epoch = len(self.data_loader)
@@ -35,22 +39,47 @@ class Trainer(BaseTrainer):
         self.log_step = int(np.sqrt(data_loader.batch_size))
         self.save_train_img_step = self.log_step * 4
 
-        # Binarize NN output
+        # Binarize NN output. Metrics of the other thresholds are logged as <metric>@<threshold>
         self.output_threshold = 0.3
+        self.output_thresholds = [self.output_threshold] + [
+            t for t in config['trainer'].get('output_thresholds', []) if t != self.output_threshold]
+
+        # Performance mode, see parse_config.py
+        # (channels_last is applied to the model by BaseTrainer, before the DDP wrap)
+        cfg_trainer = config['trainer']
+        self.amp_dtype = get_amp_dtype(cfg_trainer.get('amp', False), self.device, self.logger)
+        self.scaler = torch.cuda.amp.GradScaler() if self.amp_dtype == torch.float16 else None
+        self.sync_every = max(int(cfg_trainer.get('sync_every', 1)), 1)
+
+    def _autocast(self):
+        if self.amp_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype)
+
+    def _to_device(self, data, target):
+        data = data.to(self.device, non_blocking=True)
+        if self.channels_last:
+            data = data.contiguous(memory_format=torch.channels_last)
+        return data, target.to(self.device, non_blocking=True)
 
     def _eval_metrics(self, output, target):
         """
-        Make an evaluation of all the specified metrics and store it in an ndarray.
+        Evaluate all the specified metrics, without synchronizing with the device.
         :params
             output: prediction of the model
             target: ground truth
+        :return: tensor of the metrics on the device
         """
-        acc_metrics = np.zeros(len(self.metrics))
-        for i, metric in enumerate(self.metrics):
-            m = metric(output, target.float())
-            acc_metrics[i] += metric(output, target.float())
-            self.writer.add_scalar('{}'.format(metric.__name__), acc_metrics[i])
-        return acc_metrics
+        with torch.no_grad():
+            return torch.stack([
+                torch.as_tensor(metric(output, target.float()), dtype=torch.float32, device=self.device)
+                for metric in self.metrics])
+
+    def _write_train_step(self, step, values):
+        self.writer.set_step(step)
+        self.writer.add_scalar('loss', values[0])
+        for metric, value in zip(self.metrics, values[1:]):
+            self.writer.add_scalar('{}'.format(metric.__name__), value)
 
     def _train_epoch(self, epoch):
         """
@@ -69,34 +98,62 @@ class Trainer(BaseTrainer):
             The metrics in log must have the key 'metrics'.
         """
         self.model.train()
+        if hasattr(self.train_sampler, 'set_epoch'):
+            self.train_sampler.set_epoch(epoch)
         total_loss = 0
         total_metrics = np.zeros(len(self.metrics))
+        # loss and metrics summed on the device, reduced every sync_every steps
+        window = torch.zeros(1 + len(self.metrics), device=self.device)
+        window_steps = 0
         for batch_idx, (data, target) in enumerate(self.data_loader):
-            data, target = data.to(self.device), target.to(self.device)
+            data, target = self._to_device(data, target)
             self.optimizer.zero_grad()
-            output = self.model(data)
+            with self._autocast():
+                output = self.model(data)
+            output = output.float()
             loss = self.loss(output, target)
-            loss.backward()
-            self.optimizer.step()
+            if self.scaler is not None:
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+            else:
+                loss.backward()
+                self.optimizer.step()
 
-            self.writer.set_step((epoch - 1) * self.len_epoch + batch_idx)
-            self.writer.add_scalar('loss', loss.item())
-            total_loss += loss.item()
-            total_metrics += self._eval_metrics(output, target)
+            window[0] += loss.detach()
+            window[1:] += self._eval_metrics(output, target)
+            window_steps += 1
 
-            if batch_idx % self.log_step == 0:
-                self.logger.debug('Train Epoch: {} {} Loss: {:.6f}'.format(
-                    epoch,
-                    self._progress(batch_idx),
-                    loss.item()))
+            log_now = batch_idx % self.log_step == 0
+            if log_now or window_steps == self.sync_every:
+                values = (window / window_steps).tolist()
+                self._write_train_step((epoch - 1) * self.len_epoch + batch_idx, values)
+                total_loss += values[0] * window_steps
+                total_metrics += np.array(values[1:]) * window_steps
+                window.zero_()
+                window_steps = 0
+                if log_now:
+                    self.logger.debug('Train Epoch: {} {} Loss: {:.6f}'.format(
+                        epoch,
+                        self._progress(batch_idx),
+                        values[0]))
 
             if batch_idx == self.len_epoch:
                 break
 
+        if window_steps:
+            values = (window / window_steps).tolist()
+            self._write_train_step((epoch - 1) * self.len_epoch + batch_idx, values)
+            total_loss += values[0] * window_steps
+            total_metrics += np.array(values[1:]) * window_steps
+
         log = {
             'loss': total_loss / self.len_epoch,
             'metrics': (total_metrics / self.len_epoch).tolist()
         }
+        cache = getattr(getattr(self.data_loader, 'dataset', None), 'cache', None)
+        if cache is not None:
+            self.logger.debug('Tile cache: {}'.format(cache.stats()))
 
         val_log = {}
         if self.do_validation:
@@ -114,37 +171,56 @@ class Trainer(BaseTrainer):
         :return: A log that contains information about validation
         """
         self.model.eval()
-        total_val_loss = 0
-        hist = np.zeros((2,2))
+        # the unpadded shards of the processes can differ by a batch, so validate
+        # with the bare module, outside of the collectives of DDP
+        model = self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
+        total_val_loss = torch.zeros((), device=self.device)
+        confusion = ConfusionMatrix(self.output_thresholds, self.output_threshold)
 
         with torch.no_grad():
             for batch_idx, (data, target) in enumerate(self.valid_data_loader):
-                data, target = data.to(self.device), target.to(self.device)
-                output = self.model(data) # logits
-                output_probs = F.sigmoid(output)
+                data, target = self._to_device(data, target)
+                with self._autocast():
+                    output = model(data) # logits
+                output = output.float()
+                output_probs = torch.sigmoid(output)
                 loss = self.loss(output, target)
-                target = threshold_outputs(target.data.cpu().numpy().flatten(), self.output_threshold)
-                output_binary = threshold_outputs(
-                    output_probs.data.cpu().numpy().flatten(), self.output_threshold)
 
-                # update the confusion matrix
-                hist += fast_hist(output_binary, target)
+                # update the confusion matrices on the device
+                confusion.update(output_probs, target)
 
-                self.writer.set_step((epoch - 1) * len(self.valid_data_loader) + batch_idx, 'valid')
-                self.writer.add_scalar('loss', loss.item())
-                total_val_loss += loss.item()
+                total_val_loss += loss.detach()
+                if (batch_idx + 1) % self.sync_every == 0:
+                    self.writer.set_step((epoch - 1) * len(self.valid_data_loader) + batch_idx, 'valid')
+                    self.writer.add_scalar('loss', loss.item())
+            # sum the loss and the confusion matrices of all the processes
+            n_batches = torch.tensor(float(len(self.valid_data_loader)), device=self.device)
+            all_reduce_sum(total_val_loss)
+            all_reduce_sum(n_batches)
+            confusion.all_reduce(self.device)
+            total_val_loss = float(total_val_loss / n_batches)
+            hists = confusion.hist()
             acc, acc_cls, mean_iu, fwavacc, precision, recall, f1_score = \
-                evaluate(hist=hist)
+                evaluate(hist=hists[0])
 
         # add histogram of model parameters to tensorboard
         for name, p in self.model.named_parameters():
             self.writer.add_histogram(name, p, bins='auto')
 
-        return {
-            'val_loss': total_val_loss / len(self.valid_data_loader),
+        log = {
+            'val_loss': total_val_loss,
             'acc': acc, 'mean_iu': mean_iu, 'fwavacc': fwavacc,
             'precision': precision, 'recall': recall, 'f1_score': f1_score
         }
+        for threshold, hist in zip(self.output_thresholds[1:], hists[1:]):
+            _, _, mean_iu, _, precision, recall, f1_score = evaluate(hist=hist)
+            log.update({
+                'mean_iu@{}'.format(threshold): mean_iu,
+                'precision@{}'.format(threshold): precision,
+                'recall@{}'.format(threshold): recall,
+                'f1_score@{}'.format(threshold): f1_score
+            })
+        return log
 
     def _progress(self, batch_idx):
         base = '[{}/{} ({:.0f}%)]'
@@ -157,6 +233,28 @@ class Trainer(BaseTrainer):
         return base.format(current, total, 100.0 * current / total)
 
 
+def get_amp_dtype(amp, device, logger=None):
+    """
+    Autocast dtype of the 'amp' trainer option: false (fp32), true (bf16 on
+    CPU, fp16 with gradient scaling on GPU), "bf16" or "fp16".
+    Returns None when autocast is disabled or not supported.
+    """
+    if not amp:
+        return None
+    if not hasattr(torch, 'autocast'):
+        if logger is not None:
+            logger.warning('Warning: torch.autocast is not available, training in fp32.')
+        return None
+    if amp is True:
+        amp = 'fp16' if device.type == 'cuda' else 'bf16'
+    assert amp in ['bf16', 'fp16'], 'amp must be true, false, "bf16" or "fp16"'
+    if device.type == 'cpu' and amp == 'fp16':
+        if logger is not None:
+            logger.warning('Warning: fp16 autocast is not supported on CPU, using bf16.')
+        amp = 'bf16'
+    return torch.bfloat16 if amp == 'bf16' else torch.float16
+
+
 def threshold_outputs(outputs, output_threshold=0.3):
     """
     Binarize output probabilities up to a certain threshold
@@ -0,0 +1,81 @@
+"""
+Helpers for DistributedDataParallel training (see train.py --nproc).
+Every function also works in a single process, where the process group is not
+initialized.
+"""
+import os
+from collections import OrderedDict
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DataParallel, DistributedDataParallel
+
+
+def init_distributed(rank, world_size, backend='gloo'):
+    """
+    Join the process group of the training processes of this machine.
+    On CPU the torch threads are split among the processes.
+    """
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    if not torch.cuda.is_available():
+        torch.set_num_threads(max(os.cpu_count() // world_size, 1))
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    """
+    Wait for all the processes. No-op in a single process.
+    """
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(tensor):
+    """
+    Sum a tensor over all the processes, in place. No-op in a single process.
+    """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def unwrap_model(model):
+    """
+    The model without its DataParallel or DistributedDataParallel wrapper.
+    """
+    if isinstance(model, (DataParallel, DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def load_model_state(model, state_dict):
+    """
+    Load the state dict of a checkpoint into a model, whether the model and
+    the checkpoint were wrapped in DataParallel/DistributedDataParallel or not:
+    the 'module.' prefix of the wrapped checkpoints is stripped.
+    """
+    state_dict = OrderedDict(
+        (key[len('module.'):] if key.startswith('module.') else key, value)
+        for key, value in state_dict.items())
+    unwrap_model(model).load_state_dict(state_dict)
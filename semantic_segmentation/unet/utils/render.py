@@ -0,0 +1,214 @@
+"""
+Rendering of the test figures with NumPy. The panels are built by concatenating
+the tiles as uint8 arrays and encoded by PIL with a low PNG compression level,
+instead of drawing matplotlib figures. RenderService runs the renderers in a
+process pool, off the inference loop.
+
+A renderer takes the images of a batch and returns {png path: uint8 array},
+write_pngs creates the directories of all the files once and writes them.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+
+PNG_COMPRESS_LEVEL = 1
+LOSS_COLOR = (255, 0, 0)
+VIDEO_YEARS = ['2013', '2014', '2015', '2016', '2017']
+VIDEO_PRED_YEARS = ['2013', '2014', '2015p', '2016p', '2017p']
+
+
+def to_rgb(img):
+    """
+    (3, H, W) image, float in [0, 1] or uint8, to a (H, W, 3) uint8 array.
+    """
+    img = np.asarray(img)
+    if img.dtype != np.uint8:
+        img = (np.clip(img, 0., 1.) * 255 + 0.5).astype(np.uint8)
+    return np.ascontiguousarray(np.transpose(img, (1, 2, 0)))
+
+
+def to_binary_rgb(mask):
+    """
+    (H, W) mask to a (H, W, 3) uint8 array, black where the mask is set
+    (as the matplotlib binary colormap).
+    """
+    gray = np.where(np.asarray(mask) > 0, 0, 255).astype(np.uint8)
+    return np.repeat(gray[:, :, None], 3, axis=2)
+
+
+def to_gray(mask):
+    """
+    (H, W) mask to a (H, W) uint8 array, white where the mask is set.
+    """
+    return np.where(np.asarray(mask) > 0, 255, 0).astype(np.uint8)
+
+
+def overlay(img, mask, color=LOSS_COLOR):
+    """
+    Paint the pixels of the mask on a (H, W, 3) uint8 image.
+    """
+    img = img.copy()
+    img[np.asarray(mask) > 0] = color
+    return img
+
+
+def grid(rows):
+    """
+    Concatenate rows of (H, W, 3) uint8 tiles into one image. None tiles are white.
+    """
+    shape = next(tile.shape for row in rows for tile in row if tile is not None)
+    blank = np.full(shape, 255, dtype=np.uint8)
+    return np.concatenate([
+        np.concatenate([blank if tile is None else tile for tile in row], axis=1)
+        for row in rows], axis=0)
+
+
+def write_pngs(outputs):
+    """
+    Write the uint8 arrays of {png path: array}, creating their directories once.
+    """
+    for folder in {os.path.dirname(path) for path in outputs}:
+        os.makedirs(folder, exist_ok=True)
+    for path, array in outputs.items():
+        Image.fromarray(array).save(path, compress_level=PNG_COMPRESS_LEVEL)
+
+
+def render(renderer, *args):
+    """
+    Run a renderer and write its pngs. Returns the number of files written.
+    """
+    outputs = renderer(*args)
+    write_pngs(outputs)
+    return len(outputs)
+
+
+def tile_panels(images, out_dir, idx_start, batch_size=3):
+    """
+    One png {idx}.png per batch_size tiles, a column per tile with the input
+    image(s), the ground truth and the prediction.
+    Params:
+        images: dict of
+            'img': (N, 3, H, W) or (N, 6, H, W) for 2 input images, float in [0, 1] or uint8
+            'gt', 'pred': (N, 1, H, W) binary masks
+    """
+    outputs = {}
+    n_tiles, channels = images['img'].shape[:2]
+    for i in range(0, n_tiles, batch_size):
+        tiles = range(i, min(i + batch_size, n_tiles))
+        rows = [[to_rgb(images['img'][tile][c:c + 3]) for tile in tiles]
+                for c in range(0, channels, 3)]
+        rows.append([to_binary_rgb(images['gt'][tile][0]) for tile in tiles])
+        rows.append([to_binary_rgb(images['pred'][tile][0]) for tile in tiles])
+        rows = [row + [None] * (batch_size - len(row)) for row in rows]
+        outputs[os.path.join(out_dir, '{}.png'.format(i + idx_start))] = grid(rows)
+    return outputs
+
+
+def column_panel(images, keys, out_dir, idx_start):
+    """
+    One png {idx}.png with the images of keys stacked vertically: the keys
+    containing 'img' are (1, 3, H, W) or (3, H, W) images, the others (1, 1, H, W) masks.
+    """
+    rows = []
+    for key in keys:
+        img = np.asarray(images[key])
+        if 'img' in key:
+            rows.append([to_rgb(img[0] if img.ndim == 4 else img)])
+        else:
+            rows.append([to_binary_rgb(img[0][0])])
+    return {os.path.join(out_dir, '{}.png'.format(idx_start)): grid(rows)}
+
+
+def _loss(fc0, fc1):
+    # forest at t and not at t + 1
+    return (np.asarray(fc0) > 0) & (np.asarray(fc1) == 0)
+
+
+def video_panels(images, out_dir, idx_start):
+    """
+    Images of a timeline: in out_dir/{idx}/ the landsat images, the forest
+    cover, the cumulative forest loss and the landsat images with the loss in
+    red, for the ground truth, the predictions on the real images (pred_gt) and
+    the predictions on the predicted images (pred_pred), plus a summary
+    out_dir/{idx}.png of the real years.
+    Params:
+        images: {year: {'img': (1, 3, H, W), 'gt', 'pred': (1, 1, H, W)}} for
+            the years of VIDEO_YEARS and VIDEO_PRED_YEARS
+    """
+    out = os.path.join(out_dir, str(idx_start))
+    outputs = {}
+
+    def add(folder, name, array):
+        outputs[os.path.join(out, folder, name + '.png')] = array
+
+    shape = np.asarray(images[VIDEO_YEARS[0]]['gt']).shape[-2:]
+    total_loss_gt = np.zeros(shape, dtype=bool)
+    total_loss_pred_gt = np.zeros(shape, dtype=bool)
+    for i, year in enumerate(VIDEO_YEARS):
+        img = to_rgb(images[year]['img'][0])
+        gt = images[year]['gt'][0][0]
+        pred_gt = images[year]['pred'][0][0]
+        add('landsat_loss_gt', year + 'img_with_loss_gt', overlay(img, total_loss_gt))
+        add('landsat_loss_pred_gt', year + 'img_with_loss_pred_gt', overlay(img, total_loss_pred_gt))
+        if i + 1 < len(VIDEO_YEARS):
+            next_year = VIDEO_YEARS[i + 1]
+            total_loss_gt |= _loss(gt, images[next_year]['gt'][0][0])
+            total_loss_pred_gt |= _loss(pred_gt, images[next_year]['pred'][0][0])
+            add('fl_gt', year + 'fl_gt', to_gray(total_loss_gt))
+            add('fl_pred_gt', year + 'fl_pred_gt', to_gray(total_loss_pred_gt))
+        add('landsat_gt', year + 'img', img)
+        add('fc_gt', year + 'gt', to_gray(gt))
+        add('fc_pred_gt', year + 'pred_gt', to_gray(pred_gt))
+
+    total_loss_pred_pred = np.zeros(shape, dtype=bool)
+    for i, year in enumerate(VIDEO_PRED_YEARS):
+        img = to_rgb(images[year]['img'][0])
+        pred_pred = images[year]['pred'][0][0]
+        add('landsat_loss_pred_pred', year + 'img_with_loss_pred_pred', overlay(img, total_loss_pred_pred))
+        add('landsat_pred', year + 'img', img)
+        add('fc_pred_pred', year + 'pred', to_gray(pred_pred))
+        if i + 1 < len(VIDEO_PRED_YEARS):
+            total_loss_pred_pred |= _loss(pred_pred, images[VIDEO_PRED_YEARS[i + 1]]['pred'][0][0])
+            add('fl_pred_pred', year + 'fl_pred_pred', to_gray(total_loss_pred_pred))
+
+    outputs[os.path.join(out_dir, '{}.png'.format(idx_start))] = grid([
+        [to_rgb(images[year]['img'][0]) for year in VIDEO_YEARS],
+        [to_binary_rgb(images[year]['gt'][0][0]) for year in VIDEO_YEARS],
+        [to_binary_rgb(images[year]['pred'][0][0]) for year in VIDEO_YEARS]])
+    return outputs
+
+
+class RenderService:
+    """
+    Run renderers in a process pool. The submitted tasks are queued and at most
+    max_pending of them are in flight: submit blocks on the oldest one instead
+    of piling up batches in memory. The errors of the tasks are re-raised.
+    Params:
+        workers: number of rendering processes
+        max_pending: maximum number of queued tasks (default: 4 per worker)
+    """
+    def __init__(self, workers=4, max_pending=None):
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._pending = deque()
+        self.max_pending = max_pending if max_pending is not None else 4 * workers
+        self.n_files = 0
+
+    def submit(self, renderer, *args):
+        """
+        Queue renderer(*args), a module level function returning {png path: array}.
+        """
+        self._pending.append(self._executor.submit(render, renderer, *args))
+        self.wait(self.max_pending)
+
+    def wait(self, max_pending=0):
+        """
+        Wait for the oldest tasks until at most max_pending are queued.
+        """
+        while len(self._pending) > max_pending:
+            self.n_files += self._pending.popleft().result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
@@ -3,9 +3,6 @@ This module contains helper functions for file management and plots
 """
 import json
 import torch
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
 import numpy as np
 from torchvision.utils import make_grid
 from torchvision import transforms
@@ -15,6 +12,7 @@ from datetime import datetime
 from itertools import repeat
 from collections import OrderedDict
 from PIL import Image
+from .render import write_pngs, tile_panels, column_panel, video_panels
 
 def create_dir(folder):
     if not os.path.exists(folder):
@@ -60,306 +58,22 @@ def int_year(str_year):
     return int(str_year[:4])
 
 def save_forma_images(images, out_dir, idx_start):
-    print(images.keys())
-    keys = ['img0', 'img1', 'forma', 'hansen']
-    num_y_tiles = 4
-    f = plt.figure(figsize=(4, num_y_tiles*2))
-    gs = gridspec.GridSpec(num_y_tiles, 1, wspace=0.0, hspace=0.0)
-
-    for i in range(len(keys)):
-        key = keys[i]
-        img = images[key]
-        ax = plt.subplot(gs[i, 0])
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-        if 'img' in key:
-            if len(img.shape) == 4:
-                plt.imshow(np.transpose(img[0], axes=[1,2,0]))
-            else:
-                plt.imshow(np.transpose(img, axes=[1,2,0]))
-        else:
-            plt.imshow(img[0][0], cmap=plt.cm.binary)
-    out_imgs_dir = os.path.join(out_dir, '{}.png'.format(idx_start))
-    print('Saved!', out_imgs_dir)
-    plt.savefig(out_imgs_dir, dpi=200, bbox_inches='tight', pad_inches=0.0)
-    plt.close(f)
+    write_pngs(column_panel(images, ['img0', 'img1', 'forma', 'hansen'], out_dir, idx_start))
 
 def save_result_images(images, out_dir, idx_start):
-    print(images.keys())
     keys = ['img2016', 'img2017', 'fc2016', 'fc2017', 'fl2017', 'fl_rec2017',
         'fc_pred2016', 'fc_pred2017', 'fl_pred2017'
     ]
-    num_y_tiles = 9
-    f = plt.figure(figsize=(4, num_y_tiles*2))
-    gs = gridspec.GridSpec(num_y_tiles, 1, wspace=0.0, hspace=0.0)
-
-    for i in range(len(keys)):
-        key = keys[i]
-        img = images[key]
-        ax = plt.subplot(gs[i, 0])
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-        if 'img' in key:
-            plt.imshow(np.transpose(img[0], axes=[1,2,0]))
-        else:
-            print(img.shape, 'SHAPEE', key)
-            plt.imshow(img[0][0], cmap=plt.cm.binary)
-    out_imgs_dir = os.path.join(out_dir, '{}.png'.format(idx_start))
-    print('Saved!', out_imgs_dir)
-    plt.savefig(out_imgs_dir, dpi=200, bbox_inches='tight', pad_inches=0.0)
-    plt.close(f)
+    write_pngs(column_panel(images, keys, out_dir, idx_start))
 
 def save_simple_images(batch_size, images, out_dir, idx_start):
-
-    for i in range(0, images['img'].shape[0], batch_size):
-        num_y_tiles = 3 # input, gt, prediction
-        f = plt.figure(figsize=(batch_size*4, num_y_tiles*2))
-        gs = gridspec.GridSpec(num_y_tiles, batch_size, wspace=0.0, hspace=0.0)
-        tiles = list(range(i, i + batch_size))
-
-        for tile in tiles:
-            # img1, img2, gt, pred
-            if tile < images['img'].shape[0]:
-                img = images['img'][tile]
-                gt = images['gt'][tile]
-                pred = images['pred'][tile]
-                # Set up plot
-                ax = plt.subplot(gs[0, tile%batch_size])
-                ax.get_xaxis().set_visible(False)
-                ax.get_yaxis().set_visible(False)
-                print('plot 0')
-                plt.imshow(np.transpose(img, axes=[1,2,0]))
-                ax = plt.subplot(gs[1, tile%batch_size])
-                ax.get_xaxis().set_visible(False)
-                ax.get_yaxis().set_visible(False)
-                print('plot 1')
-                plt.imshow(gt[0], cmap=plt.cm.binary)
-                ax = plt.subplot(gs[2, tile%batch_size])
-                ax.get_xaxis().set_visible(False)
-                ax.get_yaxis().set_visible(False)
-                print('plot 2')
-                plt.imshow(pred[0], cmap=plt.cm.binary)
-
-        out_imgs_dir = os.path.join(out_dir, '{}.png'.format(i + idx_start))
-        print('Saved!', out_imgs_dir)
-        plt.savefig(out_imgs_dir, dpi=200, bbox_inches='tight', pad_inches=0.0)
-        plt.close(f)
+    write_pngs(tile_panels(images, out_dir, idx_start, batch_size))
 
 def save_double_images(batch_size, images, out_dir, idx_start):
-
-    for i in range(0, images['img'].shape[0], batch_size):
-        num_y_tiles = 4 # input, gt, prediction
-        f = plt.figure(figsize=(batch_size*4, num_y_tiles*2))
-        gs = gridspec.GridSpec(num_y_tiles, batch_size, wspace=0.0, hspace=0.0)
-        tiles = list(range(i, i + batch_size))
-
-        for tile in tiles:
-            # img1, img2, gt, pred
-            if tile < images['img'].shape[0]:
-                img = images['img'][tile]
-                gt = images['gt'][tile]
-                pred = images['pred'][tile]
-                # Set up plot
-                ax = plt.subplot(gs[0, tile%batch_size])
-                ax.get_xaxis().set_visible(False)
-                ax.get_yaxis().set_visible(False)
-                print('plot 0')
-                plt.imshow(np.transpose(img[:3], axes=[1,2,0]))
-                ax = plt.subplot(gs[1, tile%batch_size])
-                ax.get_xaxis().set_visible(False)
-                ax.get_yaxis().set_visible(False)
-                print('plot 1')
-                plt.imshow(np.transpose(img[3:], axes=[1,2,0]))
-                ax = plt.subplot(gs[2, tile%batch_size])
-                ax.get_xaxis().set_visible(False)
-                ax.get_yaxis().set_visible(False)
-                print('plot 2')
-                plt.imshow(gt[0], cmap=plt.cm.binary)
-                ax = plt.subplot(gs[3, tile%batch_size])
-                ax.get_xaxis().set_visible(False)
-                ax.get_yaxis().set_visible(False)
-                print('plot 3')
-                plt.imshow(pred[0], cmap=plt.cm.binary)
-
-        out_imgs_dir = os.path.join(out_dir, '{}.png'.format(i + idx_start))
-        print('Saved!', out_imgs_dir)
-        plt.savefig(out_imgs_dir, dpi=200, bbox_inches='tight', pad_inches=0.0)
-        plt.close(f)
-
-
-    matplotlib.image.imsave(os.path.join(out_landsat, str(year) + 'img.png'), img)
+    write_pngs(tile_panels(images, out_dir, idx_start, batch_size))
 
 def save_video_images256(images, out_dir, idx_start):
-    years0 = ['2013', '2014', '2015', '2016', '2017']
-    years1 = ['2013', '2014', '2015p', '2016p', '2017p']
-    years = years0 + years1
-    out = os.path.join(out_dir, str(idx_start))
-    create_dir(out)
-    total_loss_gt = np.zeros((256, 256))
-    total_loss_pred_gt = np.zeros((256, 256))
-    total_loss_pred_pred = np.zeros((256, 256))
-    for i in range(len(years0)):
-        year = years0[i]
-        img = np.transpose(images[year]['img'][0], [1,2,0])
-        gt = images[year]['gt'][0][0]
-        pred_gt = images[year]['pred'][0][0]
-
-        img_with_loss_gt = np.copy(img)
-        mask_gt = np.where(total_loss_gt != 0)
-        if len(mask_gt[0]) != 0:
-            img_with_loss_gt[mask_gt] = 1,0,0
-
-        img_with_loss_pred_gt = np.copy(img)
-        mask_pred = np.where(total_loss_pred_gt != 0)
-        if len(mask_pred[0]) != 0:
-            img_with_loss_pred_gt[mask_pred] = 1,0,0
-
-        out_landsat_loss_gt = os.path.join(out, 'landsat_loss_gt')
-        out_landsat_loss_pred_gt = os.path.join(out, 'landsat_loss_pred_gt')
-        out_landsat = os.path.join(out, 'landsat_gt')
-        out_gt = os.path.join(out, 'fc_gt')
-        out_pred_gt = os.path.join(out, 'fc_pred_gt')
-        create_dir(out_gt)
-        create_dir(out_landsat)
-        create_dir(out_pred_gt)
-        create_dir(out_landsat_loss_gt)
-        create_dir(out_landsat_loss_pred_gt)
-        matplotlib.image.imsave(os.path.join(out_landsat_loss_gt, str(year) + 'img_with_loss_gt.png'), img_with_loss_gt)
-        matplotlib.image.imsave(os.path.join(out_landsat_loss_pred_gt, str(year) + 'img_with_loss_pred_gt.png'), img_with_loss_pred_gt)
-
-        if int_year(year) < 2017:
-            gt_fc0 = np.copy(gt)
-            gt_fc1 = images[years0[i+1]]['gt'][0][0]
-            gt_loss = create_loss(gt_fc0, gt_fc1)
-            total_loss_gt = update_total_loss(total_loss_gt, gt_loss)
-
-            pred_fc0 = np.copy(pred_gt)
-            pred_fc1 = images[years0[i+1]]['pred'][0][0]
-            pred_loss_gt = create_loss(pred_fc0, pred_fc1)
-            total_loss_pred_gt = update_total_loss(total_loss_pred_gt, pred_loss_gt)
-
-            out_fl_gt = os.path.join(out, 'fl_gt')
-            out_fl_pred_gt = os.path.join(out, 'fl_pred_gt')
-            create_dir(out_fl_gt)
-            create_dir(out_fl_pred_gt)
-            # Save losses
-            matplotlib.image.imsave(os.path.join(out_fl_gt, str(year) + 'fl_gt.png'), total_loss_gt)
-            matplotlib.image.imsave(os.path.join(out_fl_pred_gt, str(year) + 'fl_pred_gt.png'), total_loss_pred_gt)
-
-        # print(img.shape, gt.shape, pred_gt.shape)
-        out_landsat = os.path.join(out, 'landsat_gt')
-        out_gt = os.path.join(out, 'fc_gt')
-        out_pred_gt = os.path.join(out, 'fc_pred_gt')
-        # landsat with losses
-        out_landsat_loss_gt = os.path.join(out, 'landsat_loss_gt')
-        out_landsat_loss_pred_gt = os.path.join(out, 'landsat_loss_pred_gt')
-        create_dir(out_gt)
-        create_dir(out_landsat)
-        create_dir(out_pred_gt)
-
-
-        matplotlib.image.imsave(os.path.join(out_landsat, str(year) + 'img.png'), img)
-        matplotlib.image.imsave(os.path.join(out_gt, str(year) + 'gt.png'), gt)
-        matplotlib.image.imsave(os.path.join(out_pred_gt, str(year) + 'pred_gt.png'), pred_gt)
-
-        '''
-        img_with_loss_gt = np.copy(img)
-        mask_gt = np.where(total_loss_gt != 0)
-        if len(mask_gt[0]) != 0:
-            img_with_loss_gt[mask_gt] = 1,0,0
-
-        img_with_loss_pred_gt = np.copy(img)
-        mask_pred = np.where(total_loss_pred_gt != 0)
-        if len(mask_pred[0]) != 0:
-            img_with_loss_pred_gt[mask_pred] = 1,0,0
-        create_dir(out_landsat_loss_gt)
-        create_dir(out_landsat_loss_pred_gt)
-        matplotlib.image.imsave(os.path.join(out_landsat_loss_gt, str(year) + 'img_with_loss_gt.png'), img_with_loss_gt)
-        matplotlib.image.imsave(os.path.join(out_landsat_loss_pred_gt, str(year) + 'img_with_loss_pred_gt.png'), img_with_loss_pred_gt)
-'''
-    for i in range(len(years1)):
-        year = years1[i]
-        img = np.transpose(images[year]['img'][0], [1,2,0])
-        gt = images[year]['gt'][0][0]
-        pred_pred = images[year]['pred'][0][0]
-        # print(img.shape, gt.shape, pred_pred.shape)
-
-        out_landsat_loss_pred_pred = os.path.join(out, 'landsat_loss_pred_pred')
-        create_dir(out_landsat_loss_pred_pred)
-        img_with_loss_pred_pred = np.copy(img)
-        mask_pred_pred = np.where(total_loss_pred_pred != 0)
-        if len(mask_pred_pred[0]) != 0:
-            img_with_loss_pred_pred[mask_pred_pred] = 1,0,0
-
-        matplotlib.image.imsave(os.path.join(out_landsat_loss_pred_pred, str(year) + 'img_with_loss_pred_pred.png'), img_with_loss_pred_pred)
-
-        out_landsat_pred = os.path.join(out, 'landsat_pred')
-        out_pred_pred = os.path.join(out, 'fc_pred_pred')
-        create_dir(out_pred_pred)
-        create_dir(out_landsat_pred)
-
-        matplotlib.image.imsave(os.path.join(out_landsat_pred, str(year) + 'img.png'), img)
-        matplotlib.image.imsave(os.path.join(out_pred_pred, str(year) + 'pred.png'), pred_pred)
-        # print(int_year(year), 'YEARRRR')
-        if int_year(year) < 2017:
-            pred_fc0 = np.copy(pred_pred)
-            pred_fc1 = images[years1[i+1]]['pred'][0][0]
-            pred_loss_pred = create_loss(pred_fc0, pred_fc1)
-            total_loss_pred_pred = update_total_loss(total_loss_pred_pred, pred_loss_pred)
-            out_fl_pred_pred = os.path.join(out, 'fl_pred_pred')
-            create_dir(out_fl_pred_pred)
-            # Save losses
-            matplotlib.image.imsave(os.path.join(out_fl_pred_pred, str(year) + 'fl_pred_pred.png'), total_loss_pred_pred)
-    '''
-        out_landsat_loss_pred_pred = os.path.join(out, 'landsat_loss_pred_pred')
-        create_dir(out_landsat_loss_pred_pred)
-        img_with_loss_pred_pred = np.copy(img)
-        mask_pred_pred = np.where(total_loss_pred_pred != 0)
-        if len(mask_pred_pred[0]) != 0:
-            img_with_loss_pred_pred[mask_pred_pred] = 1,0,0
-
-        matplotlib.image.imsave(os.path.join(out_landsat_loss_pred_pred, str(year) + 'img_with_loss_pred_pred.png'), img_with_loss_pred_pred)
-    '''
-        # img_save = Image.fromarray(img)
-        # gt_save = Image.fromarray(gt)
-        # pred_save = Image.fromarray(pred)
-        # img_save.save(os.path.join(out_dir, idx_start, year + '.png'))
-
-    num_y_tiles = 3
-    f = plt.figure(figsize=(4, num_y_tiles*2))
-    gs = gridspec.GridSpec(num_y_tiles, 5, wspace=0.0, hspace=0.0)
-    years = ['2013', '2014', '2015', '2016', '2017']
-    # years0 = ['2013', '2014', '2015', '2016', '2017']
-    # years1 = ['2013', '2014', '2015p', '2016p', '2017p']
-    # years = years0 + years1
-    # for i in range(0, len(years0)):
-    #     year = years0[i]
-    #     pass
-    for i in range(0, len(years)):
-        year = years[i]
-        img = images[year]['img']
-        gt = images[year]['gt']
-        pred = images[year]['pred']
-        ax = plt.subplot(gs[0, i])
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-        # print('plot 0')
-        plt.imshow(np.transpose(img[0], axes=[1,2,0]))
-        ax = plt.subplot(gs[1, i])
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-        # print('plot 1')
-        # print(gt.shape, 'SHAPEEE 1')
-        plt.imshow(gt[0][0], cmap=plt.cm.binary)
-        ax = plt.subplot(gs[2, i])
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-        # print('plot 2')
-        plt.imshow(pred[0][0], cmap=plt.cm.binary)
-    out_imgs_dir = os.path.join(out_dir, '{}.png'.format(idx_start))
-    print('Saved!', out_imgs_dir)
-    plt.savefig(out_imgs_dir, dpi=200, bbox_inches='tight', pad_inches=0.0)
-    plt.close(f)
+    write_pngs(video_panels(images, out_dir, idx_start))
 
 class Timer:
     def __init__(self):
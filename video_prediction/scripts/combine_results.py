@@ -12,16 +12,7 @@ import numpy as np
 
 from video_prediction.utils import html
 from video_prediction.utils.ffmpeg_gif import save_gif as ffmpeg_save_gif
-
-
-def load_metrics(prefix_fname):
-    import csv
-    with open('%s.csv' % prefix_fname, newline='') as csvfile:
-        reader = csv.reader(csvfile, delimiter='\t', quotechar='|')
-        rows = list(reader)
-        # skip header (first row), indices (first column), and means (last column)
-        metrics = np.array(rows)[1:, 1:-1].astype(np.float32)
-    return metrics
+from video_prediction.utils.metrics_store import list_method_metrics, load_method_metrics, load_method_store
 
 
 def load_images(image_fnames):
@@ -117,12 +108,14 @@ def main():
     else:
         method_names = list(args.method_names)
     method_dirs = [os.path.join(args.results_dir, method_dir) for method_dir in method_dirs]
+    # metrics stores of the methods, read once
+    stores = {method_dir: load_method_store(method_dir) for method_dir in method_dirs}
 
     if args.sort_by:
         task_name, metric_name = args.sort_by
         sort_criterion = []
         for method_id, (method_name, method_dir) in enumerate(zip(method_names, method_dirs)):
-            metric = load_metrics(os.path.join(method_dir, task_name, 'metrics', metric_name))
+            metric = load_method_metrics(method_dir, task_name, metric_name, store=stores[method_dir])
             sort_criterion.append(np.mean(metric))
         sort_criterion, method_ids, method_names, method_dirs = \
             zip(*sorted(zip(sort_criterion, range(len(method_names)), method_names, method_dirs)))
@@ -131,13 +124,9 @@ def main():
         method_ids = range(len(method_names))
 
     # infer task and metric names from first method
-    metric_fnames = sorted(glob.glob('%s/*/metrics/*.csv' % glob.escape(method_dirs[0])))
     task_names = []
     metric_names = []
-    for metric_fname in metric_fnames:
-        head, tail = os.path.split(metric_fname)
-        task_name = head.split('/')[-2]
-        metric_name, _ = os.path.splitext(tail)
+    for task_name, metric_name in list_method_metrics(method_dirs[0], store=stores[method_dirs[0]]):
         task_names.append(task_name)
         metric_names.append(metric_name)
 
@@ -164,7 +153,7 @@ def main():
         metric_txts = [method_id, method_name]
         metric_means = []
         for task_name, metric_name in zip(task_names, metric_names):
-            metric = load_metrics(os.path.join(method_dir, task_name, 'metrics', metric_name))
+            metric = load_method_metrics(method_dir, task_name, metric_name, store=stores[method_dir])
             metric_mean = np.mean(metric)
             num_samples = len(metric)
             metric_se = np.std(metric) / np.sqrt(num_samples)
@@ -4,7 +4,6 @@ from __future__ import print_function
 
 import re
 import argparse
-import csv
 import errno
 import json
 import os
@@ -14,53 +13,26 @@ import numpy as np
 import tensorflow as tf
 
 from video_prediction import datasets, models
+from video_prediction.utils import metrics_store
+from video_prediction.utils.output_writer import OutputWriter, link_files, save_pngs
 
 
-def save_image_sequence(prefix_fname, images, time_start_ind=0):
-    import cv2
-    head, tail = os.path.split(prefix_fname)
-    if head and not os.path.exists(head):
-        os.makedirs(head)
-    for t, image in enumerate(images):
-        image_fname = '%s_%02d.png' % (prefix_fname, time_start_ind + t)
-        image = (image * 255.0).astype(np.uint8)
-        if image.shape[-1] == 1:
-            image = np.tile(image, (1, 1, 3))
-        else:
-            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(image_fname, image)
-
-
-def save_image_sequences(prefix_fname, images, sample_start_ind=0, time_start_ind=0):
-    head, tail = os.path.split(prefix_fname)
-    if head and not os.path.exists(head):
-        os.makedirs(head)
-    for i, images_ in enumerate(images):
-        images_fname = '%s_%05d' % (prefix_fname, sample_start_ind + i)
-        save_image_sequence(images_fname, images_, time_start_ind=time_start_ind)
-
-
-def save_metrics(prefix_fname, metrics, sample_start_ind=0):
-    head, tail = os.path.split(prefix_fname)
-    if head and not os.path.exists(head):
-        os.makedirs(head)
-    assert metrics.ndim == 2
-    file_mode = 'w' if sample_start_ind == 0 else 'a'
-    with open('%s.csv' % prefix_fname, file_mode, newline='') as csvfile:
-        writer = csv.writer(csvfile, delimiter='\t', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        if sample_start_ind == 0:
-            writer.writerow(map(str, ['sample_ind'] + list(range(metrics.shape[1])) + ['mean']))
-        for i, metrics_row in enumerate(metrics):
-            writer.writerow(map(str, [sample_start_ind + i] + list(metrics_row) + [np.mean(metrics_row)]))
-
-
-def load_metrics(prefix_fname):
-    with open('%s.csv' % prefix_fname, newline='') as csvfile:
-        reader = csv.reader(csvfile, delimiter='\t', quotechar='|')
-        rows = list(reader)
-        # skip header (first row), indices (first column), and means (last column)
-        metrics = np.array(rows)[1:, 1:-1].astype(np.float32)
-    return metrics
+def image_sequences_fnames(prefix_fname, num_sequences, length, sample_start_ind=0, time_start_ind=0):
+    return [['%s_%05d_%02d.png' % (prefix_fname, sample_start_ind + i, time_start_ind + t) for t in range(length)]
+            for i in range(num_sequences)]
+
+
+def save_linked_image_sequences(prefix_fnames, images, sample_start_ind=0):
+    """
+    Save the uint8 image sequences once, with the first prefix, and hard link
+    them with the other prefixes, which must only differ in their directory.
+    """
+    fnames = image_sequences_fnames(prefix_fnames[0], len(images), images.shape[1], sample_start_ind=sample_start_ind)
+    for fnames_, images_ in zip(fnames, images):
+        save_pngs(fnames_, images_)
+    fnames = [fname for fnames_ in fnames for fname in fnames_]
+    for prefix_fname in prefix_fnames[1:]:
+        link_files(fnames, os.path.dirname(prefix_fname))
 
 
 def merge_hparams(hparams0, hparams1):
@@ -77,19 +49,25 @@ def merge_hparams(hparams0, hparams1):
     return hparams
 
 
-def save_prediction_eval_results(task_dir, results, model_hparams, sample_start_ind=0, only_metrics=False, subtasks=None):
+def save_prediction_eval_results(task_dir, results, model_hparams, metrics_writer, sample_start_ind=0, only_metrics=False,
+                                 subtasks=None, writer=None):
+    """
+    The metrics are appended to the metrics_writer (see MetricsWriter), in sample order. The images
+    are saved by the writer (see OutputWriter), or in the calling thread if it
+    is None. The context images are the same for all the tasks, so they are
+    encoded once and linked into the inputs directory of every task.
+    """
     sequence_length = model_hparams.sequence_length
     context_frames = model_hparams.context_frames
     future_length = sequence_length - context_frames
+    writer = writer or OutputWriter(num_workers=0)
 
-    context_images = results['images'][:, :context_frames]
+    context_images = (results['images'][:, :context_frames] * 255.0).astype(np.uint8)
+    context_prefix_fnames = []
 
     if 'eval_diversity' in results:
         metric = results['eval_diversity']
-        metric_name = 'diversity'
-        subtask_dir = task_dir + '_%s' % metric_name
-        save_metrics(os.path.join(subtask_dir, 'metrics', metric_name),
-                     metric, sample_start_ind=sample_start_ind)
+        metrics_writer.append('diversity', None, metric, sample_start_ind=sample_start_ind)
 
     subtasks = subtasks or ['max']
     for subtask in subtasks:
@@ -104,15 +82,16 @@ def save_prediction_eval_results(task_dir, results, model_hparams, sample_start_
             # only keep the future frames
             gen_images = gen_images[:, -future_length:]
             metric = results['eval_%s/%s' % (metric_name, subtask)]
-            save_metrics(os.path.join(subtask_dir, 'metrics', metric_name),
-                         metric, sample_start_ind=sample_start_ind)
+            metrics_writer.append(metric_name, subtask, metric, sample_start_ind=sample_start_ind)
             if only_metrics:
                 continue
 
-            save_image_sequences(os.path.join(subtask_dir, 'inputs', 'context_image'),
-                                 context_images, sample_start_ind=sample_start_ind)
-            save_image_sequences(os.path.join(subtask_dir, 'outputs', 'gen_image'),
-                                 gen_images, sample_start_ind=sample_start_ind)
+            context_prefix_fnames.append(os.path.join(subtask_dir, 'inputs', 'context_image'))
+            writer.put(save_linked_image_sequences, [os.path.join(subtask_dir, 'outputs', 'gen_image')],
+                       (gen_images * 255.0).astype(np.uint8), sample_start_ind=sample_start_ind)
+    if context_prefix_fnames:
+        writer.put(save_linked_image_sequences, context_prefix_fnames, context_images,
+                   sample_start_ind=sample_start_ind)
 
 
 def main():
@@ -123,21 +102,24 @@ def main():
     │   │   ├── inputs
     │   │   │   ├── context_image_00000_00.png  # indexed by sample index and time step
     │   │   │   └── ...
-    │   │   ├── outputs
-    │   │   │   ├── gen_image_00000_00.png      # predicted images (only the future ones)
-    │   │   │   └── ...
-    │   │   └── metrics
-    │   │       └── lpips.csv
+    │   │   └── outputs
+    │   │       ├── gen_image_00000_00.png      # predicted images (only the future ones)
+    │   │       └── ...
     │   ├── prediction_eval_ssim_max            # task: best sample in terms of SSIM
     │   │   ├── inputs
     │   │   │   ├── context_image_00000_00.png  # indexed by sample index and time step
     │   │   │   └── ...
-    │   │   ├── outputs
-    │   │   │   ├── gen_image_00000_00.png      # predicted images (only the future ones)
-    │   │   │   └── ...
-    │   │   └── metrics
-    │   │       └── ssim.csv
-    │   └── ...
+    │   │   └── outputs
+    │   │       ├── gen_image_00000_00.png      # predicted images (only the future ones)
+    │   │       └── ...
+    │   ├── ...
+    │   └── metrics                             # metrics of all the tasks (see metrics_store.py)
+    │       ├── names.json                      # metric and subtask names
+    │       ├── sample_ind.bin                  # one column file per key and the values
+    │       ├── time_step.bin
+    │       ├── metric.bin
+    │       ├── subtask.bin
+    │       └── value.bin
     └── ...
     """
     parser = argparse.ArgumentParser()
@@ -159,6 +141,9 @@ def main():
     parser.add_argument("--batch_size", type=int, default=8, help="number of samples in batch")
     parser.add_argument("--num_samples", type=int, help="number of samples in total (all of them by default)")
     parser.add_argument("--num_epochs", type=int, default=1)
+    parser.add_argument("--keys", type=str, nargs='+', help="keys of the sequences to read, from the index.json "
+                                                             "of the shards (all the tfrecords by default)")
+    parser.add_argument("--keys_file", type=str, help="file with the keys of the sequences to read, one per line")
 
     parser.add_argument("--eval_substasks", type=str, nargs='+', default=['max', 'avg', 'min'], help='subtasks to evaluate (e.g. max, avg, min)')
     parser.add_argument("--only_metrics", action='store_true')
@@ -168,6 +153,7 @@ def main():
     parser.add_argument("--gt_outputs_dir", type=str, help="directory containing output ground truth images for ismple dataset")
 
     parser.add_argument("--eval_parallel_iterations", type=int, default=10)
+    parser.add_argument("--num_writers", type=int, default=4, help="threads saving the images (0: in the session loop)")
     parser.add_argument("--gpu_mem_frac", type=float, default=0, help="fraction of gpu memory to use")
     parser.add_argument("--seed", type=int, default=7)
 
@@ -214,6 +200,11 @@ def main():
         print(k, "=", v)
     print('------------------------------------- End --------------------------------------')
 
+    keys = args.keys
+    if args.keys_file:
+        with open(args.keys_file) as f:
+            keys = [line.strip() for line in f if line.strip()]
+
     VideoDataset = datasets.get_dataset_class(args.dataset)
     dataset = VideoDataset(
         args.input_dir,
@@ -221,7 +212,8 @@ def main():
         num_epochs=args.num_epochs,
         seed=args.seed,
         hparams_dict=dataset_hparams_dict,
-        hparams=args.dataset_hparams)
+        hparams=args.dataset_hparams,
+        keys=keys)
 
     VideoPredictionModel = models.get_model_class(args.model)
     hparams_dict = dict(model_hparams_dict)
@@ -237,7 +229,10 @@ def main():
         eval_num_samples=args.num_stochastic_samples,
         eval_parallel_iterations=args.eval_parallel_iterations)
 
-    if args.num_samples:
+    if dataset.keys is not None:
+        # the last batch is padded, see BaseVideoDataset.padded_keys
+        num_examples_per_epoch = len(dataset.padded_keys(args.batch_size))
+    elif args.num_samples:
         if args.num_samples > dataset.num_examples_per_epoch():
             raise ValueError('num_samples cannot be larger than the dataset')
         num_examples_per_epoch = args.num_samples
@@ -254,6 +249,10 @@ def main():
     output_dir = args.output_dir
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    if dataset.keys is not None:
+        # key of every sample index
+        with open(os.path.join(output_dir, "keys.txt"), "w") as f:
+            f.write(''.join('%s\n' % key for key in dataset.keys))
     with open(os.path.join(output_dir, "options.json"), "w") as f:
         f.write(json.dumps(vars(args), sort_keys=True, indent=4))
     with open(os.path.join(output_dir, "dataset_hparams.json"), "w") as f:
@@ -268,6 +267,9 @@ def main():
 
     model.restore(sess, args.checkpoint)
 
+    metrics_dir = os.path.join(output_dir, metrics_store.STORE_DNAME)
+    metrics_writer = metrics_store.MetricsWriter(metrics_dir)
+    writer = OutputWriter(args.num_writers)
     sample_ind = 0
     while True:
         if args.num_samples and sample_ind >= args.num_samples:
@@ -284,27 +286,30 @@ def main():
         fetches.update(model.eval_outputs.items())
         fetches.update(model.eval_metrics.items())
         results = sess.run(fetches, feed_dict=feed_dict)
+        if dataset.keys is not None:
+            # drop the padding of the last batch
+            num_valid = min(args.batch_size, len(dataset.keys) - sample_ind)
+            if num_valid <= 0:
+                break
+            results = {name: result[:num_valid] for name, result in results.items()}
         save_prediction_eval_results(os.path.join(output_dir, 'prediction_eval'),
-                                     results, model.hparams, sample_ind, args.only_metrics, args.eval_substasks)
+                                     results, model.hparams, metrics_writer, sample_ind, args.only_metrics,
+                                     args.eval_substasks, writer=writer)
         sample_ind += args.batch_size
-
-    metric_fnames = []
-    metric_names = ['psnr', 'ssim', 'lpips']
-    subtasks = ['max']
-    for metric_name in metric_names:
-        for subtask in subtasks:
-            metric_fnames.append(
-                os.path.join(output_dir, 'prediction_eval_%s_%s' % (metric_name, subtask), 'metrics', metric_name))
-
-    for metric_fname in metric_fnames:
-        task_name, _, metric_name = metric_fname.split('/')[-3:]
-        metric = load_metrics(metric_fname)
+    metrics_writer.close()
+    writer.close()
+
+    store = metrics_store.load_store(metrics_dir)
+    for metric_name in ['psnr', 'ssim', 'lpips']:
+        subtask = 'max'
+        task_name = metrics_store.metric_task_name(metric_name, subtask)
+        metric = metrics_store.load_metrics(metrics_dir, metric_name, subtask, store=store)
         print('=' * 31)
         print(task_name, metric_name)
         print('-' * 31)
         metric_header_format = '{:>10} {:>20}'
         metric_row_format = '{:>10} {:>10.4f} ({:>7.4f})'
-        print(metric_header_format.format('time step', os.path.split(metric_fname)[1]))
+        print(metric_header_format.format('time step', metric_name))
         for t, (metric_mean, metric_std) in enumerate(zip(metric.mean(axis=0), metric.std(axis=0))):
             print(metric_row_format.format(t, metric_mean, metric_std))
         print(metric_row_format.format('mean (std)', metric.mean(), metric.std()))
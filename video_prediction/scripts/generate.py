@@ -8,12 +8,12 @@ import json
 import os
 import random
 
-import cv2
 import numpy as np
 import tensorflow as tf
 
 from video_prediction import datasets, models
-from video_prediction.utils.ffmpeg_gif import save_gif
+from video_prediction.utils.ffmpeg_gif import save_gif as ffmpeg_save_gif
+from video_prediction.utils.output_writer import OutputWriter, save_gif, save_pngs
 
 
 def main():
@@ -40,10 +40,16 @@ def main():
     parser.add_argument("--batch_size", type=int, default=8, help="number of samples in batch")
     parser.add_argument("--num_samples", type=int, help="number of samples in total (all of them by default)")
     parser.add_argument("--num_epochs", type=int, default=1)
+    parser.add_argument("--keys", type=str, nargs='+', help="keys of the sequences to read, from the index.json "
+                                                             "of the shards (all the tfrecords by default)")
+    parser.add_argument("--keys_file", type=str, help="file with the keys of the sequences to read, one per line")
 
     parser.add_argument("--num_stochastic_samples", type=int, default=5)
     parser.add_argument("--gif_length", type=int, help="default is sequence_length")
     parser.add_argument("--fps", type=int, default=4)
+    parser.add_argument("--gif", type=str, choices=['pil', 'ffmpeg', 'none'], default='pil',
+                        help="gif encoder of the samples (pil: in process), or none to only save the pngs")
+    parser.add_argument("--num_writers", type=int, default=4, help="threads saving the outputs (0: in the session loop)")
 
     parser.add_argument("--gpu_mem_frac", type=float, default=0, help="fraction of gpu memory to use")
     parser.add_argument("--seed", type=int, default=7)
@@ -95,6 +101,11 @@ def main():
         print(k, "=", v)
     print('------------------------------------- End --------------------------------------')
 
+    keys = args.keys
+    if args.keys_file:
+        with open(args.keys_file) as f:
+            keys = [line.strip() for line in f if line.strip()]
+
     VideoDataset = datasets.get_dataset_class(args.dataset)
     dataset = VideoDataset(
         args.input_dir,
@@ -102,7 +113,8 @@ def main():
         num_epochs=args.num_epochs,
         seed=args.seed,
         hparams_dict=dataset_hparams_dict,
-        hparams=args.dataset_hparams)
+        hparams=args.dataset_hparams,
+        keys=keys)
 
     VideoPredictionModel = models.get_model_class(args.model)
     hparams_dict = dict(model_hparams_dict)
@@ -120,13 +132,15 @@ def main():
     context_frames = model.hparams.context_frames
     future_length = sequence_length - context_frames
 
-    if args.num_samples:
+    if dataset.keys is not None:
+        # the last batch is padded, see BaseVideoDataset.padded_keys
+        num_examples_per_epoch = len(dataset.padded_keys(args.batch_size))
+    elif args.num_samples:
         if args.num_samples > dataset.num_examples_per_epoch():
             raise ValueError('num_samples cannot be larger than the dataset')
         num_examples_per_epoch = args.num_samples
     else:
         num_examples_per_epoch = dataset.num_examples_per_epoch()
-    print('HELLOO',num_examples_per_epoch, args.batch_size)
     if num_examples_per_epoch % args.batch_size != 0:
         raise ValueError('batch_size should evenly divide the dataset size %d' % num_examples_per_epoch)
 
@@ -152,8 +166,11 @@ def main():
 
     model.restore(sess, args.checkpoint)
 
+    writer = OutputWriter(args.num_writers)
+    save_gif_fns = {'pil': save_gif, 'ffmpeg': ffmpeg_save_gif}
     sample_ind = 0
     # dir_every_n = 128
+    # without keys, input_dir is the directory of the tfrecord of a single tile
     key = args.input_dir.split('/')[-1]
     while True:
         if args.num_samples and sample_ind >= args.num_samples:
@@ -172,30 +189,31 @@ def main():
             # only keep the future frames
             gen_images = gen_images[:, -future_length:]
             for i, gen_images_ in enumerate(gen_images):
+                output_ind = sample_ind + i
+                if dataset.keys is not None:
+                    if sample_ind + i >= len(dataset.keys):
+                        continue  # padding of the last batch
+                    # same layout as one tile per input_dir: <key>/gen_image_00000_...
+                    key, output_ind = dataset.keys[sample_ind + i], 0
                 context_images_ = (input_results['images'][i] * 255.0).astype(np.uint8)
                 gen_images_ = (gen_images_ * 255.0).astype(np.uint8)
 
-                gen_images_fname = 'gen_image_%05d_%02d.gif' % (sample_ind + i, stochastic_sample_ind)
-                context_and_gen_images = list(context_images_[:context_frames]) + list(gen_images_)
-                if args.gif_length:
-                    context_and_gen_images = context_and_gen_images[:args.gif_length]
-                # output_dir = os.path.join(args.output_gif_dir, '{}_{}'.format(sample_ind, sample_ind + args.batch_size), gen_images_fname)
-                # print('SAVE GIF', output_dir, gen_images_fname)
-                save_gif(os.path.join(args.output_gif_dir, key, gen_images_fname),
-                         context_and_gen_images, fps=args.fps)
+                if args.gif != 'none':
+                    gen_images_fname = 'gen_image_%05d_%02d.gif' % (output_ind, stochastic_sample_ind)
+                    context_and_gen_images = list(context_images_[:context_frames]) + list(gen_images_)
+                    if args.gif_length:
+                        context_and_gen_images = context_and_gen_images[:args.gif_length]
+                    writer.put(save_gif_fns[args.gif], os.path.join(args.output_gif_dir, key, gen_images_fname),
+                               context_and_gen_images, fps=args.fps)
 
                 gen_image_fname_pattern = 'gen_image_%%05d_%%02d_%%0%dd.png' % max(2, len(str(len(gen_images_) - 1)))
-                for t, gen_image in enumerate(gen_images_):
-                    gen_image_fname = gen_image_fname_pattern % (sample_ind + i, stochastic_sample_ind, t)
-                    if gen_image.shape[-1] == 1:
-                      gen_image = np.tile(gen_image, (1, 1, 3))
-                    else:
-                      gen_image = cv2.cvtColor(gen_image, cv2.COLOR_RGB2BGR)
-                    # output_dir = os.path.join(args.output_png_dir, '{}_{}'.format(sample_ind, sample_ind + args.batch_size), gen_image_fname)
-                    print('SAVE PNG', key)
-                    cv2.imwrite(os.path.join(args.output_png_dir, key, gen_image_fname), gen_image)
+                gen_image_fnames = [os.path.join(args.output_png_dir, key, gen_image_fname_pattern %
+                                                 (output_ind, stochastic_sample_ind, t))
+                                    for t in range(len(gen_images_))]
+                writer.put(save_pngs, gen_image_fnames, list(gen_images_))
 
         sample_ind += args.batch_size
+    writer.close()
 
 
 if __name__ == '__main__':
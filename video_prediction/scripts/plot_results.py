@@ -3,20 +3,11 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
-import glob
 import os
 
 import numpy as np
 
-
-def load_metrics(prefix_fname):
-    import csv
-    with open('%s.csv' % prefix_fname, newline='') as csvfile:
-        reader = csv.reader(csvfile, delimiter='\t', quotechar='|')
-        rows = list(reader)
-        # skip header (first row), indices (first column), and means (last column)
-        metrics = np.array(rows)[1:, 1:-1].astype(np.float32)
-    return metrics
+from video_prediction.utils.metrics_store import list_method_metrics, load_method_metrics, load_method_store
 
 
 def plot_metric(metric, start_x=0, color=None, label=None, zorder=None):
@@ -142,17 +133,16 @@ def main():
     if args.usetex:
         method_names = [method_name.replace('kl_weight', r'$\lambda_{\textsc{kl}}$') for method_name in method_names]
     method_dirs = [os.path.join(args.results_dir, method_dir) for method_dir in method_dirs]
+    # metrics stores of the methods, read once
+    stores = {method_dir: load_method_store(method_dir) for method_dir in method_dirs}
 
     # infer task and metric names from first method
-    metric_fnames = sorted(glob.glob('%s/*_max/metrics/*.csv' % glob.escape(method_dirs[0])))
     task_names = []
-    metric_names = []  # all the metric names inferred from file names
-    for metric_fname in metric_fnames:
-        head, tail = os.path.split(metric_fname)
-        task_name = head.split('/')[-2]
-        metric_name, _ = os.path.splitext(tail)
-        task_names.append(task_name)
-        metric_names.append(metric_name)
+    metric_names = []  # all the metric names of the store or the csv files
+    for task_name, metric_name in list_method_metrics(method_dirs[0], store=stores[method_dirs[0]]):
+        if task_name.endswith('_max'):
+            task_names.append(task_name)
+            metric_names.append(metric_name)
 
     # save plots
     dataset_name = args.dataset_name or os.path.split(os.path.normpath(args.results_dir))[1]
@@ -195,11 +185,10 @@ def main():
             plt.subplot(len(plot_metric_names), 1, i_task + 1)
 
         for method_name, method_dir in zip(method_names, method_dirs):
-            metric_fname = os.path.join(method_dir, task_name, 'metrics', metric_name)
-            if not os.path.isfile('%s.csv' % metric_fname):
-                print('Skipping', metric_fname)
+            if (task_name, metric_name) not in list_method_metrics(method_dir, store=stores[method_dir]):
+                print('Skipping', os.path.join(method_dir, task_name, metric_name))
                 continue
-            metric = load_metrics(metric_fname)
+            metric = load_method_metrics(method_dir, task_name, metric_name, store=stores[method_dir])
             plot_metric(metric, context_frames + 1, color=get_color(os.path.basename(method_dir)), label=method_name)
 
         plt.grid(axis='y')
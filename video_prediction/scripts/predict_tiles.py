@@ -0,0 +1,190 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import errno
+import json
+import os
+import random
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from video_prediction import datasets, models
+from video_prediction.utils.output_writer import OutputWriter, save_pngs
+
+
+def read_keys(args, dataset):
+    """
+    Keys of the tiles to predict: --keys, --keys_file or all the keys of the shard index.
+    """
+    if args.keys_file:
+        with open(args.keys_file) as f:
+            return [line.strip() for line in f if line.strip()]
+    if args.keys:
+        return args.keys
+    if dataset.index is None:
+        raise FileNotFoundError('No %s was found in %s. Build the shards with tfrecord_builder.py.' %
+                                (datasets.base_dataset.INDEX_FNAME, dataset.input_dir))
+    return [record[2] for record in dataset.index['records']]
+
+
+def output_fnames(output_dir, key, future_length):
+    """
+    Predicted frames of a tile, in the layout of one tile per generate.py run, read by
+    VideoDataset of the segmentation package: <output_dir>/<key>/gen_image_00000_00_<t>.png
+    """
+    fname_pattern = 'gen_image_%%05d_%%02d_%%0%dd.png' % max(2, len(str(future_length - 1)))
+    return [os.path.join(output_dir, key, fname_pattern % (0, 0, t)) for t in range(future_length)]
+
+
+def main():
+    """
+    Predict the future frames of many tiles with one model loaded once, instead of
+    one generate.py process per tile (see run_all.py). The tiles are read by key
+    from the shards and their index (see tfrecord_builder.py), batch_size tiles
+    per sess.run, and the images are written by a thread pool while the next
+    batches are predicted.
+
+    python scripts/predict_tiles.py --input_dir data/landsat --checkpoint logs/landsat/ours_deterministic_l1 \
+        --results_dir results/landsat --batch_size 32 --intra_op_threads 16
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", type=str, required=True, help="either a directory containing subdirectories "
+                                                                     "train, val, test, etc, or a directory containing "
+                                                                     "the tfrecords and their index.json")
+    parser.add_argument("--results_dir", type=str, default='results', help="ignored if output_dir is specified")
+    parser.add_argument("--output_dir", help="output directory of the tiles. default is results_dir/model_fname, "
+                                             "where model_fname is the directory name of checkpoint")
+    parser.add_argument("--checkpoint", required=True, help="directory with checkpoint or checkpoint name "
+                                                            "(e.g. checkpoint_dir/model-200000)")
+
+    parser.add_argument("--mode", type=str, choices=['val', 'test'], default='test', help='mode for dataset, val or test.')
+
+    parser.add_argument("--dataset", type=str, help="dataset class name")
+    parser.add_argument("--dataset_hparams", type=str, default='sequence_length=5',
+                        help="a string of comma separated list of dataset hyperparameters")
+    parser.add_argument("--model", type=str, help="model class name")
+    parser.add_argument("--model_hparams", type=str, help="a string of comma separated list of model hyperparameters")
+
+    parser.add_argument("--keys", type=str, nargs='+', help="keys of the tiles (all the keys of the index by default)")
+    parser.add_argument("--keys_file", type=str, help="file with the keys of the tiles, one per line")
+    parser.add_argument("--skip_existing", action='store_true', help="skip the tiles whose frames are already saved")
+
+    parser.add_argument("--batch_size", type=int, default=32, help="number of tiles per sess.run")
+    parser.add_argument("--intra_op_threads", type=int, default=0, help="threads of an op (0: number of cores)")
+    parser.add_argument("--inter_op_threads", type=int, default=0, help="ops run in parallel (0: number of cores)")
+    parser.add_argument("--num_writers", type=int, default=4, help="threads saving the images (0: in the session loop)")
+
+    parser.add_argument("--gpu_mem_frac", type=float, default=0, help="fraction of gpu memory to use")
+    parser.add_argument("--seed", type=int, default=7)
+
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        tf.set_random_seed(args.seed)
+        np.random.seed(args.seed)
+        random.seed(args.seed)
+
+    checkpoint_dir = os.path.normpath(args.checkpoint)
+    if not os.path.isdir(args.checkpoint):
+        checkpoint_dir, _ = os.path.split(checkpoint_dir)
+    if not os.path.exists(checkpoint_dir):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), checkpoint_dir)
+    with open(os.path.join(checkpoint_dir, "options.json")) as f:
+        print("loading options from checkpoint %s" % args.checkpoint)
+        options = json.loads(f.read())
+        args.dataset = args.dataset or options['dataset']
+        args.model = args.model or options['model']
+    dataset_hparams_dict = {}
+    model_hparams_dict = {}
+    try:
+        with open(os.path.join(checkpoint_dir, "dataset_hparams.json")) as f:
+            dataset_hparams_dict = json.loads(f.read())
+    except FileNotFoundError:
+        print("dataset_hparams.json was not loaded because it does not exist")
+    try:
+        with open(os.path.join(checkpoint_dir, "model_hparams.json")) as f:
+            model_hparams_dict = json.loads(f.read())
+    except FileNotFoundError:
+        print("model_hparams.json was not loaded because it does not exist")
+    args.output_dir = args.output_dir or os.path.join(args.results_dir, os.path.split(checkpoint_dir)[1])
+
+    print('----------------------------------- Options ------------------------------------')
+    for k, v in args._get_kwargs():
+        print(k, "=", v)
+    print('------------------------------------- End --------------------------------------')
+
+    VideoDataset = datasets.get_dataset_class(args.dataset)
+    dataset = VideoDataset(
+        args.input_dir,
+        mode=args.mode,
+        num_epochs=1,
+        seed=args.seed,
+        hparams_dict=dataset_hparams_dict,
+        hparams=args.dataset_hparams)
+
+    VideoPredictionModel = models.get_model_class(args.model)
+    hparams_dict = dict(model_hparams_dict)
+    hparams_dict.update({
+        'context_frames': dataset.hparams.context_frames,
+        'sequence_length': dataset.hparams.sequence_length,
+        'repeat': dataset.hparams.time_shift,
+    })
+    model = VideoPredictionModel(
+        mode=args.mode,
+        hparams_dict=hparams_dict,
+        hparams=args.model_hparams)
+    future_length = model.hparams.sequence_length - model.hparams.context_frames
+
+    keys = read_keys(args, dataset)
+    if args.skip_existing:
+        keys = [key for key in keys
+                if not all(os.path.exists(fname) for fname in output_fnames(args.output_dir, key, future_length))]
+    if not keys:
+        print('no tiles to predict')
+        return
+    dataset.select_keys(keys)
+    batch_keys = dataset.padded_keys(args.batch_size)
+
+    # the model reads the batches of the dataset directly, without feeding them back
+    inputs = dataset.make_batch(args.batch_size)
+    with tf.variable_scope(''):
+        model.build_graph(inputs)
+    gen_images = model.outputs['gen_images'][:, -future_length:]
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    with open(os.path.join(args.output_dir, "options.json"), "w") as f:
+        f.write(json.dumps(vars(args), sort_keys=True, indent=4))
+
+    gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.gpu_mem_frac)
+    config = tf.ConfigProto(gpu_options=gpu_options, allow_soft_placement=True,
+                            intra_op_parallelism_threads=args.intra_op_threads,
+                            inter_op_parallelism_threads=args.inter_op_threads)
+    sess = tf.Session(config=config)
+    sess.graph.as_default()
+    model.restore(sess, args.checkpoint)
+
+    writer = OutputWriter(args.num_writers)
+    start = time.time()
+    sample_ind = 0
+    while sample_ind < len(keys):
+        try:
+            gen_images_ = sess.run(gen_images)
+        except tf.errors.OutOfRangeError:
+            break
+        num_valid = min(args.batch_size, len(keys) - sample_ind)
+        gen_images_ = (gen_images_[:num_valid] * 255.0).astype(np.uint8)
+        for key, tile_images in zip(batch_keys[sample_ind:sample_ind + num_valid], gen_images_):
+            writer.put(save_pngs, output_fnames(args.output_dir, key, future_length), list(tile_images))
+        sample_ind += args.batch_size
+        print("predicted %d/%d tiles, %.2f tiles/s" %
+              (min(sample_ind, len(keys)), len(keys), min(sample_ind, len(keys)) / (time.time() - start)))
+    writer.close()
+
+
+if __name__ == '__main__':
+    main()
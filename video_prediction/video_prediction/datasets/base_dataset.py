@@ -1,17 +1,31 @@
 import glob
+import json
 import os
 import random
 import re
+import struct
 from collections import OrderedDict
 
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.training import HParams
 
+INDEX_FNAME = 'index.json'  # written by tfrecord_builder.py
+
+
+def read_record(f, offset):
+    """
+    Read the serialized example of the TFRecord at offset of an open shard.
+    """
+    f.seek(offset)
+    length, = struct.unpack('<Q', f.read(8))
+    f.read(4)  # crc of the length
+    return f.read(length)
+
 
 class BaseVideoDataset(object):
     def __init__(self, input_dir, mode='train', num_epochs=None, seed=None,
-                 hparams_dict=None, hparams=None):
+                 hparams_dict=None, hparams=None, keys=None):
         """
         Args:
             input_dir: either a directory containing subdirectories train,
@@ -24,6 +38,9 @@ class BaseVideoDataset(object):
             hparams: a string of comma separated list of `name=value` pairs,
                 where `name` must be defined in `self.get_default_hparams()`.
                 These values overrides any values in hparams_dict (if any).
+            keys: keys of the sequences to read, in this order, instead of
+                all the tfrecords. It needs the index.json of the shards
+                (see tfrecord_builder.py).
 
         Note:
             self.input_dir is the directory containing the tfrecords.
@@ -50,6 +67,15 @@ class BaseVideoDataset(object):
             raise FileNotFoundError('No tfrecords were found in %s.' % self.input_dir)
         self.dataset_name = os.path.basename(os.path.split(self.input_dir)[0])
 
+        self.index = None
+        index_fname = os.path.join(self.input_dir, INDEX_FNAME)
+        if os.path.exists(index_fname):
+            with open(index_fname) as index_file:
+                self.index = json.load(index_file)
+        self.keys = None
+        if keys is not None:
+            self.select_keys(keys)
+
         self.state_like_names_and_shapes = OrderedDict()
         self.action_like_names_and_shapes = OrderedDict()
 
@@ -126,14 +152,65 @@ class BaseVideoDataset(object):
         """
         raise NotImplementedError
 
+    def select_keys(self, keys):
+        """
+        Read only the sequences of keys, in this order, using the index of the shards.
+        """
+        if self.index is None:
+            raise FileNotFoundError('No %s was found in %s, it is needed to select keys.' %
+                                    (INDEX_FNAME, self.input_dir))
+        record_keys = set(record[2] for record in self.index['records'])
+        missing = [key for key in keys if key not in record_keys]
+        if missing:
+            raise ValueError('Keys not found in %s: %s' % (self.input_dir, ', '.join(missing[:10])))
+        self.keys = list(keys)
+
+    def padded_keys(self, batch_size):
+        """
+        Selected keys in the order of the samples of make_dataset (which neither
+        filters nor shuffles them). The batches have a fixed size, so the last
+        key is repeated up to a multiple of batch_size.
+        """
+        return self.keys + self.keys[-1:] * (-len(self.keys) % batch_size)
+
+    def make_keys_dataset(self, batch_size):
+        """
+        Dataset of the serialized examples of the selected keys, read at their
+        offset in the shards.
+        """
+        records = {key: (shard, offset) for shard, offset, key, _ in self.index['records']}
+        locations = [records[key] for key in self.padded_keys(batch_size)]
+        shard_fnames = [os.path.join(self.input_dir, shard['filename']) for shard in self.index['shards']]
+
+        def generator():
+            shard_file, shard_id = None, None
+            try:
+                for shard, offset in locations:
+                    if shard != shard_id:
+                        if shard_file is not None:
+                            shard_file.close()
+                        shard_file, shard_id = open(shard_fnames[shard], 'rb'), shard
+                    yield read_record(shard_file, offset)
+            finally:
+                if shard_file is not None:
+                    shard_file.close()
+
+        return tf.data.Dataset.from_generator(generator, tf.string, tf.TensorShape([]))
+
     def make_dataset(self, batch_size):
         filenames = self.filenames
         shuffle = self.mode == 'train' or (self.mode == 'val' and self.hparams.shuffle_on_val)
-        if shuffle:
-            random.shuffle(filenames)
 
-        dataset = tf.data.TFRecordDataset(filenames, buffer_size=8 * 1024 * 1024)
-        dataset = dataset.filter(self.filter)
+        if self.keys is not None:
+            # sample i is padded_keys()[i]: the selected records are neither
+            # filtered out nor shuffled, and the batches are full by construction
+            shuffle = False
+            dataset = self.make_keys_dataset(batch_size)
+        else:
+            if shuffle:
+                random.shuffle(filenames)
+            dataset = tf.data.TFRecordDataset(filenames, buffer_size=8 * 1024 * 1024)
+            dataset = dataset.filter(self.filter)
         if shuffle:
             dataset = dataset.apply(tf.contrib.data.shuffle_and_repeat(buffer_size=1024, count=self.num_epochs))
         else:
@@ -7,10 +7,10 @@ import random
 import re
 
 import numpy as np
-import skimage.io
 import tensorflow as tf
 
 from video_prediction.datasets.base_dataset import VarLenFeatureVideoDataset
+from video_prediction.datasets.tfrecord_builder import build_tfrecords
 from video_prediction.datasets.utils import get_list_of_files
 
 class CroppedVideoDataset(VarLenFeatureVideoDataset):
@@ -47,17 +47,6 @@ class CroppedVideoDataset(VarLenFeatureVideoDataset):
         return np.sum(np.array(sequence_lengths) >= self.hparams.sequence_length)
 
 
-def _bytes_feature(value):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
-
-
-def _bytes_list_feature(values):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
-
-
-def _int64_feature(value):
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
-
 # TODO: put in utils
 def get_tile_info(tile):
     """
@@ -116,24 +105,6 @@ def get_imgs(img_dir, limit=float("inf")):
             break
     return data
 
-def save_tf_record(output_fname, sequences):
-    print('saving sequences to %s' % output_fname)
-    with tf.python_io.TFRecordWriter(output_fname) as writer:
-        for sequence in sequences:
-            num_frames = len(sequence) # 6, 2 years
-            height, width, channels = sequence[0].shape
-            encoded_sequence = [image.tostring() for image in sequence]
-            # print('num_frames', num_frames, height, width, channels, len(encoded_sequence), sequence[0].dtype)
-            features = tf.train.Features(feature={
-                'sequence_length': _int64_feature(num_frames),
-                'height': _int64_feature(height),
-                'width': _int64_feature(width),
-                'channels': _int64_feature(channels),
-                'images/encoded': _bytes_list_feature(encoded_sequence)
-            })
-            example = tf.train.Example(features=features)
-            writer.write(example.SerializeToString())
-
 def get_quad_list(quad):
     return [
         quad['q1'],
@@ -142,72 +113,32 @@ def get_quad_list(quad):
         quad['q4'],
     ]
 
-def read_frames_and_save_tf_records(output_dir, img_quads, image_size, partition_name, sequences_per_file=4):
+def read_frames_and_save_tf_records(output_dir, img_quads, image_size, partition_name, sequences_per_file=4,
+                                    num_workers=None):
     """
     img_quads: {
         key1: {year_q1: img1, year_q2: img2, year_q3: img3}
         key2: {year_q1: img1, year_q2: img2, year_q3: img3}
     }
+    The shards are read and written in parallel, see tfrecord_builder.py
     """
     partition_name = os.path.split(output_dir)[1]
-    img2seq = {}
-    sequences = []
-    sequence_iter = 0
-    sequence_lengths_file = open(os.path.join(output_dir, 'sequence_lengths.txt'), 'w')
-    for video_iter, key in enumerate(img_quads.keys()):
-        frame_fnames = get_quad_list(img_quads[key])
-        frames = skimage.io.imread_collection(frame_fnames)
-        frames = [frame[:,:,:3] for frame in frames] # take only RGB
-        # for f in frames:
-        #     print(type(f), f.shape, f.meta)
-        if not sequences:
-            last_start_sequence_iter = sequence_iter
-            print("reading sequences starting at sequence %d" % sequence_iter)
-        sequences.append(frames)
-        sequence_iter += 1
-        sequence_lengths_file.write("%d\n" % len(frames)) # should be always 3
-        if (len(sequences) == sequences_per_file or
-                (video_iter == (len(img_quads) - 1))):
-            output_fname = 'sequence_{0}_to_{1}.tfrecords'.format(last_start_sequence_iter, sequence_iter - 1)
-            img2seq[key] = output_fname
-            output_fname = os.path.join(output_dir, output_fname)
-            print('SEQ2IMG', key, output_fname)
-            save_tf_record(output_fname, sequences)
-            sequences[:] = []
-    sequence_lengths_file.close()
-    out_file = os.path.join(output_fname, partition_name + 'img2seq.pkl' )
+    sequences = [(key, get_quad_list(img_quads[key])) for key in img_quads.keys()]
+    index = build_tfrecords(output_dir, sequences, sequences_per_file, num_workers)
+    # shard of every image
+    img2seq = {key: index['shards'][shard]['filename'] for shard, _, key, _ in index['records']}
     with open(partition_name + 'img2seq.pkl', 'wb') as pkl_file:
         pkl.dump(img2seq, pkl_file)
 
-def read_frames_and_save_single_tf_records(output_dir, img_quads, sequences_per_file=1):
+def read_frames_and_save_single_tf_records(output_dir, key, img_quad):
     """
-    img_quads: {
-        key1: {year_q1: img1, year_q2: img2, year_q3: img3}
-        key2: {year_q1: img1, year_q2: img2, year_q3: img3}
+    Write the sequence of a single tile in its own shard, with the encoding
+    and the index of build_tfrecords.
+    img_quad: {
+        year_q1: img1, year_q2: img2, year_q3: img3
     }
     """
-    partition_name = os.path.split(output_dir)[1]
-    img2seq = {}
-    sequences = []
-    sequence_iter = 0
-    sequence_lengths_file = open(os.path.join(output_dir, 'sequence_lengths.txt'), 'w')
-    frame_fnames = get_quad_list(img_quads)
-    frames = skimage.io.imread_collection(frame_fnames)
-    frames = [frame[:,:,:3] for frame in frames] # take only RGB
-    if not sequences:
-        last_start_sequence_iter = sequence_iter
-        print("reading sequences starting at sequence %d" % sequence_iter)
-    sequences.append(frames)
-    sequence_iter += 1
-    sequence_lengths_file.write("%d\n" % len(frames)) # should be always 3
-    print(len(sequences))
-    if len(sequences) == sequences_per_file:
-        output_fname = 'sequence_{0}_to_{1}.tfrecords'.format(0, 3)
-        output_fname = os.path.join(output_dir, output_fname)
-        save_tf_record(output_fname, sequences)
-        print(output_fname, 'saved!')
-        sequences[:] = []
-    sequence_lengths_file.close()
+    build_tfrecords(output_dir, [(key, get_quad_list(img_quad))], sequences_per_file=1, num_workers=1)
 
 def part_dict(dic, num):
     total = len(dic)
@@ -264,7 +195,7 @@ def main():
         print(output_dir)
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-        read_frames_and_save_single_tf_records(output_dir, imgs[key])
+        read_frames_and_save_single_tf_records(output_dir, key, imgs[key])
 
 
 if __name__ == '__main__':
@@ -7,10 +7,10 @@ import random
 import re
 
 import numpy as np
-import skimage.io
 import tensorflow as tf
 
 from video_prediction.datasets.base_dataset import VarLenFeatureVideoDataset
+from video_prediction.datasets.tfrecord_builder import build_tfrecords
 
 
 class LandsatVideoDataset(VarLenFeatureVideoDataset):
@@ -43,18 +43,6 @@ class LandsatVideoDataset(VarLenFeatureVideoDataset):
         return np.sum(np.array(sequence_lengths) >= self.hparams.sequence_length)
 
 
-def _bytes_feature(value):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
-
-
-def _bytes_list_feature(values):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
-
-
-def _int64_feature(value):
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
-
-
 def add_in_dict(dic, key, q, data):
 
     if key in dic:
@@ -100,87 +88,32 @@ def get_imgs(img_dir):
         add_img(data, img_dir, year, z, x, y)
     return data
 
-def save_tf_record(output_fname, sequences):
-    print('saving sequences to %s' % output_fname)
-    with tf.python_io.TFRecordWriter(output_fname) as writer:
-        for sequence in sequences:
-            num_frames = len(sequence) # 6, 2 years
-            height, width, channels = sequence[0].shape
-            encoded_sequence = [image.tostring() for image in sequence]
-            features = tf.train.Features(feature={
-                'sequence_length': _int64_feature(num_frames),
-                'height': _int64_feature(height),
-                'width': _int64_feature(width),
-                'channels': _int64_feature(channels),
-                'images/encoded': _bytes_list_feature(encoded_sequence),
-            })
-            example = tf.train.Example(features=features)
-            writer.write(example.SerializeToString())
-
 def get_quad_list(imgs):
     return [
         imgs['2013'], imgs['2014'], imgs['2015'], imgs['2016'], imgs['2017']
     ]
 
 
-def read_frames_and_save_tf_records(output_dir, img_quads, sequences_per_file=128):
+def read_frames_and_save_tf_records(output_dir, img_quads, sequences_per_file=128, num_workers=None):
     """
     img_quads: {
-        year: landsat_year
+        key: {year: landsat_year}
     }
+    The shards are read and written in parallel, see tfrecord_builder.py
     """
-    partition_name = os.path.split(output_dir)[1]
-
-    sequences = []
-    sequence_iter = 0
-    sequence_lengths_file = open(os.path.join(output_dir, 'sequence_lengths.txt'), 'w')
-    for video_iter, key in enumerate(img_quads.keys()):
-        frame_fnames = get_quad_list(img_quads[key])
-        # frame_fnames = [quads['q1'], quads['q2'], quads['q3'], quads['q4']]
-        # print('Opening', frame_fnames)
-        frames = skimage.io.imread_collection(frame_fnames)
-        frames = [frame[:,:,:3] for frame in frames] # take only RGB
-        if not sequences:
-            last_start_sequence_iter = sequence_iter
-            print("reading sequences starting at sequence %d" % sequence_iter)
-        sequences.append(frames)
-        sequence_iter += 1
-        sequence_lengths_file.write("%d\n" % len(frames)) # should be always 3
-        if (len(sequences) == sequences_per_file or
-                (video_iter == (len(img_quads) - 1))):
-            output_fname = 'sequence_{0}_to_{1}.tfrecords'.format(last_start_sequence_iter, sequence_iter - 1)
-            output_fname = os.path.join(output_dir, output_fname)
-            save_tf_record(output_fname, sequences)
-            sequences[:] = []
-    sequence_lengths_file.close()
+    sequences = [(key, get_quad_list(img_quads[key])) for key in img_quads.keys()]
+    build_tfrecords(output_dir, sequences, sequences_per_file, num_workers)
 
 
-def read_frames_and_save_single_tf_records(output_dir, img_quads, sequences_per_file=1):
+def read_frames_and_save_single_tf_records(output_dir, key, img_quad):
     """
-    img_quads: {
+    Write the sequence of a single tile in its own shard, with the encoding
+    and the index of build_tfrecords.
+    img_quad: {
         year: landsat_year
     }
     """
-    partition_name = os.path.split(output_dir)[1]
-    sequences = [] 
-    sequence_iter = 0
-    sequence_lengths_file = open(os.path.join(output_dir, 'sequence_lengths.txt'), 'w')
-    frame_fnames = get_quad_list(img_quads)
-    frames = skimage.io.imread_collection(frame_fnames)
-    frames = [frame[:,:,:3] for frame in frames] # take only RGB
-    if not sequences:
-        last_start_sequence_iter = sequence_iter
-        print("reading sequences starting at sequence %d" % sequence_iter)
-    sequences.append(frames)
-    sequence_iter += 1
-    sequence_lengths_file.write("%d\n" % len(frames)) # should be always 3
-    if (len(sequences) == sequences_per_file or
-            (video_iter == (len(img_quads) - 1))):
-        output_fname = 'sequence_{0}_to_{1}.tfrecords'.format(0, 3)
-        output_fname = os.path.join(output_dir, output_fname)
-        save_tf_record(output_fname, sequences)
-        sequences[:] = []
-    sequence_lengths_file.close()
+    build_tfrecords(output_dir, [(key, get_quad_list(img_quad))], sequences_per_file=1, num_workers=1)
 
 
 def part_dict(dic, num):
@@ -225,7 +158,7 @@ def create_dataset_from_scratch(args):
         partition_dir = os.path.join(args.output_dir, partition_name)
         if not os.path.exists(partition_dir):
             os.makedirs(partition_dir)
-        read_frames_and_save_tf_records(partition_dir, partition_quad)
+        read_frames_and_save_tf_records(partition_dir, partition_quad, num_workers=args.num_workers)
 
 def create_single_test_dataset(args):
     with open('train_val_test.pkl', 'rb') as pkl_file:
@@ -236,7 +169,7 @@ def create_single_test_dataset(args):
         output_dir = os.path.join(args.output_dir, key, 'test')
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-        read_frames_and_save_single_tf_records(output_dir, test_files[key], sequences_per_file=1)
+        read_frames_and_save_single_tf_records(output_dir, key, test_files[key])
 
 
 def create_single_test_dataset_tmp(args):
@@ -258,7 +191,7 @@ def create_single_test_dataset_tmp(args):
                 '2016': os.path.join(path, '2016', tmpl.format('2016',z,x,y)),
                 '2017': os.path.join(path, '2017', tmpl.format('2017',z,x,y)),
                 }
-        read_frames_and_save_single_tf_records(output_dir, files_dict, sequences_per_file=1)
+        read_frames_and_save_single_tf_records(output_dir, key, files_dict)
     
 
 def main():
@@ -266,6 +199,7 @@ def main():
     parser.add_argument("--input_dir", type=str, help="directory containing the quarter mosaics from landsat")
     parser.add_argument("--output_dir", type=str)
     parser.add_argument("--dataset_type", type=str, help="whether to create dataset from scratch, or just generate separate TFRecords for image tracking")
+    parser.add_argument("--num_workers", type=int, default=None, help="number of parallel workers (default: number of cpus)")
     args = parser.parse_args()
     if args.dataset_type == 'scratch':
         create_dataset_from_scratch(args)
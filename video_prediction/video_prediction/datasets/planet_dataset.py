@@ -7,10 +7,10 @@ import random
 import re
 
 import numpy as np
-import skimage.io
 import tensorflow as tf
 
 from video_prediction.datasets.base_dataset import VarLenFeatureVideoDataset
+from video_prediction.datasets.tfrecord_builder import build_tfrecords
 
 
 class PlanetVideoDataset(VarLenFeatureVideoDataset):
@@ -47,18 +47,6 @@ class PlanetVideoDataset(VarLenFeatureVideoDataset):
         return np.sum(np.array(sequence_lengths) >= self.hparams.sequence_length)
 
 
-def _bytes_feature(value):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
-
-
-def _bytes_list_feature(values):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
-
-
-def _int64_feature(value):
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
-
-
 def add_in_dict(dic, key, q, data):
 
     if key in dic:
@@ -146,23 +134,6 @@ def get_imgs(img_dir, limit=5000):
     return new_data
 """
 
-def save_tf_record(output_fname, sequences):
-    print('saving sequences to %s' % output_fname)
-    with tf.python_io.TFRecordWriter(output_fname) as writer:
-        for sequence in sequences:
-            num_frames = len(sequence) # 6, 2 years
-            height, width, channels = sequence[0].shape
-            encoded_sequence = [image.tostring() for image in sequence]
-            features = tf.train.Features(feature={
-                'sequence_length': _int64_feature(num_frames),
-                'height': _int64_feature(height),
-                'width': _int64_feature(width),
-                'channels': _int64_feature(channels),
-                'images/encoded': _bytes_list_feature(encoded_sequence),
-            })
-            example = tf.train.Example(features=features)
-            writer.write(example.SerializeToString())
-
 def get_quad_list(key, quad):
     info = key.split('_')
     year, z, x, y = int(info[0]), info[1], info[2], info[3]
@@ -178,36 +149,16 @@ def get_quad_list(key, quad):
         quad[str(year)]['q4']
     ]
 
-def read_frames_and_save_tf_records(output_dir, img_quads, image_size, sequences_per_file=128):
+def read_frames_and_save_tf_records(output_dir, img_quads, image_size, sequences_per_file=128, num_workers=None):
     """
     img_quads: {
         key1: {year_q1: img1, year_q2: img2, year_q3: img3}
         key2: {year_q1: img1, year_q2: img2, year_q3: img3}
     }
+    The shards are read and written in parallel, see tfrecord_builder.py
     """
-    partition_name = os.path.split(output_dir)[1]
-
-    sequences = []
-    sequence_iter = 0
-    sequence_lengths_file = open(os.path.join(output_dir, 'sequence_lengths.txt'), 'w')
-    for video_iter, key in enumerate(img_quads.keys()):
-        frame_fnames = get_quad_list(key, img_quads[key])
-        # frame_fnames = [quads['q1'], quads['q2'], quads['q3'], quads['q4']]
-        frames = skimage.io.imread_collection(frame_fnames)
-        frames = [frame[:,:,:3] for frame in frames] # take only RGB
-        if not sequences:
-            last_start_sequence_iter = sequence_iter
-            print("reading sequences starting at sequence %d" % sequence_iter)
-        sequences.append(frames)
-        sequence_iter += 1
-        sequence_lengths_file.write("%d\n" % len(frames)) # should be always 3
-        if (len(sequences) == sequences_per_file or
-                (video_iter == (len(img_quads) - 1))):
-            output_fname = 'sequence_{0}_to_{1}.tfrecords'.format(last_start_sequence_iter, sequence_iter - 1)
-            output_fname = os.path.join(output_dir, output_fname)
-            save_tf_record(output_fname, sequences)
-            sequences[:] = []
-    sequence_lengths_file.close()
+    sequences = [(key, get_quad_list(key, img_quads[key])) for key in img_quads.keys()]
+    build_tfrecords(output_dir, sequences, sequences_per_file, num_workers)
 
 def part_dict(dic, num):
     total = len(dic)
@@ -238,6 +189,7 @@ def main():
     parser.add_argument("input_dir", type=str, help="directory containing the quarter mosaics from planet")
     parser.add_argument("output_dir", type=str)
     parser.add_argument("image_size", type=int)
+    parser.add_argument("--num_workers", type=int, default=None, help="number of parallel workers (default: number of cpus)")
     args = parser.parse_args()
 
     partition_names = ['train', 'val', 'test']
@@ -250,7 +202,7 @@ def main():
         partition_dir = os.path.join(args.output_dir, partition_name)
         if not os.path.exists(partition_dir):
             os.makedirs(partition_dir)
-        read_frames_and_save_tf_records(partition_dir, partition_quad, args.image_size)
+        read_frames_and_save_tf_records(partition_dir, partition_quad, args.image_size, num_workers=args.num_workers)
 
 
 if __name__ == '__main__':
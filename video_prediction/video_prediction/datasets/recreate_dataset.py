@@ -6,24 +6,12 @@ import pickle
 import random
 import re
 import numpy as np
-import skimage.io
-import tensorflow as tf
 import collections
 import pickle as pkl
 from video_prediction.datasets.base_dataset import VarLenFeatureVideoDataset
+from video_prediction.datasets.tfrecord_builder import build_tfrecords
 from video_prediction.datasets.utils import get_list_of_files
 
-def _bytes_feature(value):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
-
-
-def _bytes_list_feature(values):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
-
-
-def _int64_feature(value):
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
-
 # TODO: put in utils
 def get_tile_info(tile):
     """
@@ -82,24 +70,6 @@ def get_imgs(img_dir, limit=float("inf")):
             break
     return data
 
-def save_tf_record(output_fname, sequences):
-    print('saving sequences to %s' % output_fname)
-    with tf.python_io.TFRecordWriter(output_fname) as writer:
-        for sequence in sequences:
-            num_frames = len(sequence) # 6, 2 years
-            height, width, channels = sequence[0].shape
-            encoded_sequence = [image.tostring() for image in sequence]
-            print('num_frames', num_frames, height, width, channels, len(encoded_sequence), sequence[0].dtype)
-            features = tf.train.Features(feature={
-                'sequence_length': _int64_feature(num_frames),
-                'height': _int64_feature(height),
-                'width': _int64_feature(width),
-                'channels': _int64_feature(channels),
-                'images/encoded': _bytes_list_feature(encoded_sequence),
-            })
-            example = tf.train.Example(features=features)
-            writer.write(example.SerializeToString())
-
 def get_quad_list(quad):
     return [
         quad['q1'],
@@ -108,38 +78,16 @@ def get_quad_list(quad):
         quad['q4'],
     ]
 
-def read_frames_and_save_tf_records(output_dir, img_quads, image_size, sequences_per_file=128):
+def read_frames_and_save_tf_records(output_dir, img_quads, image_size, sequences_per_file=128, num_workers=None):
     """
     img_quads: {
         key1: {year_q1: img1, year_q2: img2, year_q3: img3}
         key2: {year_q1: img1, year_q2: img2, year_q3: img3}
     }
+    The shards are read and written in parallel, see tfrecord_builder.py
     """
-    partition_name = os.path.split(output_dir)[1]
-
-    sequences = []
-    sequence_iter = 0
-    sequence_lengths_file = open(os.path.join(output_dir, 'sequence_lengths.txt'), 'w')
-    for video_iter, key in enumerate(img_quads.keys()):
-        frame_fnames = get_quad_list(img_quads[key])
-        # frame_fnames = [quads['q1'], quads['q2'], quads['q3'], quads['q4']]
-        frames = skimage.io.imread_collection(frame_fnames)
-        frames = [frame[:,:,:3] for frame in frames] # take only RGB
-        for f in frames:
-            print(type(f), f.shape, f.meta)
-        if not sequences:
-            last_start_sequence_iter = sequence_iter
-            print("reading sequences starting at sequence %d" % sequence_iter)
-        sequences.append(frames)
-        sequence_iter += 1
-        sequence_lengths_file.write("%d\n" % len(frames)) # should be always 3
-        if (len(sequences) == sequences_per_file or
-                (video_iter == (len(img_quads) - 1))):
-            output_fname = 'sequence_{0}_to_{1}.tfrecords'.format(last_start_sequence_iter, sequence_iter - 1)
-            output_fname = os.path.join(output_dir, output_fname)
-            save_tf_record(output_fname, sequences)
-            sequences[:] = []
-    sequence_lengths_file.close()
+    sequences = [(key, get_quad_list(img_quads[key])) for key in img_quads.keys()]
+    build_tfrecords(output_dir, sequences, sequences_per_file, num_workers)
 
 def part_dict(dic, num):
     total = len(dic)
@@ -0,0 +1,142 @@
+"""
+Parallel builder of the TFRecord shards of the landsat/planet/cropped video datasets.
+
+The sequences (a key and the filenames of its frames) are split in order into
+balanced shards of at most sequences_per_file sequences. Every shard is read,
+encoded and written by a worker of a process pool, so decoding and writing
+scale with the cores, and the content and names of the shards only depend on
+the order of the sequences:
+    sequence_<first>_to_<last>.tfrecords
+    sequence_lengths.txt: length of every sequence, in order
+    index.json: sidecar index of the shards and of the records, see write_index
+"""
+import json
+import math
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import skimage.io
+import tensorflow as tf
+
+INDEX_FNAME = 'index.json'
+# a TFRecord is: uint64 length, uint32 crc of the length, data, uint32 crc of the data
+RECORD_OVERHEAD = 16
+
+
+def _bytes_list_feature(values):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def read_frames(frame_fnames):
+    """
+    Read the frames of a sequence, keeping only the RGB channels.
+    """
+    return [skimage.io.imread(fname)[:, :, :3] for fname in frame_fnames]
+
+
+def encode_sequence(frames):
+    """
+    Serialized tf.train.Example of a sequence, in the format of VarLenFeatureVideoDataset.
+    """
+    height, width, channels = frames[0].shape
+    features = tf.train.Features(feature={
+        'sequence_length': _int64_feature(len(frames)),
+        'height': _int64_feature(height),
+        'width': _int64_feature(width),
+        'channels': _int64_feature(channels),
+        'images/encoded': _bytes_list_feature([np.ascontiguousarray(frame).tobytes() for frame in frames]),
+    })
+    return tf.train.Example(features=features).SerializeToString()
+
+
+def shard_ranges(num_sequences, sequences_per_file):
+    """
+    [start, end) of the shards: ceil(num_sequences / sequences_per_file) shards
+    whose sizes differ by at most one.
+    """
+    if num_sequences == 0:
+        return []
+    num_shards = int(math.ceil(num_sequences / float(sequences_per_file)))
+    bounds = np.linspace(0, num_sequences, num_shards + 1).round().astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def write_shard(args):
+    """
+    Read and write the sequences of a shard. Returns its index entry.
+    Params:
+        args: (output_fname, [(key, frame_fnames), ...])
+    """
+    output_fname, sequences = args
+    keys, offsets, lengths = [], [], []
+    offset = 0
+    with tf.python_io.TFRecordWriter(output_fname) as writer:
+        for key, frame_fnames in sequences:
+            frames = read_frames(frame_fnames)
+            record = encode_sequence(frames)
+            writer.write(record)
+            keys.append(key)
+            offsets.append(offset)
+            lengths.append(len(frames))
+            offset += len(record) + RECORD_OVERHEAD
+    print('saved sequences to %s' % output_fname)
+    return {
+        'filename': os.path.basename(output_fname),
+        'num_records': len(keys),
+        'num_bytes': offset,
+        'keys': keys,
+        'offsets': offsets,
+        'sequence_lengths': lengths,
+    }
+
+
+def write_index(output_dir, shards):
+    """
+    Write sequence_lengths.txt and the sidecar index of the shards:
+        shards: [{filename, num_records, num_bytes}, ...]
+        records: [[shard, offset, key, sequence_length], ...] in the order of the sequences
+    """
+    lengths = [length for shard in shards for length in shard['sequence_lengths']]
+    with open(os.path.join(output_dir, 'sequence_lengths.txt'), 'w') as sequence_lengths_file:
+        sequence_lengths_file.write(''.join('%d\n' % length for length in lengths))
+    index = {
+        'shards': [{key: shard[key] for key in ['filename', 'num_records', 'num_bytes']} for shard in shards],
+        'records': [[shard_id, offset, key, length]
+                    for shard_id, shard in enumerate(shards)
+                    for offset, key, length in zip(shard['offsets'], shard['keys'], shard['sequence_lengths'])],
+    }
+    with open(os.path.join(output_dir, INDEX_FNAME), 'w') as index_file:
+        json.dump(index, index_file)
+    return index
+
+
+def build_tfrecords(output_dir, sequences, sequences_per_file=128, num_workers=None):
+    """
+    Write the sequences as TFRecord shards, their lengths and their index in output_dir.
+    Params:
+        sequences: list of (key, frame_fnames), in the order of the records
+        num_workers: processes reading and writing the shards (default: number of cpus)
+    Returns the index, see write_index
+    """
+    sequences = [(str(key), list(frame_fnames)) for key, frame_fnames in sequences]
+    tasks = [(os.path.join(output_dir, 'sequence_{0}_to_{1}.tfrecords'.format(start, end - 1)),
+              sequences[start:end])
+             for start, end in shard_ranges(len(sequences), sequences_per_file)]
+    num_workers = num_workers or os.cpu_count()
+    if num_workers > 1 and len(tasks) > 1:
+        pool = Pool(min(num_workers, len(tasks)))
+        try:
+            # imap keeps the order of the shards, they are written concurrently
+            shards = list(pool.imap(write_shard, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        shards = [write_shard(task) for task in tasks]
+    print('%d sequences in %d shards' % (len(sequences), len(shards)))
+    return write_index(output_dir, shards)
@@ -2,6 +2,9 @@ import os
 
 import numpy as np
 
+# path of the ffmpeg binary, e.g. a static build
+FFMPEG_BIN = os.environ.get('FFMPEG_BIN', 'ffmpeg')
+
 
 def save_gif(gif_fname, images, fps):
     """
@@ -21,7 +24,7 @@ def save_gif(gif_fname, images, fps):
     if head and not os.path.exists(head):
         os.makedirs(head)
     h, w, c = images[0].shape
-    cmd = ['/home/lming/ffmpeg-git-20190818-amd64-static/ffmpeg', '-y',
+    cmd = [FFMPEG_BIN, '-y',
            '-f', 'rawvideo',
            '-vcodec', 'rawvideo',
            '-r', '%.02f' % fps,
@@ -54,7 +57,7 @@ def encode_gif(images, fps):
     """
     from subprocess import Popen, PIPE
     h, w, c = images[0].shape
-    cmd = ['/home/lming/ffmpeg-git-20190818-amd64-static/ffmpeg', '-y',
+    cmd = [FFMPEG_BIN, '-y',
            '-f', 'rawvideo',
            '-vcodec', 'rawvideo',
            '-r', '%.02f' % fps,
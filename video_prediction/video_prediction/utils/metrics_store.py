@@ -0,0 +1,195 @@
+import csv
+import glob
+import json
+import os
+
+import numpy as np
+
+STORE_DNAME = 'metrics'
+NAMES_FNAME = 'names.json'
+# one raw little-endian file per column, appended to by MetricsWriter
+COLUMNS = [
+    ('sample_ind', '<i4'),
+    ('time_step', '<i2'),
+    ('metric', '<i2'),  # index in names.json
+    ('subtask', '<i2'),  # index in names.json
+    ('value', '<f4'),
+]
+
+
+def column_fname(store_dir, column):
+    return os.path.join(store_dir, '%s.bin' % column)
+
+
+def metric_task_name(metric_name, subtask, task_prefix='prediction_eval'):
+    """
+    Name of the directory of the images of a metric and subtask, e.g. prediction_eval_psnr_max.
+    """
+    return '_'.join([task_prefix, metric_name] + ([subtask] if subtask else []))
+
+
+class MetricsWriter(object):
+    """
+    Columnar store of the metrics of an evaluation, in the directory
+    <output_dir>/metrics: one row per sample index, time step, metric and
+    subtask. The rows are buffered and appended to the column files every
+    flush_rows rows, instead of opening a csv file per metric and batch.
+
+    writer = MetricsWriter(os.path.join(output_dir, 'metrics'))
+    writer.append('psnr', 'max', metrics, sample_start_ind)  # metrics: (batch_size, time steps)
+    writer.close()
+    """
+    def __init__(self, store_dir, flush_rows=1 << 16):
+        self.store_dir = store_dir
+        self.flush_rows = flush_rows
+        self.names = {'metric': [], 'subtask': []}
+        self._buffers = {column: [] for column, _ in COLUMNS}
+        self._num_buffered = 0
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        # a new evaluation overwrites the previous store
+        for column, _ in COLUMNS:
+            open(column_fname(store_dir, column), 'wb').close()
+        self._save_names()
+
+    def _name_ind(self, kind, name):
+        names = self.names[kind]
+        if name not in names:
+            names.append(name)
+            self._save_names()
+        return names.index(name)
+
+    def _save_names(self):
+        with open(os.path.join(self.store_dir, NAMES_FNAME), 'w') as f:
+            f.write(json.dumps(self.names, sort_keys=True, indent=4))
+
+    def append(self, metric_name, subtask, metrics, sample_start_ind=0):
+        """
+        Params:
+            metrics: array (num_samples, num_time_steps) of the samples
+                sample_start_ind, sample_start_ind + 1, ...
+            subtask: e.g. max, avg or min, or None if the metric has no subtasks.
+        """
+        metrics = np.asarray(metrics)
+        assert metrics.ndim == 2
+        num_samples, num_time_steps = metrics.shape
+        sample_ind, time_step = np.meshgrid(np.arange(sample_start_ind, sample_start_ind + num_samples),
+                                            np.arange(num_time_steps), indexing='ij')
+        size = metrics.size
+        self._buffers['sample_ind'].append(sample_ind.ravel())
+        self._buffers['time_step'].append(time_step.ravel())
+        self._buffers['metric'].append(np.full(size, self._name_ind('metric', metric_name)))
+        self._buffers['subtask'].append(np.full(size, self._name_ind('subtask', subtask or '')))
+        self._buffers['value'].append(metrics.ravel())
+        self._num_buffered += size
+        if self._num_buffered >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._num_buffered:
+            return
+        for column, dtype in COLUMNS:
+            with open(column_fname(self.store_dir, column), 'ab') as f:
+                f.write(np.concatenate(self._buffers[column]).astype(dtype).tobytes())
+            self._buffers[column] = []
+        self._num_buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+def load_store(store_dir):
+    """
+    All the rows of the store, as a dict of column arrays, and the names of
+    the metric and subtask indices of the rows.
+    """
+    with open(os.path.join(store_dir, NAMES_FNAME)) as f:
+        names = json.loads(f.read())
+    columns = {column: np.fromfile(column_fname(store_dir, column), dtype=dtype) for column, dtype in COLUMNS}
+    # drop the rows of a partial flush, e.g. of an interrupted evaluation
+    num_rows = min(len(values) for values in columns.values())
+    columns = {column: values[:num_rows] for column, values in columns.items()}
+    return columns, names
+
+
+def list_metrics(store_dir, store=None):
+    """
+    (metric_name, subtask) pairs of the store, sorted by task name.
+    """
+    columns, names = store or load_store(store_dir)
+    pairs = np.unique(np.stack([columns['metric'], columns['subtask']], axis=-1), axis=0)
+    pairs = [(names['metric'][m], names['subtask'][s] or None) for m, s in pairs]
+    return sorted(pairs, key=lambda pair: metric_task_name(*pair))
+
+
+def load_metrics(store_dir, metric_name, subtask=None, store=None):
+    """
+    Metrics (num_samples, num_time_steps) of a metric and subtask, the rows
+    sorted by sample index. Pass the result of load_store to load many
+    metrics without reading the store again.
+    """
+    columns, names = store or load_store(store_dir)
+    subtask = subtask or ''
+    if metric_name not in names['metric'] or subtask not in names['subtask']:
+        raise KeyError('No metric %s of subtask %s in %s' % (metric_name, subtask, store_dir))
+    mask = ((columns['metric'] == names['metric'].index(metric_name)) &
+            (columns['subtask'] == names['subtask'].index(subtask)))
+    sample_inds, sample_pos = np.unique(columns['sample_ind'][mask], return_inverse=True)
+    time_steps = columns['time_step'][mask]
+    metrics = np.full((len(sample_inds), time_steps.max() + 1 if len(time_steps) else 0), np.nan, dtype=np.float32)
+    metrics[sample_pos, time_steps] = columns['value'][mask]
+    return metrics
+
+
+def load_csv_metrics(prefix_fname):
+    """
+    Metrics of the per-task csv files written before the columnar store.
+    """
+    with open('%s.csv' % prefix_fname, newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter='\t', quotechar='|')
+        rows = list(reader)
+        # skip header (first row), indices (first column), and means (last column)
+        metrics = np.array(rows)[1:, 1:-1].astype(np.float32)
+    return metrics
+
+
+def load_method_store(method_dir):
+    """
+    Store of an evaluate.py output directory (see load_store), or None for
+    the output directories with the csv files of the tasks.
+    """
+    store_dir = os.path.join(method_dir, STORE_DNAME)
+    if not os.path.exists(os.path.join(store_dir, NAMES_FNAME)):
+        return None
+    return load_store(store_dir)
+
+
+def load_method_metrics(method_dir, task_name, metric_name, store=None):
+    """
+    Metrics of a task of an evaluate.py output directory, from its store or
+    else from the csv file of the task. Pass the result of load_method_store
+    to load many metrics without reading the store again.
+    """
+    store = store or load_method_store(method_dir)
+    if store is not None:
+        store_dir = os.path.join(method_dir, STORE_DNAME)
+        for metric_name_, subtask in list_metrics(store_dir, store=store):
+            if metric_name_ == metric_name and metric_task_name(metric_name, subtask) == task_name:
+                return load_metrics(store_dir, metric_name, subtask, store=store)
+    return load_csv_metrics(os.path.join(method_dir, task_name, 'metrics', metric_name))
+
+
+def list_method_metrics(method_dir, store=None):
+    """
+    (task_name, metric_name) pairs of an evaluate.py output directory, from
+    its store or else from the csv files of the tasks.
+    """
+    store = store or load_method_store(method_dir)
+    if store is not None:
+        return [(metric_task_name(metric_name, subtask), metric_name)
+                for metric_name, subtask in list_metrics(os.path.join(method_dir, STORE_DNAME), store=store)]
+    pairs = []
+    for metric_fname in sorted(glob.glob('%s/*/metrics/*.csv' % glob.escape(method_dir))):
+        head, tail = os.path.split(metric_fname)
+        pairs.append((head.split('/')[-2], os.path.splitext(tail)[0]))
+    return pairs
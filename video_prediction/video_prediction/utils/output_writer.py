@@ -0,0 +1,121 @@
+import os
+import queue
+import shutil
+import threading
+
+import cv2
+import numpy as np
+
+
+class OutputWriter(object):
+    """
+    Output stage of the generate and evaluate scripts: the save functions are
+    queued and run by worker threads, so the session loop does not wait for
+    the image encoding and the disk. The queue is bounded, so put blocks when
+    the writers fall behind instead of holding many batches in memory.
+    With num_workers=0 the save functions are run by put directly.
+    The first error of a save function is re-raised by put or close.
+    """
+    def __init__(self, num_workers=4, max_pending=32):
+        self.num_workers = num_workers
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._workers = [threading.Thread(target=self._run, daemon=True) for _ in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                fn, args, kwargs = task
+                if self._error is None:
+                    fn(*args, **kwargs)
+            except Exception as e:
+                self._error = self._error or e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def put(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs). The arguments must not be modified afterwards.
+        """
+        self._raise_error()
+        if not self._workers:
+            fn(*args, **kwargs)
+        else:
+            self._queue.put((fn, args, kwargs))
+
+    def join(self):
+        """
+        Wait for the queued save functions.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._raise_error()
+
+
+def makedirs(dirname):
+    if dirname and not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except FileExistsError:  # created by another writer
+            pass
+
+
+def save_png(image_fname, image):
+    """
+    Save a uint8 RGB or grayscale image (H, W, C).
+    """
+    if image.shape[-1] == 1:
+        image = np.tile(image, (1, 1, 3))
+    else:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    cv2.imwrite(image_fname, image)
+
+
+def save_pngs(image_fnames, images):
+    if image_fnames:
+        makedirs(os.path.dirname(image_fnames[0]))
+    for image_fname, image in zip(image_fnames, images):
+        save_png(image_fname, image)
+
+
+def link_files(fnames, dst_dir):
+    """
+    Hard link the files into dst_dir (copy them if the filesystem does not support it).
+    """
+    makedirs(dst_dir)
+    for fname in fnames:
+        dst_fname = os.path.join(dst_dir, os.path.basename(fname))
+        if os.path.exists(dst_fname):
+            os.remove(dst_fname)
+        try:
+            os.link(fname, dst_fname)
+        except OSError:
+            shutil.copyfile(fname, dst_fname)
+
+
+def save_gif(gif_fname, images, fps):
+    """
+    Save uint8 images (T, H, W, C) as a gif in process with PIL, without ffmpeg.
+    """
+    from PIL import Image
+    makedirs(os.path.dirname(gif_fname))
+    frames = [Image.fromarray(image[..., 0] if image.shape[-1] == 1 else image) for image in images]
+    frames[0].save(gif_fname, save_all=True, append_images=frames[1:],
+                   duration=int(round(1000. / fps)), loop=0)